@@ -0,0 +1,3 @@
+"""
+Benchmarks for the webscraper, run against in process mock sites
+"""
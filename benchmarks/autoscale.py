@@ -0,0 +1,63 @@
+"""
+Pages per second of a fixed worker pool against the autoscaling one,
+on generated sites with different latencies and sizes.
+Each crawl runs in a fresh process, see `synthetic_site.run_scenario`
+
+run with `python -m benchmarks.autoscale`
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import typer
+
+from benchmarks.synthetic_site import SiteShape, run_scenario
+from webscraper.settings import get_core_settings
+
+SITES = {
+    "small": SiteShape(nodes=100),
+    "fast": SiteShape(nodes=3000, fanout=10),
+    "slow": SiteShape(nodes=3000, fanout=10, latency=0.05),
+    "slower": SiteShape(nodes=2000, fanout=20, latency=0.2),
+}
+
+
+def crawl(shape: SiteShape, autoscale: bool, workers: int, max_workers: int) -> dict:
+    """crawl a site with a fixed or autoscaling pool, in a fresh process"""
+    settings = get_core_settings()
+    settings.autoscale_workers = autoscale
+    settings.num_workers = workers
+    settings.max_workers = max_workers
+    return run_scenario(shape)
+
+
+def main(
+    site: list[str] = typer.Option(list(SITES), help="sites to crawl"),
+    workers: int = 10,
+    max_workers: int = 200,
+):
+    """
+    Print pages per second with `workers` fixed workers and with the
+    autoscaling pool starting from `workers`, up to `max_workers`
+    """
+    context = multiprocessing.get_context("spawn")
+    for name in site:
+        shape = SITES[name]
+        rates = {}
+        for label, autoscale in (("fixed", False), ("autoscale", True)):
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                result = pool.submit(
+                    crawl, shape, autoscale, workers, max_workers
+                ).result()
+            rates[label] = result["pages_per_second"]
+            print(
+                f"{name:<8} {label:<10} pages={result['pages']:<6} "
+                f"pages/s={result['pages_per_second']:8.1f} "
+                f"p99={result['latency_p99'] * 1000:7.1f}ms "
+                f"cpu={result['cpu_seconds']:6.2f}s"
+            )
+        print(f"{name:<8} speedup    {rates['autoscale'] / rates['fixed']:.2f}x")
+
+
+if __name__ == "__main__":
+    typer.run(main)
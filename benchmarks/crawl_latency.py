@@ -0,0 +1,105 @@
+"""
+End to end crawl latency on the mock site.
+Compares the event driven workers against the old polling workers,
+which slept for a second whenever the queue was empty.
+The baseline only reproduces the wake up delay, not the extra second the old
+`begin` spent draining sleeping workers, so the difference shown is conservative.
+
+run with `python -m benchmarks.crawl_latency`
+"""
+
+import asyncio
+import logging
+import statistics
+import time
+from unittest import mock
+
+import httpx
+from httpx import ASGITransport, AsyncClient
+import typer
+
+from tests.mocks.site import app
+from webscraper import scraper
+from webscraper.datastore import get_db
+from webscraper.definitions import Status
+from webscraper.parsing import get_link_parser
+
+
+async def polling_worker(
+    crawl: scraper.CrawlContext, stop: asyncio.Event, _idle: asyncio.Event | None = None
+):
+    """
+    The previous worker implementation, kept here as a baseline
+    """
+    db, queue, settings = get_db(), crawl.queue, crawl.settings
+    while not stop.is_set():
+        try:
+            url, depth = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(1)
+            continue
+        db.set_url_status(settings.id_, url, Status.IN_PROGRESS)
+        async for extracted_url in scraper._page_links(
+            url, crawl.client, settings, db, get_link_parser()
+        ):
+            status = scraper.validate_next_steps(settings, extracted_url, depth)
+            db.set_url_status(settings.id_, extracted_url, status)
+            if status == Status.PENDING:
+                queue.put_nowait((extracted_url, depth + 1))
+        queue.task_done()
+
+
+class LatencyTransport(httpx.AsyncBaseTransport):
+    """
+    Adds a fixed delay to every request to stand in for network latency
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, latency: float):
+        self._transport = transport
+        self._latency = latency
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self._latency)
+        return await self._transport.handle_async_request(request)
+
+
+async def crawl_once(latency: float) -> float:
+    """time a single crawl of the mock site"""
+    client = AsyncClient(
+        transport=LatencyTransport(ASGITransport(app=app), latency),
+        base_url="http://test",
+    )
+    start = time.perf_counter()
+    await scraper.begin("http://test/", 10, client)
+    return time.perf_counter() - start
+
+
+def run(rounds: int, legacy: bool, latency: float) -> list[float]:
+    """run the crawl `rounds` times and return the latencies"""
+    latencies = []
+    for _ in range(rounds):
+        if legacy:
+            with mock.patch.object(scraper, "worker", polling_worker):
+                latencies.append(asyncio.run(crawl_once(latency)))
+        else:
+            latencies.append(asyncio.run(crawl_once(latency)))
+        get_db.cache_clear()
+    return latencies
+
+
+def main(rounds: int = 5, latency: float = 0.05):
+    """
+    Print crawl latency for both worker implementations
+    """
+    logging.disable(logging.CRITICAL)
+    for name, legacy in (("polling", True), ("event-driven", False)):
+        latencies = run(rounds, legacy, latency)
+        print(
+            f"{name:<14} mean={statistics.mean(latencies) * 1000:8.1f}ms "
+            f"median={statistics.median(latencies) * 1000:8.1f}ms "
+            f"max={max(latencies) * 1000:8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
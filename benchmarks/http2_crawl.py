@@ -0,0 +1,74 @@
+"""
+Crawl throughput and connections opened with HTTP/1.1 vs HTTP/2.
+The mock site is served on a local socket by a stand in server speaking both,
+with `latency` added to every response. HTTP/1.1 needs a connection per
+request in flight, HTTP/2 multiplexes them all over one.
+HTTP/2 is spoken with prior knowledge as the stand in doesn't do TLS,
+real sites negotiate it with ALPN. Needs `httpx[http2]`
+
+run with `python -m benchmarks.http2_crawl`
+"""
+
+import asyncio
+import logging
+import time
+
+from httpx import AsyncClient
+import typer
+
+from tests.mocks.server import StandInServer
+from tests.mocks.site import app
+from webscraper import scraper
+from webscraper.datastore import get_db
+from webscraper.definitions import Status
+from webscraper.settings import get_core_settings, get_http_client_settings
+from webscraper.utils import get_transport
+
+
+async def crawl(http2: bool, size: int, fanout: int, latency: float) -> dict:
+    """crawl the generated site once, returning what the server saw"""
+    async with StandInServer(app, latency) as server:
+        client = AsyncClient(transport=get_transport(http1=not http2, http2=http2))
+        start = time.perf_counter()
+        id_ = await scraper.begin(
+            f"{server.url}/nodes/0?size={size}&fanout={fanout}", 1000, client
+        )
+        elapsed = time.perf_counter() - start
+    pages = get_db().get_scrape_counts(id_)["counts"][Status.SUCCESS]
+    get_db.cache_clear()
+    return {
+        "pages": pages,
+        "requests": server.requests,
+        "connections": server.connections,
+        "elapsed": elapsed,
+    }
+
+
+def main(
+    size: int = 2000,
+    fanout: int = 5,
+    latency: float = 0.02,
+    workers: int = 50,
+    max_connections: int = 100,
+):
+    """
+    Print requests per second and connections opened for each protocol
+    """
+    logging.disable(logging.CRITICAL)
+    get_core_settings().num_workers = workers
+    http_settings = get_http_client_settings()
+    http_settings.max_connections = max_connections
+    http_settings.max_keepalive_connections = max_connections
+    http_settings.adaptive_rate_limit = False  # measure the transport, not the limiter
+    print(f"{size} pages, fanout {fanout}, latency {latency}s, {workers} workers")
+    for name, http2 in (("HTTP/1.1", False), ("HTTP/2", True)):
+        stats = asyncio.run(crawl(http2, size, fanout, latency))
+        print(
+            f"{name:<9} pages={stats['pages']:<6} time={stats['elapsed']:6.2f}s "
+            f"requests/s={stats['requests'] / stats['elapsed']:8.1f} "
+            f"connections={stats['connections']}"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,70 @@
+"""
+Memory and time of recording, compacting and analysing a large link graph.
+Pages link to a few pages near them and to a shared navigation, like a site,
+with urls as long as real ones so the cost of the url table shows up
+
+run with `python -m benchmarks.link_graph`
+"""
+
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import typer
+
+from webscraper.linkgraph import CsrGraph, LinkGraph
+
+
+def _url(page: int) -> str:
+    return f"https://example.com/section/{page % 97}/articles/{page}-some-title"
+
+
+def main(pages: int = 500000, links: int = 40, navigation: int = 20, seed: int = 0):
+    """
+    Record `pages` pages of `links` links each, `navigation` of them to the
+    same pages on every page, then compact, save, load and rank the graph
+    """
+    rng = random.Random(seed)
+    tracemalloc.start()
+    graph = LinkGraph(_url(0))
+    nav = [_url(page) for page in range(navigation)]
+    start = time.perf_counter()
+    for page in range(pages):
+        nearby = [
+            _url(min(pages - 1, max(0, page + rng.randint(-50, 50))))
+            for _ in range(links - navigation)
+        ]
+        graph.add_page(_url(page), nav + nearby)
+    recorded = time.perf_counter() - start
+    _, recording_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"recorded  {graph.nodes} urls, {graph.edges} links in {recorded:.1f}s,"
+        f" {recording_peak / 2**20:.0f} MiB traced,"
+        f" {recording_peak / graph.edges:.1f} bytes per link including urls"
+    )
+
+    start = time.perf_counter()
+    csr = graph.compact()
+    print(f"compacted in {time.perf_counter() - start:.2f}s")
+    with tempfile.NamedTemporaryFile(suffix=".graph") as f:
+        start = time.perf_counter()
+        csr.save(f.name)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        csr = CsrGraph.load(f.name)
+        print(f"saved in {saved:.2f}s, loaded in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    csr.in_degree(self_links=False)
+    print(f"in-degree in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    csr.pagerank()
+    print(f"pagerank in {time.perf_counter() - start:.2f}s")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print(f"peak rss {peak:.0f} MiB")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,71 @@
+"""
+Memory and time of the in memory db with and without the seen-set, for a
+crawl where most urls seen are never visited, e.g. external or too deep.
+Also measures the share of urls never added which the seen-set takes for known ones
+
+run with `python -m benchmarks.seen_set`
+"""
+
+import time
+import tracemalloc
+from uuid import uuid4
+
+import typer
+
+from webscraper.datastore import Db, MemoryDb, SeenSetDb
+from webscraper.definitions import Status
+
+
+def _url(i: int) -> str:
+    return f"https://example.com/section/{i % 97}/articles/{i}-some-title"
+
+
+def crawl(db: Db, urls: int, visited: float, trace: bool) -> tuple[float, float]:
+    """
+    record `urls` urls, visiting a `visited` share of them, returning the MiB
+    held if tracing allocations, which slows it down, and the seconds taken
+    """
+    id_ = uuid4()
+    db.add_scrape_event(id_, "https://example.com/", 10)
+    every = round(1 / visited)
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(urls):
+        url = _url(i)
+        db.get_url_statuses(id_, [url])  # as a page's links are checked first
+        if i % every:
+            db.set_url_statuses(id_, {url: Status.IGNORED})
+        else:
+            db.set_url_statuses(id_, {url: Status.PENDING})
+            db.set_url_status(id_, url, Status.IN_PROGRESS)
+            db.set_url_status(id_, url, Status.SUCCESS)
+    elapsed = time.perf_counter() - start
+    # the urls themselves are freed with the records, count them as the db's
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if trace and isinstance(db, SeenSetDb):
+        print(f"  {db.get_seen_set_stats(id_)}")
+        missed = sum(
+            db.get_url_status(id_, _url(-i)) != Status.MISSING for i in range(1, 100001)
+        )
+        print(f"  new urls taken for known ones {missed / 100000:.5f}")
+    return size / 2**20, elapsed
+
+
+def main(urls: int = 2000000, visited: float = 0.1, error_rate: float = 0.001):
+    """
+    Record `urls` urls with a `visited` share of them visited, with and
+    without a seen-set of `error_rate` false positives
+    """
+    for name, new_db in (
+        ("memory", MemoryDb),
+        ("seen-set", lambda: SeenSetDb(MemoryDb(), error_rate, 1000000)),
+    ):
+        _, seconds = crawl(new_db(), urls, visited, trace=False)
+        mib, _ = crawl(new_db(), urls, visited, trace=True)
+        print(f"{name:<9} {mib:8.1f} MiB {seconds:6.1f}s")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,68 @@
+"""
+Crawl throughput of sharded crawls on a generated mock site.
+Each shard serves the mock site in its own process too, so this shows how
+the crawler's own cpu work (parsing, validation, bookkeeping) scales with cores.
+
+run with `python -m benchmarks.sharded_crawl`
+"""
+
+import asyncio
+from functools import partial
+import logging
+import os
+import time
+
+from httpx import ASGITransport, AsyncClient
+import typer
+
+from benchmarks.crawl_latency import LatencyTransport
+from tests.mocks.site import app
+from webscraper import scraper
+from webscraper.datastore import get_db
+from webscraper.definitions import Status
+from webscraper.sharding import begin_sharded
+
+
+def mock_client(latency: float) -> AsyncClient:
+    """client for the mock site, picklable through `partial`"""
+    return AsyncClient(
+        transport=LatencyTransport(ASGITransport(app=app), latency),
+        base_url="http://test",
+    )
+
+
+def crawl(processes: int, url: str, latency: float) -> tuple[int, float]:
+    """crawl the site, returning the pages scraped and the time taken"""
+    start = time.perf_counter()
+    if processes:
+        id_ = begin_sharded(url, 1000, processes, partial(mock_client, latency))
+    else:
+        id_ = asyncio.run(scraper.begin(url, 1000, mock_client(latency)))
+    elapsed = time.perf_counter() - start
+    pages = get_db().get_scrape_counts(id_)["counts"][Status.SUCCESS]
+    get_db.cache_clear()
+    return pages, elapsed
+
+
+def main(size: int = 2000, fanout: int = 5, latency: float = 0, max_processes: int = 4):
+    """
+    Print pages per second for a single event loop, then 1 to `max_processes` shards.
+    Shard counts above the number of cores can't scale
+    """
+    logging.disable(logging.CRITICAL)
+    url = f"http://test/nodes/0?size={size}&fanout={fanout}"
+    print(f"{os.cpu_count()} cores, {size} pages, fanout {fanout}, latency {latency}s")
+    baseline = None
+    for processes in range(max_processes + 1):
+        pages, elapsed = crawl(processes, url, latency)
+        rate = pages / elapsed
+        baseline = baseline or rate
+        name = f"{processes} shards" if processes else "single loop"
+        print(
+            f"{name:<12} pages={pages:<6} time={elapsed:6.2f}s "
+            f"pages/s={rate:8.1f} speedup={rate / baseline:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
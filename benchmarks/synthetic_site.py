@@ -0,0 +1,262 @@
+"""
+Crawl benchmarks on large generated sites of configurable shape.
+Each scenario crawls a synthetic ASGI site in process through the retrying
+transport, in a fresh process of its own so peak RSS and cpu time are its own.
+Pages per second, p50 / p99 page latency (request sent to body read and
+parsed), peak RSS and cpu time are printed and written to a json report,
+which a later run can be compared against with `--compare`
+
+run with `python -m benchmarks.synthetic_site`
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import time
+
+import httpx
+from pydantic import BaseModel
+import typer
+
+from webscraper import scraper
+from webscraper.datastore import get_db
+from webscraper.definitions import Status
+from webscraper.settings import get_http_client_settings
+from webscraper.utils import RetryTransport
+
+
+class SiteShape(BaseModel):
+    """shape of a generated site"""
+
+    nodes: int = 5000  # pages on the site
+    fanout: int = 5  # links from each page to its children
+    depth: int = 100  # max depth crawled
+    duplicate_ratio: float = 0.5  # share of links pointing at random existing pages
+    latency: float = 0  # seconds added to every response
+    throttle_rate: float = 0  # share of requests answered with a 429
+    page_bytes: int = 4096  # rough html size of each page
+
+
+SCENARIOS = {
+    "wide": SiteShape(fanout=50, duplicate_ratio=0.2),
+    "deep": SiteShape(fanout=1, duplicate_ratio=0, nodes=2000, depth=2000),
+    "duplicates": SiteShape(duplicate_ratio=0.9),
+    "latency": SiteShape(nodes=2000, latency=0.02),
+    "throttled": SiteShape(nodes=2000, throttle_rate=0.05),
+}
+
+
+class SyntheticSite:
+    """
+    ASGI app of a generated site. Page n links to its children
+    n * fanout + 1 ... n * fanout + fanout, plus links to random pages making up
+    `duplicate_ratio` of its links, all picked deterministically per page
+    """
+
+    def __init__(self, shape: SiteShape):
+        self.shape = shape
+        self.requests = 0
+        self._random = random.Random(0)
+        self._filler = b"<p>lorem ipsum dolor sit amet</p>" * (shape.page_bytes // 32)
+        ratio = min(shape.duplicate_ratio, 0.99)
+        self._duplicates = round(max(shape.fanout, 1) * ratio / (1 - ratio))
+
+    def page(self, node: int) -> bytes:
+        """html of a page"""
+        shape = self.shape
+        first = node * shape.fanout + 1
+        links = list(range(first, min(first + shape.fanout, shape.nodes)))
+        rng = random.Random(node)
+        links += [rng.randrange(shape.nodes) for _ in range(self._duplicates)]
+        anchors = "".join(f'<a href="/p/{link}">page {link}</a>' for link in links)
+        return (
+            f"<html><body><h1>page {node}</h1>".encode()
+            + self._filler
+            + f"{anchors}</body></html>".encode()
+        )
+
+    async def __call__(self, scope, receive, send):
+        self.requests += 1
+        # always suspend like a network round trip would, else nothing in the
+        # crawl ever waits and one worker keeps the event loop to itself
+        await asyncio.sleep(self.shape.latency)
+        path = scope["path"]
+        status, headers, body = 404, [(b"content-type", b"text/plain")], b""
+        if self._random.random() < self.shape.throttle_rate:
+            status, headers = 429, headers + [(b"retry-after", b"0")]
+        elif path.startswith("/p/") and path[3:].isdigit():
+            if (node := int(path[3:])) < self.shape.nodes:
+                status, body = 200, self.page(node)
+        if status == 200:
+            headers = [(b"content-type", b"text/html; charset=utf-8")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+class _TimedStream(httpx.AsyncByteStream):
+    """records the time from the request until the body is closed"""
+
+    def __init__(self, stream, start: float, samples: list[float]):
+        self._stream = stream
+        self._start = start
+        self._samples = samples
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+        self._samples.append(time.perf_counter() - self._start)
+
+
+class TimingTransport(httpx.AsyncBaseTransport):
+    """
+    Times each page from sending the request to the crawler being done with
+    its body, which includes retries and streaming link extraction
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+        self.samples: list[float] = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_TimedStream(response.stream, start, self.samples),
+            extensions=response.extensions,
+        )
+
+
+def run_scenario(shape: SiteShape) -> dict:
+    """crawl a generated site, meant to run in a fresh process"""
+    logging.disable(logging.CRITICAL)
+    settings = get_http_client_settings()
+    site = SyntheticSite(shape)
+    timing = TimingTransport(
+        # retries 429s straight away, without the adaptive rate limiter,
+        # so the crawler is measured rather than the limits
+        RetryTransport(httpx.ASGITransport(app=site), settings.status_retries, 0, 0)
+    )
+    client = httpx.AsyncClient(transport=timing)
+    cpu_start, start = time.process_time(), time.perf_counter()
+    id_ = asyncio.run(scraper.begin("http://synthetic.test/p/0", shape.depth, client))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    pages = get_db().get_scrape_counts(id_)["counts"][Status.SUCCESS]
+    percentiles = statistics.quantiles(timing.samples, n=100)
+    return {
+        "shape": shape.model_dump(),
+        "pages": pages,
+        "requests": site.requests,
+        "elapsed": elapsed,
+        "pages_per_second": pages / elapsed,
+        "latency_p50": percentiles[49],
+        "latency_p99": percentiles[98],
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cpu_seconds": cpu,
+    }
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(report: dict, baseline_path: str):
+    """print the change of each scenario's metrics against an earlier report"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nchange against {baseline_path} (commit {baseline.get('commit')})")
+    for name, result in report["scenarios"].items():
+        if (before := baseline["scenarios"].get(name)) is None:
+            continue
+        changes = " ".join(
+            f"{metric}={(result[metric] / before[metric] - 1) * 100:+6.1f}%"
+            for metric in (
+                "pages_per_second",
+                "latency_p99",
+                "peak_rss_mb",
+                "cpu_seconds",
+            )
+            if before[metric]
+        )
+        print(f"{name:<12} {changes}")
+
+
+def main(
+    scenario: list[str] = typer.Option(list(SCENARIOS), help="scenarios to run"),
+    output: str = "benchmark_results.json",
+    compare: str | None = typer.Option(None, help="earlier report to compare to"),
+    nodes: int | None = None,
+    fanout: int | None = None,
+    depth: int | None = None,
+    duplicate_ratio: float | None = None,
+    latency: float | None = None,
+    throttle_rate: float | None = None,
+):
+    """
+    Run benchmark scenarios and write the report to `output`.
+    Shape options override those of every scenario run
+    """
+    overrides = {
+        name: value
+        for name, value in {
+            "nodes": nodes,
+            "fanout": fanout,
+            "depth": depth,
+            "duplicate_ratio": duplicate_ratio,
+            "latency": latency,
+            "throttle_rate": throttle_rate,
+        }.items()
+        if value is not None
+    }
+    report: dict = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "scenarios": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for name in scenario:
+        shape = SCENARIOS[name].model_copy(update=overrides)
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_scenario, shape).result()
+        report["scenarios"][name] = result
+        print(
+            f"{name:<12} pages={result['pages']:<6} "
+            f"pages/s={result['pages_per_second']:8.1f} "
+            f"p50={result['latency_p50'] * 1000:7.2f}ms "
+            f"p99={result['latency_p99'] * 1000:7.2f}ms "
+            f"rss={result['peak_rss_mb']:6.1f}MB cpu={result['cpu_seconds']:6.2f}s"
+        )
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {output}")
+    if compare:
+        _compare(report, compare)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -4,8 +4,16 @@ Test configuration
 
 import pytest_asyncio
 from httpx import AsyncClient, ASGITransport
-from webscraper.settings import get_http_client_settings
+from webscraper.utils import get_httpx_client
+from webscraper.settings import DbBackend, get_core_settings, get_http_client_settings
 from webscraper.datastore import get_db
+from webscraper.fingerprint import get_content_index
+from webscraper.httpcache import get_response_cache
+from webscraper.metrics import get_metrics
+from webscraper.parsing import get_link_parser
+from webscraper.ratelimit import get_rate_controller
+from webscraper.robots import get_robots_cache
+from webscraper.scope import get_scope
 from .mocks.site import app
 
 
@@ -39,10 +47,34 @@ async def setup_teardown():
     yield
 
 
+@pytest_asyncio.fixture(autouse=True, params=list(DbBackend))
+async def db_backend(request, tmp_path):
+    """
+    run every test against each db backend
+    """
+    settings = get_core_settings()
+    settings.db_backend = request.param
+    settings.sqlite_path = str(tmp_path / "webscraper.db")
+    yield request.param
+    settings.db_backend = DbBackend.MEMORY
+
+
 @pytest_asyncio.fixture(scope="function", autouse=True)
 async def cleanup():
     """
     Cleanup between tests
     """
     yield
+    get_db().close()
     get_db.cache_clear()
+    get_rate_controller.cache_clear()
+    get_link_parser().close()
+    get_link_parser.cache_clear()
+    get_httpx_client.cache_clear()  # begin closes the client when it is done
+    if cache := get_response_cache():
+        cache.close()
+    get_response_cache.cache_clear()
+    get_content_index.cache_clear()
+    get_robots_cache.cache_clear()
+    get_scope.cache_clear()
+    get_metrics.cache_clear()
@@ -0,0 +1,204 @@
+"""
+A stand in server for the mock site on a real socket, speaking HTTP/1.1 and
+cleartext HTTP/2 (prior knowledge), which counts the connections it accepts.
+Only GET requests without bodies are supported
+"""
+
+import asyncio
+from urllib.parse import unquote
+
+import h11
+import h2.config
+import h2.connection
+import h2.events
+
+H2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+Headers = list[tuple[bytes, bytes]]
+
+
+class StandInServer:
+    """
+    Serves an ASGI app on localhost until the context exits.
+    `latency` is added to every response, like a slow upstream would
+    """
+
+    def __init__(self, app, latency: float = 0):
+        self._app = app
+        self._latency = latency
+        self._server: asyncio.Server | None = None
+        self.port = 0
+        self.connections = 0
+        self.http2_connections = 0
+        self.requests = 0
+        self._writers: set[asyncio.StreamWriter] = set()
+
+    @property
+    def url(self) -> str:
+        """base url of the server"""
+        return f"http://127.0.0.1:{self.port}"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *_):
+        if self._server is not None:
+            self._server.close()
+            for writer in self._writers:
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _call_app(
+        self, method: bytes, target: bytes, headers: Headers, http_version: str
+    ) -> tuple[int, Headers, bytes]:
+        """run a request through the app, returning the status, headers and body"""
+        self.requests += 1
+        await asyncio.sleep(self._latency)
+        path, _, query = target.partition(b"?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": http_version,
+            "method": method.decode(),
+            "scheme": "http",
+            "path": unquote(path.decode()),
+            "raw_path": path,
+            "query_string": query,
+            "root_path": "",
+            "headers": [(name.lower(), value) for name, value in headers],
+            "server": ("127.0.0.1", self.port),
+            "client": ("127.0.0.1", 0),
+        }
+        status, response_headers, body = 500, [], []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            nonlocal status, response_headers
+            if message["type"] == "http.response.start":
+                status, response_headers = message["status"], message["headers"]
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        await self._app(scope, receive, send)
+        return status, response_headers, b"".join(body)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            try:
+                start = await reader.readexactly(len(H2_PREFACE))
+            except asyncio.IncompleteReadError as e:
+                start = e.partial
+            if start == H2_PREFACE:
+                self.http2_connections += 1
+                await self._serve_h2(start, reader, writer)
+            elif start:
+                await self._serve_h11(start, reader, writer)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _serve_h11(
+        self, data: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """HTTP/1.1 handles one request at a time per connection"""
+        conn = h11.Connection(h11.SERVER)
+        conn.receive_data(data)
+        request = None
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                conn.receive_data(await reader.read(65536))
+            elif isinstance(event, h11.Request):
+                request = event
+            elif isinstance(event, h11.EndOfMessage) and request is not None:
+                status, headers, body = await self._call_app(
+                    request.method, request.target, list(request.headers), "1.1"
+                )
+                headers = [
+                    header
+                    for header in headers
+                    if header[0].lower() != b"content-length"
+                ]
+                headers.append((b"content-length", str(len(body)).encode()))
+                writer.write(
+                    conn.send(h11.Response(status_code=status, headers=headers))
+                )
+                writer.write(conn.send(h11.Data(data=body)))
+                writer.write(conn.send(h11.EndOfMessage()))
+                await writer.drain()
+                if conn.our_state is not h11.DONE or conn.their_state is not h11.DONE:
+                    return
+                conn.start_next_cycle()
+                request = None
+            elif isinstance(event, h11.ConnectionClosed) or event is h11.PAUSED:
+                return
+
+    async def _serve_h2(
+        self, data: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """HTTP/2 multiplexes every request over the one connection"""
+        conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding=None)
+        )
+        conn.initiate_connection()
+        requests: dict[int, Headers] = {}
+        window_updated = asyncio.Event()
+        streams: set[asyncio.Task] = set()
+
+        async def respond(stream_id: int, headers: Headers):
+            pseudo = dict(header for header in headers if header[0].startswith(b":"))
+            regular = [header for header in headers if not header[0].startswith(b":")]
+            regular.append((b"host", pseudo.get(b":authority", b"")))
+            status, response_headers, body = await self._call_app(
+                pseudo[b":method"], pseudo[b":path"], regular, "2"
+            )
+            conn.send_headers(
+                stream_id,
+                [(b":status", str(status).encode())]
+                + [
+                    (name.lower(), value)
+                    for name, value in response_headers
+                    if name.lower() not in (b"connection", b"transfer-encoding")
+                ],
+            )
+            while body:
+                # wait for the client to open the flow control window
+                while not (window := conn.local_flow_control_window(stream_id)):
+                    window_updated.clear()
+                    await window_updated.wait()
+                size = min(window, conn.max_outbound_frame_size, len(body))
+                conn.send_data(stream_id, body[:size])
+                body = body[size:]
+                writer.write(conn.data_to_send())
+            conn.end_stream(stream_id)
+            writer.write(conn.data_to_send())
+            await writer.drain()
+
+        while data:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = list(event.headers)
+                elif isinstance(event, h2.events.StreamEnded):
+                    task = asyncio.create_task(
+                        respond(event.stream_id, requests.pop(event.stream_id))
+                    )
+                    streams.add(task)
+                    task.add_done_callback(streams.discard)
+                elif isinstance(event, h2.events.WindowUpdated):
+                    window_updated.set()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    data = b""
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            if data:
+                data = await reader.read(65536)
+        for task in streams:
+            task.cancel()
@@ -2,9 +2,19 @@
 A mock site used to test web scraping
 """
 
+import asyncio
+import gzip
 import pathlib
+from xml.sax.saxutils import escape
 from fastapi import FastAPI, Header, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from httpx import ASGITransport, AsyncClient
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
 
 
@@ -17,6 +27,13 @@ current_dir = pathlib.Path(__file__).parent
 templates = Jinja2Templates(directory=f"{current_dir}/templates")
 
 
+def client() -> AsyncClient:
+    """
+    client for the mock site, module level so it can be pickled for other processes
+    """
+    return AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+
+
 @app.get("/", response_class=HTMLResponse)
 def homepage(request: Request):
     """
@@ -51,3 +68,158 @@ def rate_limited(attempt: int = Header(None)):
     if attempt == 2:
         return JSONResponse({"detail": "failed"}, 500)
     return JSONResponse({"detail": "rate limitted"}, 429)
+
+
+@app.get("/slow", response_class=HTMLResponse)
+async def slow_page():
+    """
+    Test shutdown while a page is in flight
+    """
+    await asyncio.sleep(10)
+    return HTMLResponse("<html></html>")
+
+
+@app.get("/cached", response_class=HTMLResponse)
+def cached_page(request: Request, if_none_match: str = Header(None)):
+    """
+    Test conditional requests, the page never changes
+    """
+    if if_none_match == '"v1"':
+        return HTMLResponse(status_code=304)
+    response = templates.TemplateResponse(request, "nextpage.html")
+    response.headers["ETag"] = '"v1"'
+    return response
+
+
+@app.get("/nodes/{node}", response_class=HTMLResponse)
+def node_page(node: int, size: int = 1000, fanout: int = 5):
+    """
+    A generated site for benchmarks, `size` pages each linking to
+    `fanout` others and back to the first page, with some text to parse
+    """
+    children = [(node * fanout + i) % size for i in range(1, fanout + 1)]
+    links = "".join(
+        f'<li><a href="/nodes/{child}?size={size}&fanout={fanout}">node {child}</a></li>'
+        for child in children
+    )
+    text = "<p>lorem ipsum dolor sit amet</p>" * 50
+    return HTMLResponse(
+        f"<html><body><h1>node {node}</h1>{text}<ul>{links}"
+        f'<li><a href="/nodes/0?size={size}&fanout={fanout}">home</a></li></ul>'
+        "</body></html>"
+    )
+
+
+@app.get("/bogus-charset")
+def bogus_charset():
+    """
+    Test a page declaring a charset no codec exists for
+    """
+    return Response(
+        b'<html><body><a href="/about">about</a></body></html>',
+        headers={"Content-Type": "text/html; charset=bogus"},
+    )
+
+
+@app.get("/assets", response_class=HTMLResponse)
+def assets():
+    """
+    Test skipping responses which can't hold links, not linked from the homepage
+    """
+    links = ["/files/report.pdf", "/files/photo.JPG", "/download", "/huge", "/long"]
+    items = "".join(f'<li><a href="{link}">{link}</a></li>' for link in links)
+    return HTMLResponse(f"<html><body><ul>{items}</ul></body></html>")
+
+
+@app.get("/download")
+def download():
+    """
+    A binary file without a telling extension
+    """
+    return Response(b"%PDF-1.4" + bytes(1024), media_type="application/pdf")
+
+
+@app.get("/huge", response_class=HTMLResponse)
+def huge_page():
+    """
+    An html page with a Content-Length over the size cap used in tests
+    """
+    filler = "<p>lorem ipsum dolor sit amet</p>" * 500
+    return HTMLResponse(f'<html><body>{filler}<a href="/huge-link">x</a></body></html>')
+
+
+@app.get("/long")
+def long_page():
+    """
+    A chunked html page without a Content-Length, running over the size cap
+    """
+
+    def chunks():
+        yield b'<html><body><a href="/early">early</a>'
+        for _ in range(500):
+            yield b"<p>lorem ipsum dolor sit amet</p>"
+        yield b'<a href="/late">late</a></body></html>'
+
+    return StreamingResponse(chunks(), media_type="text/html")
+
+
+# robots.txt and sitemaps are only served on this host, so other tests crawl as before
+ROBOTS_HOST = "robots.test"
+ROBOTS_TXT = f"""
+User-agent: otherbot
+Disallow: /
+
+User-agent: *
+Disallow: /blog
+Allow: /blog/ok$
+Crawl-delay: 0.05
+Sitemap: http://{ROBOTS_HOST}/sitemap_index.xml
+"""
+
+
+def _sitemap(tag: str, entry: str, locs: list[str]) -> bytes:
+    entries = "".join(f"<{entry}><loc>{escape(loc)}</loc></{entry}>" for loc in locs)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<{tag} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</{tag}>'
+    ).encode()
+
+
+@app.get("/robots.txt")
+def robots_txt(request: Request):
+    """
+    Test robots.txt rules
+    """
+    if request.url.hostname != ROBOTS_HOST:
+        return PlainTextResponse("", 404)
+    return PlainTextResponse(ROBOTS_TXT)
+
+
+@app.get("/sitemap_index.xml")
+def sitemap_index(request: Request):
+    """
+    Test sitemap indexes
+    """
+    if request.url.hostname != ROBOTS_HOST:
+        return Response(status_code=404)
+    locs = [f"http://{ROBOTS_HOST}/sitemap-pages.xml.gz"]
+    return Response(
+        _sitemap("sitemapindex", "sitemap", locs), media_type="application/xml"
+    )
+
+
+@app.get("/sitemap-pages.xml.gz")
+def sitemap_pages(request: Request):
+    """
+    Test gzipped sitemaps, listing pages that aren't linked from the homepage
+    """
+    if request.url.hostname != ROBOTS_HOST:
+        return Response(status_code=404)
+    locs = [
+        f"http://{ROBOTS_HOST}/payments",
+        f"http://{ROBOTS_HOST}/nodes/7?size=10&fanout=0",
+        f"http://{ROBOTS_HOST}/blog",
+        "http://elsewhere.test/page",
+    ]
+    body = gzip.compress(_sitemap("urlset", "url", locs))
+    return Response(body, media_type="application/gzip")
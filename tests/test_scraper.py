@@ -2,27 +2,76 @@
 Test Scraper functionality
 """
 
+import asyncio
+import io
 import json
 import logging
+import math
 import os
-from uuid import uuid4
+import pathlib
+import signal
+import time
+from uuid import UUID, uuid4
 from httpx import ASGITransport, AsyncClient
 import httpx
-from pydantic import HttpUrl, ValidationError
+from pydantic import ValidationError
 import pytest
-from webscraper.datastore import get_db
+from webscraper.datastore import SeenSetDb, SqliteDb, get_db
 from webscraper.scraper import (
     _extract_links,
-    _fetch_page,
+    _page_links,
     begin,
     get_results,
+    queue_links,
+    resume,
     validate_next_steps,
+    write_results,
+)
+from webscraper.autoscale import WorkerPool
+from webscraper.checkpoint import read_checkpoint, take_checkpoint, write_checkpoint
+from webscraper.definitions import Checkpoint, JobState, Status
+from webscraper.frontier import Frontier
+from webscraper.fingerprint import ContentIndex, PageFingerprint
+from webscraper.httpcache import ResponseCache, get_response_cache
+from webscraper.linkgraph import CsrGraph, LinkGraph
+from webscraper.logs import (
+    BackgroundHandler,
+    BatchedFileHandler,
+    BatchedStreamHandler,
+    JsonFormatter,
+    RateLimitFilter,
+)
+from webscraper.metrics import BUCKETS, Histogram, Stage, get_metrics, serve_metrics
+from webscraper.profiling import profiled
+from webscraper.service import CrawlService
+from webscraper.parsing import (
+    LinkParser,
+    StreamingLinkExtractor,
+    extract_hrefs,
+    stream_hrefs,
+)
+from webscraper.results import read_ndjson_results
+from webscraper.robots import get_robots_cache, parse_robots
+from webscraper.scope import Scope
+from webscraper.seenset import ScalableBloomFilter
+from webscraper.ratelimit import HostLimiter, RateController, parse_retry_after
+from webscraper.sharding import begin_sharded, shard_of
+from webscraper.settings import (
+    LinkExtractor,
+    ParseMode,
+    get_core_settings,
+    get_http_client_settings,
+)
+from webscraper.urls import UrlNormalizer, normalize_url
+from webscraper.utils import (
+    get_httpx_client,
+    get_transport,
+    setup_logging,
+    RetryTransport,
 )
-from webscraper.definitions import Status
-from webscraper.settings import get_core_settings, get_http_client_settings
-from webscraper.utils import get_httpx_client, setup_logging, RetryTransport
 from webscraper.__main__ import scrape
-from .mocks.site import app
+from .mocks import site
+from .mocks.site import ROBOTS_HOST, app
 
 
 def test_main_runs():
@@ -52,12 +101,84 @@ def test_root_logger_config():
     settings = get_core_settings()
     settings.log_level = "DEBUG"
     setup_logging()
+    setup_logging()  # replaces the earlier setup
     root_logger = logging.getLogger()
 
     assert root_logger.level == logging.DEBUG
-    types = [type(handler) for handler in root_logger.handlers]
-    assert logging.StreamHandler in types
-    assert logging.FileHandler in types
+    handlers = [
+        handler
+        for handler in root_logger.handlers
+        if isinstance(handler, BackgroundHandler)
+    ]
+    assert len(handlers) == 1
+    assert (listener := handlers[0].listener) is not None
+    types = [type(handler) for handler in listener.handlers]
+    assert BatchedStreamHandler in types
+    assert BatchedFileHandler in types
+
+
+def test_background_logging(tmp_path):
+    """
+    records are written as json lines by a background thread in batches,
+    and records past the rate limit are dropped and counted
+    """
+    rate_limit = RateLimitFilter(2)
+    records = [
+        logging.makeLogRecord({"levelno": logging.INFO, "created": 100.5})
+        for _ in range(4)
+    ]
+    assert [rate_limit.filter(record) for record in records] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+    warning = logging.makeLogRecord({"levelno": logging.WARNING, "created": 100.6})
+    assert rate_limit.filter(warning) and getattr(warning, "dropped", 0) == 2
+    later = logging.makeLogRecord({"levelno": logging.INFO, "created": 101.0})
+    assert rate_limit.filter(later) and not hasattr(later, "dropped")
+
+    path = tmp_path / "log.jsonl"
+    file_handler = BatchedFileHandler(str(path), batch_size=3, flush_interval=60)
+    file_handler.setFormatter(JsonFormatter())
+    handler = BackgroundHandler(file_handler, flush_interval=60)
+    logger = logging.getLogger("test_background_logging")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    def written() -> list[dict]:
+        deadline = time.monotonic() + 2
+        while not (text := path.read_text()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [json.loads(line) for line in text.splitlines()]
+
+    try:
+        logger.info("visited %s", "http://test/0", extra={"links": 1})
+        logger.info("visited %s", "http://test/1", extra={"links": 2})
+        time.sleep(0.1)
+        assert not path.read_text()  # waiting for a full batch
+        logger.info("visited %s", "http://test/2", extra={"links": 3})
+        lines = written()
+        assert [line["message"] for line in lines] == [
+            f"visited http://test/{i}" for i in range(3)
+        ]
+        assert [line["links"] for line in lines] == [1, 2, 3]
+        assert lines[0]["level"] == "INFO"
+        assert lines[0]["function"] == "test_background_logging"
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed")  # warnings and up are written straight away
+        deadline = time.monotonic() + 2
+        while len(lines := written()) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert "ValueError: boom" in lines[3]["exception"]
+        logger.info("last")
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert written()[-1]["message"] == "last"  # flushed when closed
 
 
 def test_get_httpx_client():
@@ -77,6 +198,7 @@ def test_get_httpx_client():
     assert transport._jitter == settings.jitter_range
     assert transport._backoff_factor == settings.backoff_factor
     assert transport._status_retries == settings.status_retries
+    assert isinstance(transport._rate_controller, RateController)
 
     wrapped_transport = transport._transport
     assert isinstance(wrapped_transport, httpx.AsyncHTTPTransport)
@@ -86,6 +208,7 @@ def test_get_httpx_client():
         wrapped_transport._pool._max_keepalive_connections
         == settings.max_keepalive_connections
     )
+    assert wrapped_transport._pool._http2 is settings.http2
 
 
 @pytest.mark.asyncio
@@ -94,7 +217,7 @@ async def test_db_interface():
     Test db interface
     """
     db = get_db()
-    url = HttpUrl("http://random")
+    url = "http://random/"
     id_ = uuid4()
     with pytest.raises(KeyError):
         db.get_scrape_event_settings(id_)
@@ -111,26 +234,67 @@ async def test_db_interface():
     results = db.get_scrape_stats(id_)
     assert results["total_count"] == 1
     assert results["counts"]["success"] == 1
-    assert results["status"]["success"] == [url.encoded_string()]
+    assert results["status"]["success"] == [url]
+
+    # counts follow every transition
+    db.set_url_status(id_, "http://random/a", Status.PENDING)
+    db.set_url_status(id_, "http://random/a", Status.IN_PROGRESS)
+    db.set_url_status(id_, "http://random/a", Status.IN_PROGRESS)
+    db.set_url_status(id_, "http://random/a", Status.FAILED)
+    counts = db.get_scrape_counts(id_)
+    assert counts["total_count"] == 2
+    assert counts["counts"][Status.PENDING] == 0
+    assert counts["counts"][Status.IN_PROGRESS] == 0
+    assert counts["counts"][Status.FAILED] == 1
+    streamed = {status: list(urls) for status, urls in db.iter_scrape_stats(id_)}
+    assert streamed == db.get_scrape_stats(id_)["status"]
+
+
+def test_sqlite_db(tmp_path: pathlib.Path):
+    """
+    Test sqlite writes are buffered and survive reopening the db
+    """
+    path = str(tmp_path / "test.db")
+    db = SqliteDb(path, batch_size=2, flush_interval=3600)
+    id_ = uuid4()
+    db.add_scrape_event(id_, "http://random", 10)
+    db.set_url_status(id_, "http://random/", Status.SUCCESS)
+    assert db._pending  # buffered until the batch is full
+    assert db.get_url_status(id_, "http://random/") == Status.SUCCESS
+    db.set_url_status(id_, "http://random/a", Status.PENDING)
+    assert not db._pending
+    db.set_url_status(id_, "http://random/a", Status.FAILED)
+    db.close()
+
+    db = SqliteDb(path)
+    assert db.get_url_status(id_, "http://random/a") == Status.FAILED
+    counts: dict[Status, int] = {status: 0 for status in Status}
+    counts |= {Status.SUCCESS: 1, Status.FAILED: 1}
+    assert db.get_scrape_counts(id_) == {"counts": counts, "total_count": 2}
+    assert db.get_scrape_event_settings(id_).base_url == "http://random/"
+    db.close()
 
 
 @pytest.mark.asyncio
-async def test_fetch_page(client: AsyncClient):
+async def test_page_links(client: AsyncClient):
     """
-    Test fetching page
+    Test fetching a page's links
     """
     db = get_db()
     id_ = uuid4()
-    working_url = HttpUrl(str(client.base_url))
+    working_url = normalize_url(str(client.base_url))
+    assert working_url is not None
     settings = db.add_scrape_event(id_, working_url, 1000)
+    parser = LinkParser(ParseMode.INLINE)
+
+    async def page_links(url: str) -> list[str]:
+        return [link async for link in _page_links(url, client, settings, db, parser)]
 
-    resp = await _fetch_page(working_url, client, settings, db)
-    assert resp != ""
+    assert await page_links(working_url)
     status = db.get_url_status(settings.id_, working_url)
     assert status == Status.SUCCESS
-    broken_url = HttpUrl(f"{working_url}/fake")
-    resp = await _fetch_page(broken_url, client, settings, db)
-    assert resp == ""
+    broken_url = f"{working_url}fake"
+    assert await page_links(broken_url) == []
     status = db.get_url_status(settings.id_, broken_url)
     assert status == Status.FAILED
 
@@ -142,7 +306,8 @@ async def test_validate_next_steps(client: AsyncClient):
     """
     db = get_db()
     id_ = uuid4()
-    working_url = str(client.base_url)
+    working_url = normalize_url(str(client.base_url))
+    assert working_url is not None
     settings = db.add_scrape_event(id_, working_url, 2)
     assert validate_next_steps(settings, working_url, 0) == Status.PENDING
     db.set_url_status(settings.id_, working_url, Status.FAILED)
@@ -150,29 +315,89 @@ async def test_validate_next_steps(client: AsyncClient):
     assert validate_next_steps(settings, working_url, 0) == Status.FAILED
 
     # test different host
-    different_host_url = HttpUrl("https://google.com")
-    assert (
-        validate_next_steps(settings, different_host_url.encoded_string(), 0)
-        == Status.IGNORED
-    )
+    different_host_url = "https://google.com/"
+    assert validate_next_steps(settings, different_host_url, 0) == Status.IGNORED
     # test max depth reached
     assert validate_next_steps(settings, working_url, 3) == Status.IGNORED
     # test url is invalid
     assert validate_next_steps(settings, "ftp://google.com", 3) == Status.IGNORED
 
 
+def test_scope():
+    """
+    Test scope rules
+    """
+    scope = Scope("example.com", skip_extensions={"pdf"})
+    assert scope.check("https://example.com/a?b=c") is None
+    assert scope.check("https://docs.example.com/") == Status.IGNORED
+    assert scope.check("https://example.com/a.pdf") == Status.SKIPPED
+
+    scope = Scope(
+        "example.com",
+        subdomains=True,
+        allow_hosts={"other.org"},
+        allow_paths=["/blog/", "/docs/"],
+        deny_paths=["/blog/drafts/"],
+        deny_patterns=[r"[?&]page=\d+", r"/print$"],
+    )
+    assert scope.check("https://docs.example.com/docs/") is None
+    assert scope.check("https://other.org/blog/a") is None
+    assert scope.check("https://notexample.com/blog/") == Status.IGNORED
+    assert scope.check("https://example.com/") == Status.IGNORED
+    assert scope.check("https://example.com/blog/drafts/a") == Status.IGNORED
+    assert scope.check("https://example.com/blog/a?page=2") == Status.IGNORED
+    assert scope.check("https://example.com/blog/a/print") == Status.IGNORED
+
+    scope = Scope("example.com", allow_patterns=[r"/\d{4}/"])
+    assert scope.check("https://example.com/2024/a") is None
+    assert scope.check("https://example.com/about") == Status.IGNORED
+
+
 @pytest.mark.asyncio
-async def test_extract_urls(client: AsyncClient):
+async def test_queue_links():
     """
-    Test fetching page
+    Test validating a page's links in one batch
     """
     db = get_db()
-    id_ = uuid4()
-    working_url = HttpUrl(str(client.base_url))
-    settings = db.add_scrape_event(id_, working_url, 1000)
+    settings = db.add_scrape_event(uuid4(), "https://example.com/", 2)
+    db.set_url_status(settings.id_, "https://example.com/done", Status.SUCCESS)
+    queue = Frontier()
+    links = [
+        "https://example.com/a",
+        "https://example.com/done",
+        "https://example.com/a",
+        "https://elsewhere.com/",
+        "https://example.com/b.zip",
+    ]
+    assert queue_links(settings, queue, links, 0) == {
+        "https://example.com/a": Status.PENDING,
+        "https://elsewhere.com/": Status.IGNORED,
+        "https://example.com/b.zip": Status.SKIPPED,
+    }
+    assert list(queue.items()) == [("https://example.com/a", 1)]
+    # known links are left alone, even past the max depth
+    assert not queue_links(settings, queue, links, 3)
+    assert db.get_url_status(settings.id_, "https://example.com/done") == Status.SUCCESS
+    # a link ignored for being too deep is queued once found closer to the base url
+    assert queue_links(settings, queue, ["https://example.com/c"], 3) == {
+        "https://example.com/c": Status.IGNORED
+    }
+    assert queue_links(settings, queue, ["https://example.com/c"], 1) == {
+        "https://example.com/c": Status.PENDING
+    }
+    assert queue.qsize() == 2
+    assert db.get_scrape_counts(settings.id_)["counts"][Status.IGNORED] == 1
+
 
-    resp = await _fetch_page(working_url, client, settings, db)
-    assert [link.encoded_string() for link in _extract_links(resp, working_url)] == [
+@pytest.mark.asyncio
+async def test_extract_urls(client: AsyncClient):
+    """
+    Test fetching page
+    """
+    working_url = normalize_url(str(client.base_url))
+    assert working_url is not None
+    resp = await client.get(working_url)
+    assert list(_extract_links(resp.content, working_url)) == [
         "https://twitter.com/example",
         "https://facebook.com/example",
         "https://linkedin.com/company/example",
@@ -197,6 +422,203 @@ async def test_retry_transport(client: AsyncClient):
     resp = await client.get("/rate")  ## this endpoint only returns 200 after 3 attempts
     assert resp.status_code == 500
     assert resp.json() == {"detail": "failed"}
+    assert get_metrics().counter("retries") == 2
+    assert get_metrics().stage(Stage.BACKOFF).count == 2
+
+
+@pytest.mark.asyncio
+async def test_http2():
+    """
+    Test a crawl multiplexed over a single HTTP/2 connection through the
+    retrying, rate limited transport
+    """
+    pytest.importorskip("h2")
+    from .mocks.server import StandInServer
+
+    async with StandInServer(app) as server:
+        # prior knowledge, as the stand in doesn't do TLS
+        client = AsyncClient(transport=get_transport(http1=False, http2=True))
+        id_ = await begin(f"{server.url}/", 10, client)
+    results = get_results(id_)
+    assert f"{server.url}/about" in results["status"][Status.SUCCESS]
+    assert f"{server.url}/payments" in results["status"][Status.SUCCESS]
+    assert server.requests > 5
+    assert server.connections == server.http2_connections == 1
+
+
+def test_link_graph(tmp_path: pathlib.Path):
+    """
+    Test recording, compacting and analysing the link graph
+    """
+    np = pytest.importorskip("numpy")
+    graph = LinkGraph("a")
+    graph.add_page("b", ["c", "a"])
+    graph.add_page("a", ["b", "c", "b", "a", "x"])
+    graph.add_page("c", ["a"])
+    graph.add_page("o", ["a"])  # e.g. only in a sitemap
+    graph.add_page("b", ["o"])  # already recorded
+    assert (graph.nodes, graph.edges) == (5, 8)
+    csr = graph.compact()
+    assert csr.urls == ["a", "b", "c", "x", "o"]  # in the order first seen
+    ids = {url: id_ for id_, url in enumerate(csr.urls)}
+    assert [csr.urls[i] for i in csr.indices[csr.indptr[0] : csr.indptr[1]]] == [
+        "b",
+        "c",
+        "a",
+        "x",
+    ]
+    assert csr.out_degree().tolist() == [
+        {"a": 4, "b": 2, "c": 1, "x": 0, "o": 1}[url] for url in csr.urls
+    ]
+    in_degree = csr.in_degree(self_links=False)
+    assert in_degree[ids["a"]] == 3 and in_degree[ids["x"]] == 1
+    assert csr.orphans() == ["o"]
+
+    rank = csr.pagerank()
+    assert rank.sum() == pytest.approx(1)
+    assert rank.argmax() == ids["a"]
+    assert rank[ids["o"]] == pytest.approx(rank.min())
+
+    path = str(tmp_path / "links.graph")
+    csr.save(path)
+    loaded = CsrGraph.load(path)
+    assert loaded.urls == csr.urls
+    assert np.array_equal(loaded.indptr, csr.indptr)
+    assert np.array_equal(loaded.indices, csr.indices)
+    assert np.array_equal(loaded.crawled, csr.crawled)
+    assert loaded.summary(2) == csr.summary(2)
+    assert csr.summary(2)["pagerank"][0][0] == "a"
+
+
+@pytest.mark.asyncio
+async def test_link_graph_crawl(tmp_path: pathlib.Path):
+    """
+    Test recording the link graph of a crawl, with a page only in the sitemap
+    """
+    pytest.importorskip("numpy")
+    settings = get_core_settings()
+    settings.link_graph_path = str(tmp_path / "links.graph")
+    try:
+        client = AsyncClient(transport=ASGITransport(app=app))
+        id_ = await begin(f"http://{ROBOTS_HOST}/", 1, client)
+    finally:
+        settings.link_graph_path = None
+    graph = get_results(id_)["link_graph"]
+    assert graph["path"] == str(tmp_path / "links.graph")
+    assert graph["orphans"] == [f"http://{ROBOTS_HOST}/nodes/7?size=10&fanout=0"]
+    ranks = [rank for _, rank in graph["pagerank"]]
+    assert ranks == sorted(ranks, reverse=True)
+    assert f"http://{ROBOTS_HOST}/" in [url for url, _ in graph["most_linked"]]
+    csr = CsrGraph.load(graph["path"])
+    assert (csr.nodes, csr.edges) == (graph["nodes"], graph["edges"])
+    assert csr.crawled.sum() == graph["crawled"]
+
+
+def test_seen_set():
+    """
+    Test the seen-set never forgets a url and keeps to its false positive rate
+    as it grows
+    """
+    seen = ScalableBloomFilter(0.01, initial_capacity=1000)
+    urls = [f"https://example.com/{i}" for i in range(20000)]
+    # false positives are binomial, allow 4 standard deviations over the rate
+    margin = 4 * math.sqrt(0.01 / len(urls))
+    assert sum(seen.add(url) for url in urls) / len(urls) < 0.01 + margin
+    assert all(url in seen for url in urls)
+    assert all(seen.add(url) for url in urls[:100])
+    stats = seen.stats()
+    assert stats["filters"] == 5  # 1000, 2000, 4000, 8000 and 16000 urls
+    assert stats["estimated_error_rate"] < 0.01
+    new = [f"https://example.com/new/{i}" for i in range(20000)]
+    expected = stats["estimated_error_rate"] + margin
+    assert sum(url in seen for url in new) / len(new) < expected
+
+
+@pytest.fixture
+def seen_set():
+    """keep status records for queued and visited pages only"""
+    settings = get_core_settings()
+    settings.seen_set = True
+    get_db.cache_clear()
+    yield
+    settings.seen_set = False
+
+
+@pytest.mark.asyncio
+async def test_scrape_seen_set(seen_set):
+    """
+    Test a crawl keeping status records for queued and visited pages only
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    id_ = await begin("http://test/", 10, client)
+    results = get_results(id_)
+    assert results["total_count"] == 11
+    assert results["counts"][Status.SUCCESS] == 5
+    assert results["counts"][Status.FAILED] == 1
+    assert results["counts"][Status.IGNORED] == 5
+    assert results["counts"][Status.PENDING] == 0
+    assert results["status"][Status.IGNORED] == []  # counted, not recorded
+    assert len(results["status"][Status.SUCCESS]) == 5
+    assert results["seen_set"]["urls"] == 11
+    assert results["seen_set"]["unrecorded_urls"] == 5
+    assert results["seen_set"]["estimated_error_rate"] < 0.001
+    db = get_db()
+    assert db.get_url_status(id_, "https://twitter.com/example") == Status.IGNORED
+    assert db.get_url_status(id_, "http://test/about") == Status.SUCCESS
+    assert db.get_url_status(id_, "http://test/never") == Status.MISSING
+
+
+def test_seen_set_ignored_links(seen_set):
+    """
+    Test links ignored as too deep are still queued when found closer to the
+    base url, and counted under their current status only
+    """
+    id_ = uuid4()
+    settings = get_db().add_scrape_event(id_, "http://test/", 1)
+    queue = Frontier()
+    assert queue_links(
+        settings, queue, ["http://test/deep", "http://test/a.pdf"], 2
+    ) == {
+        "http://test/deep": Status.IGNORED,
+        "http://test/a.pdf": Status.IGNORED,
+    }
+    assert queue.qsize() == 0
+    recorded = queue_links(
+        settings, queue, ["http://test/deep", "http://test/a.pdf"], 0
+    )
+    assert recorded == {
+        "http://test/deep": Status.PENDING,
+        "http://test/a.pdf": Status.SKIPPED,
+    }
+    assert queue.get_nowait() == ("http://test/deep", 1)
+    # found again, neither is queued or counted twice
+    assert (
+        queue_links(settings, queue, ["http://test/deep", "http://test/a.pdf"], 0) == {}
+    )
+    counts = get_db().get_scrape_counts(id_)["counts"]
+    assert counts[Status.PENDING] == 1
+    assert counts[Status.SKIPPED] == 1
+    assert counts[Status.IGNORED] == 0
+    assert get_db().get_url_status(id_, "http://test/a.pdf") == Status.SKIPPED
+
+
+def test_seen_set_counts(seen_set):
+    """
+    A url leaving a status it has a record for is only taken off the db's
+    count, never the seen-set's as well
+    """
+    db = get_db()
+    assert isinstance(db, SeenSetDb)
+    id_ = db.add_scrape_event(uuid4(), "http://test/", 10).id_
+    db.set_url_status(id_, "http://test/a", Status.IGNORED)
+    db.set_url_status(id_, "http://test/b", Status.IGNORED)
+    for status in (Status.PENDING, Status.IGNORED, Status.PENDING):
+        db.set_url_status(id_, "http://test/a", status)
+    counts = db.get_scrape_counts(id_)
+    assert counts["counts"][Status.IGNORED] == 1
+    assert counts["counts"][Status.PENDING] == 1
+    assert counts["total_count"] == 2
+    assert db.get_seen_set_stats(id_)["unrecorded_urls"] == 1
 
 
 @pytest.mark.asyncio
@@ -205,7 +627,7 @@ async def test_scrape():
     Integration test running on the mock app
     """
     client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
-    base_url = HttpUrl(str(client.base_url))
+    base_url = str(client.base_url)
     id_ = await begin(base_url, 10, client)
     results = get_results(id_)
     counts = results["counts"]
@@ -229,3 +651,954 @@ async def test_scrape():
         "http://abc.test/about?a=b",
         "http://abc.test/about?b=c",
     ]
+
+
+def test_sharded_scrape():
+    """
+    A crawl sharded across processes finds the same urls with the same statuses
+    """
+    id_ = begin_sharded("http://test/", 10, 2, client_factory=site.client)
+    results = get_results(id_)
+    assert results["total_count"] == 11
+    assert results["counts"][Status.SUCCESS] == 5
+    assert results["counts"][Status.FAILED] == 1
+    assert results["counts"][Status.IGNORED] == 5
+    assert sorted(results["status"][Status.SUCCESS]) == [
+        "http://test/",
+        "http://test/about",
+        "http://test/blog",
+        "http://test/contact",
+        "http://test/payments",
+    ]
+    assert {shard_of(url, 2) for url in results["status"][Status.SUCCESS]} == {0, 1}
+
+
+def test_histogram():
+    """
+    Observations land in the first bucket they fit, quantiles are bucket bounds
+    """
+    histogram = Histogram()
+    for value in (0.0001, 0.003, 0.003, 0.2, 100):
+        histogram.observe(value)
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(100.2061)
+    assert histogram.counts[0] == 1
+    assert histogram.counts[BUCKETS.index(0.005)] == 2
+    assert histogram.counts[-1] == 1
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.8) == 0.25
+    assert histogram.quantile(1) == float("inf")
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+    """
+    A crawl records every stage per host and event, served in Prometheus format
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    id_ = await begin(str(client.base_url), 10, client)
+    metrics = get_metrics()
+    for stage in (Stage.QUEUE_WAIT, Stage.FETCH, Stage.PARSE, Stage.VALIDATE):
+        assert metrics.stage(stage).count >= 5
+    assert metrics.stage(Stage.PAGE).count == metrics.counter("pages") == 6
+    assert "pages=6" in metrics.summary()
+
+    server = await serve_metrics(metrics, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        async with AsyncClient() as scraper_client:
+            response = await scraper_client.get(f"http://127.0.0.1:{port}/metrics")
+            missing = await scraper_client.get(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.close()
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert missing.status_code == 404
+    labels = f'host="test",event="{id_}"'
+    assert f'webscraper_pages_total{{{labels},status="success"}} 5' in response.text
+    assert (
+        f'webscraper_stage_seconds_count{{{labels},stage="fetch"}} 6' in response.text
+    )
+    assert (
+        f'webscraper_stage_seconds_bucket{{{labels},stage="fetch",le="+Inf"}} 6'
+        in response.text
+    )
+
+
+@pytest.mark.asyncio
+async def test_crawl_service():
+    """
+    The service crawls jobs concurrently over one shared client, capping each
+    job's workers and the pages worked on at once across every job
+    """
+    in_flight, peak = 0, 0
+
+    async def counting_app(scope, receive, send):
+        nonlocal in_flight, peak
+        counted = scope["path"].startswith("/nodes")
+        in_flight += counted
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.002)
+            await app(scope, receive, send)
+        finally:
+            in_flight -= counted
+
+    get_core_settings().service_progress_interval = 0.01
+    client = AsyncClient(transport=ASGITransport(app=counting_app))
+    service = CrawlService(client, max_workers=2, max_job_workers=3)
+    server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+    api_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    try:
+        async with AsyncClient(base_url=api_url) as api:
+            first, second = [
+                (await api.post("/jobs", json=job)).json()
+                for job in (
+                    {"url": "http://test/nodes/0?size=30&fanout=5"},
+                    {
+                        "url": "http://other.test/nodes/0?size=30&fanout=5",
+                        "workers": 50,
+                    },
+                )
+            ]
+            assert second["workers"] == 3
+            async with api.stream("GET", f"/jobs/{first['id']}/progress") as response:
+                progress = [json.loads(line) async for line in response.aiter_lines()]
+            assert progress[0]["state"] == JobState.RUNNING
+            assert progress[-1]["state"] == JobState.DONE
+            assert progress[-1]["counts"][Status.SUCCESS] == 30
+            await asyncio.wait([job.task for job in service.jobs.values()])
+            results = (await api.get(f"/jobs/{second['id']}/results")).json()
+            assert results["counts"][Status.SUCCESS] == 30
+            assert len(results["status"][Status.SUCCESS]) == 30
+            assert len((await api.get("/jobs")).json()) == 2
+            assert (await api.get(f"/jobs/{uuid4()}")).status_code == 404
+            assert (await api.get("/jobs/nope/results")).status_code == 404
+            assert (await api.post("/jobs", json={"url": "nope"})).status_code == 400
+            # valid for pydantic, too long for the normalizer once percent-encoded
+            too_long = {"url": "http://test/" + "é" * 1000}
+            response = await api.post("/jobs", json=too_long)
+            assert response.status_code == 400
+            assert "invalid base url" in response.json()["detail"]
+
+            huge = (await api.post("/jobs", json={"url": "http://test/nodes/0"})).json()
+            cancelled = (await api.delete(f"/jobs/{huge['id']}")).json()
+            assert cancelled["state"] == JobState.CANCELLED
+            metrics = await api.get("/metrics")
+            assert "webscraper_pages_total" in metrics.text
+    finally:
+        server.close()
+        await service.close()
+    assert peak <= 2
+
+
+@pytest.mark.asyncio
+async def test_crawl_service_forgets_jobs():
+    """
+    Past the retention limit the oldest finished job is forgotten, along with
+    its url statuses, metrics and robots.txt rules, and so is a deleted one
+    """
+    client = AsyncClient(transport=ASGITransport(app=app))
+    service = CrawlService(
+        client, max_workers=2, max_job_workers=2, max_finished_jobs=1
+    )
+    server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+    api_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    try:
+        async with AsyncClient(base_url=api_url) as api:
+            blog = f"http://{site.ROBOTS_HOST}/blog"
+            jobs = []
+            for url in (
+                f"http://{site.ROBOTS_HOST}/nodes/0?size=5&fanout=5",
+                "http://other.test/nodes/0?size=5&fanout=5",
+            ):
+                job = (await api.post("/jobs", json={"url": url})).json()
+                jobs.append(service.jobs[UUID(job["id"])])
+                await asyncio.wait((jobs[-1].task,))
+                if len(jobs) == 1:
+                    assert not get_robots_cache().allowed(blog)
+                    described = jobs[0].describe()
+            first, second = (job.settings.id_ for job in jobs)
+            assert list(service.jobs) == [second]
+            # a progress stream of a forgotten job can still describe it
+            assert jobs[0].describe() == described
+            assert (await api.get(f"/jobs/{first}")).status_code == 404
+            with pytest.raises(KeyError):
+                get_db().get_scrape_event_settings(first)
+            assert f'event="{first}"' not in get_metrics().render()
+            assert f'event="{second}"' in get_metrics().render()
+            assert get_robots_cache().allowed(blog)  # unknown again
+
+            deleted = (await api.delete(f"/jobs/{second}")).json()
+            assert deleted["counts"][Status.SUCCESS] == 5
+            assert service.jobs == {}
+            assert (await api.get(f"/jobs/{second}")).status_code == 404
+            with pytest.raises(KeyError):
+                get_db().get_scrape_event_settings(second)
+    finally:
+        server.close()
+        await service.close()
+
+
+@pytest.mark.asyncio
+async def test_worker_pool():
+    """
+    The pool grows while pages wait on a slow site with urls queued,
+    and retires idle workers once nothing is queued
+    """
+    in_flight, peak = 0, 0
+
+    async def slow_app(scope, receive, send):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.02)
+            await app(scope, receive, send)
+        finally:
+            in_flight -= 1
+
+    settings = get_core_settings()
+    settings.autoscale_interval = 0.05
+    settings.num_workers = 2
+    try:
+        client = AsyncClient(transport=ASGITransport(app=slow_app))
+        id_ = await begin("http://test/nodes/0?size=300&fanout=5", 10, client)
+    finally:
+        settings.autoscale_interval = 0.5
+        settings.num_workers = 10
+    assert get_results(id_)["counts"][Status.SUCCESS] == 300
+    assert peak > 4
+
+    async def idle_worker(stop: asyncio.Event, idle: asyncio.Event):
+        while not stop.is_set():
+            idle.set()
+            await queue.get()
+
+    queue = Frontier()
+    pool = WorkerPool(idle_worker, queue, Histogram(), Histogram(), 1, 10, 0.02)
+    running = asyncio.create_task(pool.run(8))
+    await asyncio.sleep(0.3)
+    assert pool.size == 1
+    running.cancel()
+    await asyncio.gather(running, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_profiled(tmp_path: pathlib.Path):
+    """
+    Profiling a crawl writes collapsed stacks and a cpu / memory / loop lag report
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    id_ = await profiled(begin(str(client.base_url), 10, client), str(tmp_path))
+    assert get_results(id_)["counts"][Status.SUCCESS] == 5
+    stacks = (tmp_path / "cpu.collapsed").read_text().splitlines()
+    assert stacks
+    for line in stacks:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.split(";")[0] and int(count) > 0
+    report = (tmp_path / "report.txt").read_text()
+    assert "memory allocated at the end by module" in report
+    assert " MiB " in report
+    assert "p99" in report
+
+
+@pytest.mark.asyncio
+async def test_pages_fetched_once():
+    """
+    Links found again while their page is still queued aren't queued twice
+    """
+    transport = RecordingTransport()
+    client = AsyncClient(transport=transport, base_url="http://test")
+    id_ = await begin("http://test/nodes/0?size=200&fanout=5", 100, client)
+    assert get_results(id_)["counts"][Status.SUCCESS] == 200
+    pages = [path for path in transport.paths if path.startswith("/nodes")]
+    assert len(pages) == len(set(pages)) == 200
+
+
+@pytest.mark.asyncio
+async def test_frontier_spills_in_order(tmp_path: pathlib.Path):
+    """
+    Overflow goes to disk and comes back in FIFO order, with join semantics kept
+    """
+    frontier = Frontier(max_in_memory=3, segment_size=2, spill_dir=str(tmp_path))
+    items = [(f"http://test/{i}", i) for i in range(10)]
+    for item in items[:7]:
+        frontier.put_nowait(item)
+    assert frontier.spilled == 2  # 3 in memory, 2 segments of 2
+    assert list(frontier.items()) == items[:7]
+
+    got = [await frontier.get() for _ in range(4)]
+    for item in items[7:]:
+        frontier.put_nowait(item)
+    while not frontier.empty():
+        got.append(await frontier.get())
+    assert got == items
+
+    join = asyncio.create_task(frontier.join())
+    for _ in items[:-1]:
+        frontier.task_done()
+    await asyncio.sleep(0)
+    assert not join.done()
+    frontier.task_done()
+    await asyncio.wait_for(join, 1)
+    frontier.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_scrape_spilled_frontier():
+    """
+    Crawling with a frontier that spills almost everything gives the same results
+    """
+    get_core_settings().frontier_max_in_memory = 1
+    get_core_settings().frontier_segment_size = 1
+    try:
+        client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+        id_ = await begin(str(client.base_url), 10, client)
+    finally:
+        get_core_settings().frontier_max_in_memory = 100000
+        get_core_settings().frontier_segment_size = 10000
+    results = get_results(id_)
+    assert results["total_count"] == 11
+    assert results["counts"][Status.SUCCESS] == 5
+
+
+@pytest.mark.asyncio
+async def test_write_results():
+    """
+    Streamed results are the same as the in memory results
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    id_ = await begin(str(client.base_url), 10, client)
+    buffer = io.StringIO()
+    write_results(id_, buffer)
+    assert json.loads(buffer.getvalue()) == json.loads(json.dumps(get_results(id_)))
+
+
+def assert_ndjson_parity(id_: UUID, path: pathlib.Path):
+    """the results rebuilt from the stream are the json results"""
+    expected = json.loads(json.dumps(get_results(id_)))
+    rebuilt = json.loads(json.dumps(read_ndjson_results(path.read_text().splitlines())))
+    # urls are in the order pages finished rather than the order they were found
+    for status, urls in rebuilt.pop("status").items():
+        assert sorted(urls) == sorted(expected["status"].pop(status))
+    assert expected.pop("status") == {}
+    assert rebuilt == expected
+
+
+@pytest.mark.asyncio
+async def test_ndjson_results(tmp_path: pathlib.Path):
+    """
+    Results streamed page by page can be rebuilt into the json results
+    """
+    path = tmp_path / "results.ndjson"
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    id_ = await begin(str(client.base_url), 10, client, results_path=str(path))
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert records[0]["type"] == "event" and records[0]["id"] == str(id_)
+    assert records[-1]["type"] == "summary"
+    pages = {record["url"]: record for record in records if record["type"] == "page"}
+    assert len(pages) == 6  # five scraped and /search which failed
+    assert pages["http://test/"]["depth"] == 0
+    assert "http://test/about" in pages["http://test/"]["links"]
+    assert pages["http://test/search"]["status"] == Status.FAILED
+
+    assert_ndjson_parity(id_, path)
+
+
+@pytest.mark.asyncio
+async def test_scrape_does_not_idle():
+    """
+    Workers should pick up new urls immediately rather than polling the queue
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    start = time.perf_counter()
+    await begin(str(client.base_url), 10, client)
+    assert time.perf_counter() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_scrape_shutdown():
+    """
+    SIGTERM should stop the crawl straight away, leaving in flight pages in progress
+    """
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    base_url = "http://test/slow"
+    task = asyncio.create_task(begin(base_url, 10, client))
+    await asyncio.sleep(0.1)  # let the worker pick up the slow page
+    os.kill(os.getpid(), signal.SIGTERM)
+    id_ = await asyncio.wait_for(task, 1)
+    assert get_db().get_url_status(id_, base_url) == Status.IN_PROGRESS
+
+
+@pytest.mark.asyncio
+async def test_host_limiter():
+    """
+    Test the AIMD window shrinks on 429's and grows back on healthy responses
+    """
+    settings = get_http_client_settings()
+    limiter = HostLimiter("test", settings)
+    request = httpx.Request("GET", "http://test")
+    sent = await limiter.acquire()
+    assert limiter.in_flight == 1
+    limiter.release(
+        httpx.Response(429, headers={"Retry-After": "0.2"}, request=request), sent
+    )
+    assert limiter.in_flight == 0
+    assert (
+        limiter.window == settings.host_initial_window * settings.host_decrease_factor
+    )
+    assert limiter.rate == settings.host_initial_rate * settings.host_decrease_factor
+    assert limiter.throttled == 1
+
+    start = time.perf_counter()
+    sent = await limiter.acquire()  # blocked until Retry-After has passed
+    assert time.perf_counter() - start >= 0.15
+    window = limiter.window
+    limiter.release(httpx.Response(200, request=request), sent)
+    assert limiter.window > window
+
+    assert parse_retry_after("3", 300) == 3
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", 300) == 0
+    assert parse_retry_after("garbage", 300) is None
+
+
+def test_parse_retry_after_bounds():
+    """
+    Non finite delays are ignored, huge ones and far off dates are capped
+    """
+    for value in ("inf", "-inf", "nan", "Infinity"):
+        assert parse_retry_after(value, 300) is None
+    assert parse_retry_after("1e308", 300) == 300
+    assert parse_retry_after("-5", 300) == 0
+    assert parse_retry_after("Fri, 31 Dec 9999 23:59:59 GMT", 300) == 300
+
+
+@pytest.mark.asyncio
+async def test_host_limiter_burst():
+    """
+    A burst of 429's for requests in flight together cuts the window once,
+    and a 429 for a request sent after the cut cuts it again
+    """
+    settings = get_http_client_settings()
+    limiter = HostLimiter("test", settings)
+    limiter.rate = 1000
+    throttled = httpx.Response(429, request=httpx.Request("GET", "http://test"))
+    burst = [await limiter.acquire() for _ in range(4)]
+    for sent in burst:
+        limiter.release(throttled, sent)
+    window = settings.host_initial_window * settings.host_decrease_factor
+    assert limiter.window == window
+    assert limiter.throttled == 4
+    limiter.release(throttled, await limiter.acquire())
+    assert limiter.window == window * settings.host_decrease_factor
+
+
+@pytest.mark.asyncio
+async def test_host_limiter_window():
+    """
+    Requests beyond the window wait for a slot to be released
+    """
+    settings = get_http_client_settings()
+    limiter = HostLimiter("test", settings)
+    limiter.window = 1
+    limiter.rate = 1000
+    sent = await limiter.acquire()
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    response = httpx.Response(200, request=httpx.Request("GET", "http://test"))
+    limiter.release(response, sent)
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_transport_rate_controller():
+    """
+    429's seen through the retry transport shrink the shared host window
+    """
+    controller = RateController(get_http_client_settings())
+    client = AsyncClient(
+        transport=RetryTransport(ASGITransport(app=app), 1, 0, 0, controller),
+        base_url="http://test",
+    )
+    resp = await client.get("/rate")
+    assert resp.status_code == 429
+    snapshot = controller.snapshot("test")["test"]
+    assert snapshot["throttled"] == 2
+    assert snapshot["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", list(ParseMode))
+async def test_link_parser(client: AsyncClient, mode: ParseMode):
+    """
+    Test every parse mode returns the same hrefs
+    """
+    resp = await client.get("/")
+    parser = LinkParser(mode, max_workers=1)
+    try:
+        hrefs, base_href = await parser.extract_hrefs(resp.content)
+    finally:
+        parser.close()
+    assert parser.mode == mode
+    assert hrefs[:4] == [
+        "https://twitter.com/example",
+        "https://facebook.com/example",
+        "https://linkedin.com/company/example",
+        "http://abc.test/about?a=b",
+    ]
+    assert len(hrefs) == 12  # includes mailto and tel links, filtered out later
+    assert base_href is None
+
+
+@pytest.mark.parametrize(
+    "template", ["homepage.html", "nextpage.html", "finalpage.html"]
+)
+def test_streaming_extractor_parity(template: str):
+    """
+    The streaming extractor should find the same hrefs as BeautifulSoup,
+    however the page is split into chunks
+    """
+    with open(pathlib.Path(__file__).parent / "mocks/templates" / template, "rb") as f:
+        content = f.read()
+    expected = extract_hrefs(content)
+    assert stream_hrefs(content) == expected
+    for chunk_size in (1, 7, 64):
+        extractor = StreamingLinkExtractor()
+        hrefs = []
+        for i in range(0, len(content), chunk_size):
+            hrefs.extend(extractor.feed(content[i : i + chunk_size]))
+        assert (hrefs, extractor.base_href) == expected
+
+
+def test_streaming_extractor_edge_cases():
+    """
+    Test comments, scripts, quoting, entities and base href
+    """
+    content = (
+        b'<base href="/docs/"><base href="/ignored/">'
+        b"<!-- <a href=/comment> --><script>'<a href=/script>'</script>"
+        b'<img alt="<a href=/alt>"><A HREF="a?x=1&amp;y=2" href=b>'
+        b"<a\nclass='x' href = 'c'><a href>"
+    )
+    assert stream_hrefs(content) == extract_hrefs(content) == (["b", "c", ""], "/docs/")
+    extractor = StreamingLinkExtractor()
+    extractor.feed(b"<p>" + b"x" * 100000)
+    assert extractor._buffer == b""  # text between tags is never kept
+
+
+@pytest.mark.asyncio
+async def test_scrape_soup_extractor():
+    """
+    Crawling with the BeautifulSoup extractor gives the same results
+    """
+    get_core_settings().link_extractor = LinkExtractor.SOUP
+    try:
+        client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+        id_ = await begin(str(client.base_url), 10, client)
+    finally:
+        get_core_settings().link_extractor = LinkExtractor.STREAM
+    results = get_results(id_)
+    assert results["total_count"] == 11
+    assert results["counts"][Status.SUCCESS] == 5
+
+
+def test_url_normalizer():
+    """
+    Test url canonicalization
+    """
+    normalizer = UrlNormalizer()
+    assert normalizer.normalize("HTTP://Test:80/a b#frag") == "http://test/a%20b"
+    assert normalizer.normalize("https://test:443") == "https://test/"
+    assert (
+        normalizer.normalize("https://test:8443/?b=2&a=1")
+        == "https://test:8443/?b=2&a=1"
+    )
+    assert normalizer.normalize("http://bücher.de/") == "http://xn--bcher-kva.de/"
+    assert normalizer.normalize("ftp://test/") is None
+    assert normalizer.normalize("http:///path") is None
+    assert normalizer.normalize("http://test:99999/") is None
+    assert normalizer.resolve("../c?x=1", "http://test/a/b/") == "http://test/a/c?x=1"
+    assert normalizer.resolve("mailto:hello@example.com", "http://test/") is None
+    # repeated links share the cached key
+    assert normalizer.normalize("http://test/x") is normalizer.resolve(
+        "/x", "http://test/"
+    )
+    assert normalizer.host("http://user@test:8080/") == "test"
+
+    normalizer = UrlNormalizer(
+        sort_query_params=True, strip_query_params={"utm_source"}
+    )
+    assert (
+        normalizer.normalize("http://test/?b=2&utm_source=x&a=1")
+        == "http://test/?a=1&b=2"
+    )
+
+
+class RecordingTransport(ASGITransport):
+    """
+    Records every path requested from the mock app
+    """
+
+    def __init__(self):
+        super().__init__(app=app)
+        self.paths: list[str] = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.paths.append(request.url.path)
+        return await super().handle_async_request(request)
+
+
+class BrokenTransport(ASGITransport):
+    """
+    Fails every request for `path` with an error that isn't an http error
+    """
+
+    def __init__(self, path: str):
+        super().__init__(app=app)
+        self.path = path
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == self.path:
+            raise RuntimeError("unexpected")
+        return await super().handle_async_request(request)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extractor", list(LinkExtractor))
+async def test_bogus_charset(extractor: LinkExtractor):
+    """
+    A page declaring an unknown charset is decoded as utf-8, and a page failing
+    unexpectedly is marked FAILED without stopping the only worker
+    """
+    assert StreamingLinkExtractor("bogus").encoding == "utf-8"
+    assert StreamingLinkExtractor("Latin-1").encoding == "iso8859-1"
+    settings = get_core_settings()
+    settings.link_extractor, settings.autoscale_workers = extractor, False
+    settings.num_workers = 1
+    try:
+        client = AsyncClient(transport=BrokenTransport("/blog"), base_url="http://test")
+        id_ = await asyncio.wait_for(begin("http://test/bogus-charset", 2, client), 5)
+        client = AsyncClient(
+            transport=BrokenTransport("/about"), base_url="http://test"
+        )
+        broken_id = await asyncio.wait_for(begin("http://test/", 1, client), 5)
+    finally:
+        settings.link_extractor, settings.autoscale_workers = (
+            LinkExtractor.STREAM,
+            True,
+        )
+        settings.num_workers = 10
+    db = get_db()
+    assert db.get_url_status(id_, "http://test/bogus-charset") == Status.SUCCESS
+    assert db.get_url_status(id_, "http://test/about") == Status.SUCCESS
+    assert db.get_url_status(broken_id, "http://test/about") == Status.FAILED
+    assert db.get_url_status(broken_id, "http://test/blog") == Status.SUCCESS
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extractor", list(LinkExtractor))
+async def test_skip_unreadable_pages(extractor: LinkExtractor):
+    """
+    Binary file extensions are never requested, non html responses and ones
+    over the size cap aren't read, and chunked html is cut off at the cap
+    """
+    settings = get_core_settings()
+    settings.link_extractor = extractor
+    max_page_bytes, settings.max_page_bytes = settings.max_page_bytes, 4096
+    transport = RecordingTransport()
+    try:
+        client = AsyncClient(transport=transport, base_url="http://test")
+        id_ = await begin("http://test/assets", 1, client)
+    finally:
+        settings.link_extractor = LinkExtractor.STREAM
+        settings.max_page_bytes = max_page_bytes
+    results = get_results(id_)
+    assert sorted(results["status"][Status.SKIPPED]) == [
+        "http://test/download",
+        "http://test/files/photo.JPG",
+        "http://test/files/report.pdf",
+        "http://test/huge",
+    ]
+    assert results["counts"][Status.SKIPPED] == 4
+    assert not [path for path in transport.paths if path.startswith("/files")]
+    assert "http://test/early" in results["status"][Status.FAILED]  # a 404
+    assert "http://test/late" not in results["status"][Status.FAILED]
+    assert "http://test/huge-link" not in results["status"][Status.FAILED]
+
+
+def test_parse_robots():
+    """
+    Test robots.txt group selection and rule precedence
+    """
+    rules = parse_robots(site.ROBOTS_TXT, "webscraper/1.0")
+    assert rules.crawl_delay == 0.05
+    assert rules.sitemaps == ["http://robots.test/sitemap_index.xml"]
+    assert rules.allowed("http://robots.test/about")
+    assert not rules.allowed("http://robots.test/blog")
+    assert not rules.allowed("http://robots.test/blog/post?a=b")
+    assert rules.allowed("http://robots.test/blog/ok")  # the longer allow wins
+    assert not rules.allowed("http://robots.test/blog/ok/more")
+    assert not parse_robots(site.ROBOTS_TXT, "otherbot").allowed("http://robots.test/")
+
+    rules = parse_robots(
+        "user-agent: *\ndisallow: /*.pdf$\ndisallow: /private\nallow: /private\n",
+        "webscraper",
+    )
+    assert not rules.allowed("http://test/files/a.pdf")
+    assert rules.allowed("http://test/files/a.pdf?download=1")
+    assert rules.allowed("http://test/private")  # allow wins a tie
+    assert parse_robots("user-agent: *\ndisallow:\n", "webscraper").allowed(
+        "http://test/"
+    )
+
+
+@pytest.mark.asyncio
+async def test_robots_and_sitemaps():
+    """
+    Disallowed pages are never fetched, requests keep to the Crawl-delay,
+    and pages from the (gzipped) sitemaps are queued up front
+    """
+    transport = RecordingTransport()
+    client = AsyncClient(transport=transport, base_url=f"http://{site.ROBOTS_HOST}")
+    start = time.perf_counter()
+    id_ = await begin(f"http://{site.ROBOTS_HOST}/", 0, client)
+    elapsed = time.perf_counter() - start
+    results = get_results(id_)
+    assert "/blog" not in transport.paths
+    assert f"http://{site.ROBOTS_HOST}/blog" in results["status"][Status.IGNORED]
+    assert "http://elsewhere.test/page" in results["status"][Status.IGNORED]
+    # only reachable through the sitemap
+    assert (
+        f"http://{site.ROBOTS_HOST}/nodes/7?size=10&fanout=0"
+        in results["status"][Status.SUCCESS]
+    )
+    pages = len(results["status"][Status.SUCCESS]) + len(
+        results["status"][Status.FAILED]
+    )
+    assert elapsed >= 0.05 * (pages - 1)
+
+
+@pytest.mark.asyncio
+async def test_ndjson_results_of_sitemaps(tmp_path: pathlib.Path):
+    """
+    Statuses set while seeding from sitemaps are streamed too,
+    so the stream still rebuilds into the json results
+    """
+    path = tmp_path / "results.ndjson"
+    client = AsyncClient(
+        transport=ASGITransport(app=app), base_url=f"http://{site.ROBOTS_HOST}"
+    )
+    id_ = await begin(f"http://{site.ROBOTS_HOST}/", 0, client, results_path=str(path))
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    seeded = [record for record in records if record["type"] == "statuses"]
+    assert any("http://elsewhere.test/page" in record["statuses"] for record in seeded)
+    assert_ndjson_parity(id_, path)
+
+
+@pytest.mark.asyncio
+async def test_robots_of_other_origins():
+    """
+    Pages on other origins in scope are only fetched once their own
+    robots.txt has been, which happens once however many ask at the same time
+    """
+    transport = RecordingTransport()
+    client = AsyncClient(transport=transport, base_url="http://test")
+    db = get_db()
+    settings = db.add_scrape_event(uuid4(), "http://test/", 1)
+    parser = LinkParser(ParseMode.INLINE)
+
+    async def page_links(url: str) -> list[str]:
+        return [link async for link in _page_links(url, client, settings, db, parser)]
+
+    blog, about = f"http://{site.ROBOTS_HOST}/blog", f"http://{site.ROBOTS_HOST}/about"
+    assert get_robots_cache().allowed(blog)  # unknown until loaded
+    blog_links, about_links = await asyncio.gather(page_links(blog), page_links(about))
+    assert blog_links == [] and about_links
+    assert sorted(transport.paths) == ["/about", "/robots.txt"]
+    assert db.get_url_status(settings.id_, blog) == Status.IGNORED
+    assert db.get_url_status(settings.id_, about) == Status.SUCCESS
+    assert not get_robots_cache().allowed(blog)
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_on_shutdown(tmp_path: pathlib.Path):
+    """
+    A checkpoint is written on shutdown with the in flight page in it
+    """
+    path = str(tmp_path / "checkpoint.json.gz")
+    client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+    task = asyncio.create_task(begin("http://test/slow", 10, client, path))
+    await asyncio.sleep(0.1)
+    os.kill(os.getpid(), signal.SIGTERM)
+    id_ = await asyncio.wait_for(task, 1)
+    checkpoint = read_checkpoint(path)
+    assert checkpoint.settings.id_ == id_
+    assert checkpoint.frontier == []
+    assert checkpoint.in_progress == [("http://test/slow", 0)]
+    assert checkpoint.status == {Status.IN_PROGRESS: ["http://test/slow"]}
+
+
+def test_take_checkpoint(tmp_path: pathlib.Path):
+    """
+    The checkpoint is built from snapshots taken when it was requested,
+    so updates made while it is built in a thread don't leak into it,
+    even from spilled segments refilled and removed in the meantime
+    """
+    settings = get_db().add_scrape_event(uuid4(), "http://test", 10)
+    get_db().set_url_status(settings.id_, "http://test/", Status.SUCCESS)
+    get_db().set_url_status(settings.id_, "http://test/about", Status.IN_PROGRESS)
+    in_flight = {"http://test/about": 1}
+    frontier = Frontier(max_in_memory=2, segment_size=2, spill_dir=str(tmp_path))
+    items = [(f"http://test/{i}", 1) for i in range(7)]
+    frontier.put_many(items)
+    assert frontier.spilled == 2
+    build = take_checkpoint(settings, frontier, in_flight)
+    get_db().set_url_status(settings.id_, "http://test/about", Status.SUCCESS)
+    get_db().set_url_status(settings.id_, "http://test/blog", Status.PENDING)
+    in_flight.clear()
+    for _ in range(5):
+        frontier.get_nowait()
+    assert frontier.spilled == 0
+    checkpoint = build()
+    assert checkpoint.frontier == items
+    assert not list(tmp_path.glob("snapshot-*"))  # the links are removed
+    assert checkpoint.in_progress == [("http://test/about", 1)]
+    assert checkpoint.status == {
+        Status.SUCCESS: ["http://test/"],
+        Status.IN_PROGRESS: ["http://test/about"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_resume(tmp_path: pathlib.Path):
+    """
+    Resuming doesn't refetch scraped pages and requeues in progress ones
+    """
+    path = str(tmp_path / "checkpoint.json.gz")
+    settings = get_db().add_scrape_event(uuid4(), "http://test", 10)
+    get_db().close()
+    get_db.cache_clear()  # the resumed scrape starts from a fresh db
+    write_checkpoint(
+        path,
+        Checkpoint(
+            settings=settings,
+            frontier=[("http://test/about", 1)],
+            in_progress=[("http://test/blog", 1)],
+            status={
+                Status.SUCCESS: ["http://test/"],
+                Status.PENDING: ["http://test/about"],
+                Status.IN_PROGRESS: ["http://test/blog"],
+                Status.IGNORED: ["https://twitter.com/example"],
+            },
+        ),
+    )
+    transport = RecordingTransport()
+    client = AsyncClient(transport=transport, base_url="http://test")
+    id_ = await resume(path, client)
+    assert id_ == settings.id_
+    assert "/" not in transport.paths
+    # robots.txt is fetched again, but there is no sitemap seeding on resume
+    assert sorted(transport.paths) == ["/about", "/blog", "/payments", "/robots.txt"]
+    results = get_results(id_)
+    assert results["counts"][Status.SUCCESS] == 4
+    assert results["counts"][Status.PENDING] == 0
+    assert results["counts"][Status.IN_PROGRESS] == 0
+    assert read_checkpoint(path).frontier == []  # checkpoints carry on to the same file
+
+
+@pytest.mark.asyncio
+async def test_conditional_requests(tmp_path: pathlib.Path):
+    """
+    A recrawl sends the cached ETag and reuses the cached links on a 304
+    """
+    get_http_client_settings().cache_path = str(tmp_path / "cache.db")
+    try:
+        results = []
+        for _ in range(2):
+            transport = RecordingTransport()
+            client = AsyncClient(transport=transport, base_url="http://test")
+            id_ = await begin("http://test/cached", 0, client)
+            results.append(get_results(id_))
+    finally:
+        get_http_client_settings().cache_path = None
+
+    first, second = results
+    # "/" and "/payments" are linked from the page but send no validators
+    assert first["http_cache"] == {"hits": 0, "misses": 3, "not_modified": 0}
+    assert second["http_cache"] == {"hits": 1, "misses": 2, "not_modified": 1}
+    assert first["status"] == second["status"]
+    assert get_response_cache() is not None
+
+
+def test_response_cache_eviction(tmp_path: pathlib.Path):
+    """
+    The least recently used entries are evicted once over the size limit
+    """
+    id_ = uuid4()
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_bytes=1000, batch_size=1)
+    headers = httpx.Headers({"ETag": '"v1"'})
+    for i in range(20):
+        cache.store(f"http://test/{i}", headers, ["http://test/" + "x" * 80])
+        cache.lookup(id_, "http://test/0")  # keep the first page in use
+    cache.store("http://test/no-validators", httpx.Headers(), ["http://test/"])
+    cache.flush()
+
+    assert cache.lookup(id_, "http://test/0") is not None
+    assert cache.lookup(id_, "http://test/1") is None
+    entry = cache.lookup(id_, "http://test/19")
+    assert entry is not None
+    assert entry.headers() == {"If-None-Match": '"v1"'}
+    assert cache.lookup(id_, "http://test/no-validators") is None
+    assert cache._stored_size() <= 1000
+    cache.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("extractor", list(LinkExtractor))
+async def test_content_dedup(extractor: LinkExtractor):
+    """
+    Pages with the same content as one already scraped don't have their links followed
+    """
+    get_core_settings().dedup_content = True
+    get_core_settings().link_extractor = extractor
+    try:
+        client = AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
+        id_ = await begin(str(client.base_url), 10, client)
+    finally:
+        get_core_settings().dedup_content = False
+        get_core_settings().link_extractor = LinkExtractor.STREAM
+    results = get_results(id_)
+    # /about, /blog and /contact all render the same page, only one is kept
+    assert results["counts"][Status.DUPLICATE] == 2
+    assert results["counts"][Status.SUCCESS] == 3
+    assert results["total_count"] == 11
+
+
+def test_page_fingerprint():
+    """
+    Fingerprints don't depend on chunking, and near duplicates are found
+    """
+    words = " ".join(f"word{i}" for i in range(500))
+    page = f"<html><body><p>{words}</p><a href='/?sid=abc123'>x</a></body></html>"
+    near = page.replace("sid=abc123", "sid=def456").encode()
+
+    whole, chunked = PageFingerprint(), PageFingerprint()
+    whole.update(page.encode())
+    for i in range(0, len(page), 7):
+        chunked.update(page[i : i + 7].encode())
+    assert whole.digest() == chunked.digest()
+
+    index = ContentIndex(max_distance=3)
+    id_ = uuid4()
+    assert index.duplicate_of(id_, "http://test/a", whole) is None
+    assert index.duplicate_of(id_, "http://test/b", chunked) == "http://test/a"
+    fingerprint = PageFingerprint()
+    fingerprint.update(near)
+    assert index.duplicate_of(id_, "http://test/c", fingerprint) == "http://test/a"
+    other = PageFingerprint()
+    other.update(" ".join(f"other{i}" for i in range(500)).encode())
+    assert index.duplicate_of(id_, "http://test/d", other) is None
+    assert index.duplicate_of(uuid4(), "http://test/b", chunked) is None  # per event
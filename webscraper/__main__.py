@@ -8,27 +8,111 @@ import logging
 from pydantic import HttpUrl
 import typer
 
+from .results import convert_ndjson_results
+from .settings import ResultsFormat, get_core_settings
 from .utils import setup_logging
-from . import scraper
+from . import linkgraph, profiling, scraper, service, sharding
 
 app = typer.Typer()
 
 
 @app.command("scrape")
 def scrape(
-    starting_url: str, max_depth: int = 10, results_filename: str = "results.json"
+    starting_url: str,
+    max_depth: int = 10,
+    results_filename: str = "results.json",
+    checkpoint: str | None = None,
+    results_format: ResultsFormat = ResultsFormat.JSON,
+    processes: int = 1,
+    profile: str | None = None,
 ):
     """
-    Scrape all connecting URL's from a given website
+    Scrape all connecting URL's from a given website,
+    optionally checkpointing to a file so the scrape can be resumed.
+    NDJSON results are streamed to the file page by page while scraping.
+    With more than one process the crawl is sharded between them.
+    `--profile <dir>` writes cpu, memory and event loop lag profiles to dir
     """
     logging.info("starting webscraper from %s...", starting_url)
-    parsed_url = HttpUrl(starting_url)  # will fail fast if its the incorrect format
-    id_ = asyncio.run(scraper.begin(parsed_url, max_depth))
-    with open(results_filename, "w", encoding="utf-8") as f:
-        f.write(json.dumps(scraper.get_results(id_)))
+    # will fail fast if its the incorrect format, the only place urls go through pydantic
+    parsed_url = HttpUrl(starting_url)
+    streaming = results_format == ResultsFormat.NDJSON
+    if processes > 1:
+        if checkpoint or streaming or profile or get_core_settings().link_graph_path:
+            raise typer.BadParameter(
+                "checkpoints, ndjson results, profiling and link graphs aren't"
+                " supported with --processes"
+            )
+        id_ = sharding.begin_sharded(parsed_url.encoded_string(), max_depth, processes)
+    else:
+        crawl = scraper.begin(
+            parsed_url.encoded_string(),
+            max_depth,
+            checkpoint_path=checkpoint,
+            results_path=results_filename if streaming else None,
+        )
+        id_ = asyncio.run(profiling.profiled(crawl, profile) if profile else crawl)
+    if not streaming:
+        with open(results_filename, "w", encoding="utf-8") as f:
+            scraper.write_results(id_, f)
     logging.info("scraping completed.")
 
 
+@app.command("resume")
+def resume(
+    checkpoint: str,
+    results_filename: str = "results.json",
+    results_format: ResultsFormat = ResultsFormat.JSON,
+):
+    """
+    Resume an interrupted scrape from a checkpoint, without refetching
+    anything that was already scraped. NDJSON results are appended to the file
+    """
+    logging.info("resuming webscraper from %s...", checkpoint)
+    streaming = results_format == ResultsFormat.NDJSON
+    id_ = asyncio.run(
+        scraper.resume(checkpoint, results_path=results_filename if streaming else None)
+    )
+    if not streaming:
+        with open(results_filename, "w", encoding="utf-8") as f:
+            scraper.write_results(id_, f)
+    logging.info("scraping completed.")
+
+
+@app.command("serve")
+def serve(host: str | None = None, port: int | None = None):
+    """
+    Run the crawl service, taking scrape jobs over http and crawling
+    them concurrently until stopped, see service.py for the api
+    """
+    settings = get_core_settings()
+    asyncio.run(
+        service.serve(host or settings.service_host, port or settings.service_port)
+    )
+
+
+@app.command("convert")
+def convert(ndjson_filename: str, results_filename: str = "results.json"):
+    """
+    Rebuild the json results from streamed NDJSON results
+    """
+    with (
+        open(ndjson_filename, encoding="utf-8") as source,
+        open(results_filename, "w", encoding="utf-8") as destination,
+    ):
+        convert_ndjson_results(source, destination)
+
+
+@app.command("graph")
+def graph(link_graph_filename: str, top: int = 20):
+    """
+    Print the size, orphan pages and top pages by in-links and PageRank
+    of a link graph recorded with LINK_GRAPH_PATH
+    """
+    summary = linkgraph.CsrGraph.load(link_graph_filename).summary(top)
+    typer.echo(json.dumps(summary, indent=2))
+
+
 if __name__ == "__main__":
     setup_logging()
     app()
@@ -0,0 +1,187 @@
+"""
+Autoscaling worker pool.
+Every `autoscale_interval` seconds the pool is resized between
+`min_workers` and `max_workers`:
+
+- the event loop lagging past `autoscale_max_loop_lag` means the crawl is
+  cpu bound and more workers only add contention, so the pool shrinks
+- every worker busy with urls still queued means more could be fetched
+  at once. The pool grows by the share of a page's time spent fetching,
+  so slow sites grow fast and cpu heavy ones slowly
+- a grow which didn't raise pages per second by a tenth is undone, and the
+  pool doesn't grow past that size for `COOLDOWN` intervals
+- idle workers with nothing queued are retired, half of them at a time
+
+Idle workers are retired straight away, busy ones once their page is done
+"""
+
+import asyncio
+from collections.abc import Callable, Coroutine
+from functools import partial
+import logging
+import math
+import statistics
+import time
+
+from .frontier import Frontier
+from .metrics import Histogram
+from .profiling import LoopLagMonitor
+
+COOLDOWN = 10  # intervals the pool is capped for after a grow that didn't pay off
+
+
+class _Worker:
+    """a worker's task, and the events it is stopped and reports idling with"""
+
+    def __init__(self):
+        self.stop = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+class WorkerPool:
+    """
+    Worker tasks resized between `minimum` and `maximum` from the frontier
+    depth, pages per second, the time pages spend in `fetches` out of their
+    time in `pages`, and event loop lag.
+    `spawn(stop, idle)` creates a worker's coroutine, which should return once
+    `stop` is set and have `idle` set while it waits for a url
+    """
+
+    def __init__(
+        self,
+        spawn: Callable[[asyncio.Event, asyncio.Event], Coroutine],
+        queue: Frontier,
+        fetches: Histogram,
+        pages: Histogram,
+        minimum: int,
+        maximum: int,
+        interval: float = 0.5,
+        max_loop_lag: float = 0.1,
+    ):
+        self._spawn = spawn
+        self._queue = queue
+        self._fetches = fetches
+        self._pages = pages
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._interval = interval
+        self._max_loop_lag = max_loop_lag
+        self._lag = LoopLagMonitor(min(interval / 10, 0.01))
+        self._workers: list[_Worker] = []
+        # page count, fetch and page seconds, and time at the last resize
+        self._seen = (0, 0.0, 0.0, time.monotonic())
+        self._grown_from: tuple[int, float] | None = None  # size and pages/s
+        self._ceiling = self._maximum
+        self._cooldown = 0
+
+    @property
+    def size(self) -> int:
+        """workers not told to stop"""
+        return sum(not worker.stop.is_set() for worker in self._workers)
+
+    def _start(self, count: int):
+        for _ in range(count):
+            worker = _Worker()
+            worker.task = asyncio.create_task(self._spawn(worker.stop, worker.idle))
+            worker.task.add_done_callback(partial(self._forget, worker))
+            self._workers.append(worker)
+
+    def _forget(self, worker: _Worker, _: asyncio.Task):
+        self._workers.remove(worker)
+
+    def _retire(self, count: int):
+        """stop idle workers first, then busy ones after their page"""
+        running = [worker for worker in self._workers if not worker.stop.is_set()]
+        running.sort(key=lambda worker: not worker.idle.is_set())
+        for worker in running[:count]:
+            worker.stop.set()
+            if worker.idle.is_set() and worker.task is not None:
+                worker.task.cancel()  # waiting on the queue, nothing to lose
+
+    def _loop_lag(self) -> float:
+        """p90 event loop lag since the last resize"""
+        samples, self._lag.samples = self._lag.samples, []
+        if len(samples) < 10:
+            return max(samples, default=0.0)
+        return statistics.quantiles(samples, n=10)[-1]
+
+    def _progress(self) -> tuple[float, float]:
+        """pages per second, and the share of page time spent fetching"""
+        now = time.monotonic()
+        count, fetched, paged = self._pages.count, self._fetches.sum, self._pages.sum
+        last_count, last_fetched, last_paged, last = self._seen
+        self._seen = (count, fetched, paged, now)
+        rate = (count - last_count) / max(now - last, 1e-9)
+        if paged <= last_paged:
+            return rate, 1.0  # nothing finished, e.g. waiting on slow first pages
+        return rate, min(1.0, (fetched - last_fetched) / (paged - last_paged))
+
+    def _target(self) -> tuple[int, str]:
+        """the size the pool should be, and why"""
+        size, queued = self.size, self._queue.qsize()
+        idle = sum(
+            worker.idle.is_set() and not worker.stop.is_set()
+            for worker in self._workers
+        )
+        lag = self._loop_lag()
+        rate, io_share = self._progress()
+        grown_from, self._grown_from = self._grown_from, None
+        if self._cooldown:
+            self._cooldown -= 1
+            if not self._cooldown:
+                self._ceiling = self._maximum
+        if lag > self._max_loop_lag:
+            return math.floor(size * 0.75), f"event loop lag p90 {lag * 1000:.0f}ms"
+        if grown_from is not None and rate < grown_from[1] * 1.1:
+            previous, previous_rate = grown_from
+            self._ceiling, self._cooldown = previous, COOLDOWN
+            return previous, (
+                f"{rate:.0f} pages/s with {size} workers, "
+                f"{previous_rate:.0f} pages/s with {previous}"
+            )
+        if queued and not idle and size < self._ceiling:
+            self._grown_from = (size, rate)
+            grow = max(1, math.ceil(size * io_share))
+            return min(size + grow, size + queued, self._ceiling), (
+                f"{queued} queued, {io_share:.0%} of page time fetching"
+            )
+        if idle and not queued:
+            return size - math.ceil(idle / 2), f"{idle} idle"
+        return size, ""
+
+    def resize(self):
+        """resize the pool once"""
+        size = self.size
+        target, reason = self._target()
+        target = min(self._maximum, max(self._minimum, target))
+        if target > size:
+            self._start(target - size)
+        elif target < size:
+            self._retire(size - target)
+        if target != size:
+            logging.info(
+                "scaling workers from %s to %s, %s",
+                size,
+                target,
+                reason,
+                extra={"workers": target, "previous_workers": size, "reason": reason},
+            )
+
+    async def run(self, initial: int):
+        """
+        Start `initial` workers and keep resizing until cancelled,
+        the workers are cancelled along with it
+        """
+        self._start(min(self._maximum, max(self._minimum, initial)))
+        monitor = asyncio.create_task(self._lag.run())
+        try:
+            while True:
+                await asyncio.sleep(self._interval)
+                self.resize()
+        finally:
+            tasks = [monitor]
+            tasks += [worker.task for worker in self._workers if worker.task]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
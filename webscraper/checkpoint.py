@@ -0,0 +1,121 @@
+"""
+Checkpoints of in progress scrape events, so an interrupted crawl can be resumed
+"""
+
+import asyncio
+from collections.abc import Callable
+import gzip
+import logging
+import os
+
+from .datastore import get_db
+from .definitions import Checkpoint, ScrapeEventSettings, Status
+from .frontier import Frontier
+
+
+def take_checkpoint(
+    settings: ScrapeEventSettings,
+    frontier: Frontier,
+    in_flight: dict[str, int],
+) -> Callable[[], Checkpoint]:
+    """
+    Snapshot the frontier, the pages being worked on and every url status.
+    Synchronous so nothing can change while the snapshots are taken, only
+    in memory state is copied though. Reading spilled segments and the
+    sqlite table, then grouping it all into a checkpoint, is left to the
+    returned function so it can run in a thread
+    """
+    read_statuses = get_db().snapshot_url_statuses(settings.id_)
+    read_frontier = frontier.snapshot()
+    in_progress = list(in_flight.items())
+
+    def build() -> Checkpoint:
+        grouped: dict[Status, list[str]] = {status: [] for status in Status}
+        for url, status in read_statuses().items():
+            grouped[status].append(url)
+        return Checkpoint(
+            settings=settings,
+            frontier=read_frontier(),
+            in_progress=in_progress,
+            status={status: urls for status, urls in grouped.items() if urls},
+        )
+
+    return build
+
+
+def write_checkpoint(path: str, checkpoint: Checkpoint):
+    """
+    gzip the checkpoint to disk, replacing the previous one atomically
+    so a crash mid write never leaves a corrupt checkpoint behind
+    """
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+        f.write(checkpoint.model_dump_json().encode())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path: str) -> Checkpoint:
+    """load a checkpoint written by `write_checkpoint`"""
+    with gzip.open(path, "rb") as f:
+        return Checkpoint.model_validate_json(f.read())
+
+
+def restore_checkpoint(checkpoint: Checkpoint) -> list[tuple[str, int]]:
+    """
+    Restore the scrape event and its url statuses into the db,
+    returning the urls to queue. Pages that were in progress are queued
+    again, anything already scraped is left alone
+    """
+    db = get_db()
+    settings = checkpoint.settings
+    try:
+        db.get_scrape_event_settings(settings.id_)  # e.g. still in the sqlite db
+    except KeyError:
+        db.add_scrape_event(settings.id_, settings.base_url, settings.max_depth)
+    for status, urls in checkpoint.status.items():
+        for url in urls:
+            db.set_url_status(settings.id_, url, status)
+
+    seeds = checkpoint.frontier + checkpoint.in_progress
+    for url, _ in checkpoint.in_progress:
+        db.set_url_status(settings.id_, url, Status.PENDING)
+    logging.info(
+        "resuming scrape event %s with %s urls queued", settings.id_, len(seeds)
+    )
+    return seeds
+
+
+def _build_and_write(path: str, build: Callable[[], Checkpoint]) -> Checkpoint:
+    checkpoint = build()
+    write_checkpoint(path, checkpoint)
+    return checkpoint
+
+
+async def save_checkpoint(path: str, snapshot: Callable[[], Callable[[], Checkpoint]]):
+    """
+    snapshot the crawl state on the loop, then build, compress and write
+    the checkpoint in a thread so the loop isn't blocked by large crawls
+    """
+    writing = asyncio.get_running_loop().run_in_executor(
+        None, _build_and_write, path, snapshot()
+    )
+    try:
+        checkpoint = await asyncio.shield(writing)
+    except asyncio.CancelledError:
+        # let the write finish, or it could replace a later checkpoint
+        await writing
+        raise
+    logging.info(
+        "checkpoint written to %s, %s urls queued",
+        path,
+        len(checkpoint.frontier) + len(checkpoint.in_progress),
+    )
+
+
+async def checkpoint_periodically(
+    path: str, interval: float, snapshot: Callable[[], Callable[[], Checkpoint]]
+):
+    """write a checkpoint every `interval` seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        await save_checkpoint(path, snapshot)
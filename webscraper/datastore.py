@@ -1,69 +1,559 @@
 """
-In memory database interface
+Database interface, with in memory and sqlite backends
 """
 
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
 from functools import lru_cache
+import sqlite3
+import sys
+import time
 from uuid import UUID
 
-from pydantic import HttpUrl
 from .definitions import Status, ScrapeEvent, ScrapeEventSettings
+from .seenset import ScalableBloomFilter
+from .settings import DbBackend, get_core_settings
+from .urls import normalize_url, url_host
 
 
-class Db:
+class Db(ABC):
     """
-    In memory db interface
+    Db interface, urls are normalized keys from urls.py
+    """
+
+    @staticmethod
+    def _new_settings(id_: UUID, base_url: str, max_depth: int) -> ScrapeEventSettings:
+        if (key := normalize_url(base_url)) is None:
+            raise ValueError(f"invalid base url {base_url}")
+        return ScrapeEventSettings(
+            id_=id_, max_depth=max_depth, base_url=key, host=url_host(key)
+        )
+
+    @abstractmethod
+    def add_scrape_event(
+        self, id_: UUID, base_url: str, max_depth: int
+    ) -> ScrapeEventSettings:
+        """add a new scrape event to db"""
+
+    @abstractmethod
+    def get_scrape_event_settings(self, id_: UUID) -> ScrapeEventSettings:
+        """Get scrape event, raising a KeyError if it doesn't exist"""
+
+    @abstractmethod
+    def remove_scrape_event(self, id_: UUID):
+        """remove a scrape event and every url status, if it exists"""
+
+    @abstractmethod
+    def set_url_status(self, id_: UUID, url: str, status: Status):
+        """set scrape status, updating the per status counts"""
+
+    @abstractmethod
+    def get_url_status(self, id_: UUID, url: str) -> Status:
+        """get scrape status, MISSING if the url hasn't been seen"""
+
+    def get_url_statuses(self, id_: UUID, urls: Iterable[str]) -> dict[str, Status]:
+        """statuses of the urls which have been seen, in one lookup"""
+        statuses = {url: self.get_url_status(id_, url) for url in urls}
+        return {url: s for url, s in statuses.items() if s != Status.MISSING}
+
+    def set_url_statuses(self, id_: UUID, statuses: dict[str, Status]):
+        """set the status of many urls"""
+        for url, status in statuses.items():
+            self.set_url_status(id_, url, status)
+
+    @abstractmethod
+    def get_scrape_counts(self, id_: UUID) -> dict:
+        """
+        live counts of a scrape event, O(1) regardless of the number of urls
+        """
+
+    @abstractmethod
+    def iter_scrape_stats(self, id_: UUID) -> Iterator[tuple[Status, Iterator[str]]]:
+        """
+        stream the urls of each status, rather than building every list at once.
+        yields (status, iterator of urls) in the order of the Status enum
+        """
+
+    def get_scrape_stats(self, id_: UUID):
+        """
+        get high level stats of scrape event
+        """
+        outcome: dict = self.get_scrape_counts(id_)
+        outcome["status"] = {
+            status: list(urls) for status, urls in self.iter_scrape_stats(id_)
+        }
+        return outcome
+
+    def snapshot_url_statuses(self, id_: UUID) -> Callable[[], dict[str, Status]]:
+        """
+        Snapshot every url status as they are now. The returned function
+        reads the snapshot, so a checkpoint can be built from it in a thread
+        while the crawl carries on updating the db
+        """
+        statuses = {
+            url: status for status, urls in self.iter_scrape_stats(id_) for url in urls
+        }
+        return lambda: statuses
+
+    def flush(self):
+        """write any buffered updates"""
+
+    def close(self):
+        """flush and release any resources"""
+        self.flush()
+
+
+class MemoryDb(Db):
+    """
+    In memory db
     """
 
     def __init__(self):
         self.db: dict[UUID, ScrapeEvent] = {}
 
     def add_scrape_event(
-        self, id_: UUID, base_url: HttpUrl, max_depth: int
+        self, id_: UUID, base_url: str, max_depth: int
     ) -> ScrapeEventSettings:
-        """add a new scrape event to db"""
-        settings = ScrapeEventSettings(id_=id_, max_depth=max_depth, base_url=base_url)
+        settings = self._new_settings(id_, base_url, max_depth)
         self.db[id_] = ScrapeEvent(settings=settings)
         return settings
 
     def get_scrape_event_settings(self, id_: UUID):
-        """Get scrape event"""
         if id_ not in self.db:
             raise KeyError("scrape event doesn't exist")
         return self.db[id_].settings
 
-    def set_url_status(self, id_: UUID, url: HttpUrl, status: Status):
-        """set scrape status"""
-        self.db[id_].status[url] = status
+    def remove_scrape_event(self, id_: UUID):
+        self.db.pop(id_, None)
 
-    def get_url_status(self, id_: UUID, url: HttpUrl):
-        """get scrape status"""
-        if url not in self.db[id_].status:
-            return Status.MISSING
-        return self.db[id_].status[url]
+    def set_url_status(self, id_: UUID, url: str, status: Status):
+        event = self.db[id_]
+        previous = event.status.get(url)
+        if previous == status:
+            return
+        if previous is not None:
+            event.counts[previous] -= 1
+        event.counts[status] += 1
+        event.status[url] = status
+
+    def get_url_status(self, id_: UUID, url: str):
+        return self.db[id_].status.get(url, Status.MISSING)
+
+    def get_url_statuses(self, id_: UUID, urls: Iterable[str]):
+        status = self.db[id_].status
+        return {url: status[url] for url in urls if url in status}
+
+    def get_scrape_counts(self, id_: UUID):
+        event = self.db[id_]  # expected key error if scrape event doesn't exist
+        return {"counts": dict(event.counts), "total_count": len(event.status)}
+
+    def iter_scrape_stats(self, id_: UUID):
+        event = self.db[id_]
+        for status in Status:
+            yield (
+                status,
+                (url for url, value in event.status.items() if value == status),
+            )
+
+    def snapshot_url_statuses(self, id_: UUID):
+        statuses = self.db[id_].status.copy()
+        return lambda: statuses
 
     def get_scrape_stats(self, id_: UUID):
         """
-        get high level stats of scrape event
+        get high level stats of scrape event, built in a single pass
         """
-        event = self.db[id_]  # expected key error if scrape event doesn't exist
+        outcome: dict = self.get_scrape_counts(id_)
         statuses: dict[Status, list[str]] = {status: [] for status in Status}
-        counts: dict[Status, int] = {status: 0 for status in Status}
-        outcome: dict = {}
-        total = 0
-        for url, status in event.status.items():
-            if (
-                url not in statuses[status]
-            ):  # using a list instead of a set so its json serializable
-                statuses[status].append(url.encoded_string())
-                counts[status] += 1
-                total += 1
-        outcome["counts"] = counts
-        outcome["total_count"] = total
+        for url, status in self.db[id_].status.items():
+            statuses[status].append(url)
         outcome["status"] = statuses
         return outcome
 
 
+class SqliteDb(Db):
+    """
+    Durable sqlite db in WAL mode.
+    Status updates go to a write buffer which is flushed in a single
+    transaction once it is full or `flush_interval` seconds have passed,
+    reads check the buffer first so they always see the latest status
+    """
+
+    _schema = """
+    CREATE TABLE IF NOT EXISTS scrape_events (
+        id TEXT PRIMARY KEY,
+        max_depth INTEGER NOT NULL,
+        base_url TEXT NOT NULL,
+        host TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS url_status (
+        event_id TEXT NOT NULL,
+        url TEXT NOT NULL,
+        status TEXT NOT NULL,
+        UNIQUE (event_id, url)
+    );
+    CREATE INDEX IF NOT EXISTS url_status_by_status ON url_status (event_id, status);
+    """
+    _MAX_VARIABLES = 900  # per query, sqlite builds before 3.32 allow 999
+
+    def __init__(self, path: str, batch_size: int = 1000, flush_interval: float = 1):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._schema)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._pending: dict[tuple[UUID, str], Status] = {}
+        self._events: dict[UUID, ScrapeEventSettings] = {}
+        self._counts: dict[UUID, dict[Status, int]] = {}
+
+    def add_scrape_event(
+        self, id_: UUID, base_url: str, max_depth: int
+    ) -> ScrapeEventSettings:
+        settings = self._new_settings(id_, base_url, max_depth)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO scrape_events VALUES (?, ?, ?, ?)",
+                (str(id_), max_depth, settings.base_url, settings.host),
+            )
+        self._events[id_] = settings
+        self._counts[id_] = {status: 0 for status in Status}
+        return settings
+
+    def get_scrape_event_settings(self, id_: UUID):
+        if id_ in self._events:
+            return self._events[id_]
+        row = self._conn.execute(
+            "SELECT max_depth, base_url, host FROM scrape_events WHERE id = ?",
+            (str(id_),),
+        ).fetchone()
+        if row is None:
+            raise KeyError("scrape event doesn't exist")
+        max_depth, base_url, host = row
+        settings = ScrapeEventSettings(
+            id_=id_, max_depth=max_depth, base_url=base_url, host=host
+        )
+        # an event from a previous run, so count what is already stored
+        counts = {status: 0 for status in Status}
+        for status, count in self._conn.execute(
+            "SELECT status, COUNT(*) FROM url_status WHERE event_id = ? GROUP BY status",
+            (str(id_),),
+        ):
+            counts[Status(status)] = count
+        self._events[id_], self._counts[id_] = settings, counts
+        return settings
+
+    def remove_scrape_event(self, id_: UUID):
+        for key in [key for key in self._pending if key[0] == id_]:
+            del self._pending[key]
+        with self._conn:
+            self._conn.execute("DELETE FROM url_status WHERE event_id = ?", (str(id_),))
+            self._conn.execute("DELETE FROM scrape_events WHERE id = ?", (str(id_),))
+        self._events.pop(id_, None)
+        self._counts.pop(id_, None)
+
+    def set_url_status(self, id_: UUID, url: str, status: Status):
+        previous = self.get_url_status(id_, url)
+        if previous == status:
+            return
+        counts = self._counts[id_]
+        if previous != Status.MISSING:
+            counts[previous] -= 1
+        counts[status] += 1
+        self._pending[(id_, url)] = status
+        if (
+            len(self._pending) >= self._batch_size
+            or time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            self.flush()
+
+    def get_url_status(self, id_: UUID, url: str):
+        self.get_scrape_event_settings(id_)  # key error if it doesn't exist
+        if (status := self._pending.get((id_, url))) is not None:
+            return status
+        row = self._conn.execute(
+            "SELECT status FROM url_status WHERE event_id = ? AND url = ?",
+            (str(id_), url),
+        ).fetchone()
+        return Status(row[0]) if row else Status.MISSING
+
+    def get_url_statuses(self, id_: UUID, urls: Iterable[str]):
+        self.get_scrape_event_settings(id_)
+        statuses, unbuffered = {}, []
+        for url in urls:
+            if (status := self._pending.get((id_, url))) is not None:
+                statuses[url] = status
+            else:
+                unbuffered.append(url)
+        for start in range(0, len(unbuffered), self._MAX_VARIABLES):
+            chunk = unbuffered[start : start + self._MAX_VARIABLES]
+            statuses.update(
+                (url, Status(status))
+                for url, status in self._conn.execute(
+                    "SELECT url, status FROM url_status WHERE event_id = ? "
+                    f"AND url IN ({', '.join('?' * len(chunk))})",
+                    (str(id_), *chunk),
+                )
+            )
+        return statuses
+
+    def set_url_statuses(self, id_: UUID, statuses: dict[str, Status]):
+        previous = self.get_url_statuses(id_, statuses)
+        counts = self._counts[id_]
+        for url, status in statuses.items():
+            if (before := previous.get(url)) == status:
+                continue
+            if before is not None:
+                counts[before] -= 1
+            counts[status] += 1
+            self._pending[(id_, url)] = status
+        if (
+            len(self._pending) >= self._batch_size
+            or time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            self.flush()
+
+    def get_scrape_counts(self, id_: UUID):
+        self.get_scrape_event_settings(id_)
+        counts = self._counts[id_]
+        # MISSING is never stored, so the total is the sum of the counts
+        return {"counts": dict(counts), "total_count": sum(counts.values())}
+
+    def iter_scrape_stats(self, id_: UUID):
+        self.get_scrape_event_settings(id_)
+        self.flush()
+        for status in Status:
+            cursor = self._conn.execute(
+                "SELECT url FROM url_status WHERE event_id = ? AND status = ? "
+                "ORDER BY rowid",  # the order urls were first seen in
+                (str(id_), status.value),
+            )
+            yield status, (url for (url,) in cursor)
+
+    def snapshot_url_statuses(self, id_: UUID):
+        _, _, path = self._conn.execute("PRAGMA database_list").fetchone()
+        if not path:  # in memory, can't be read from another connection
+            return super().snapshot_url_statuses(id_)
+        self.get_scrape_event_settings(id_)
+        self.flush()
+        # the first read of a transaction pins a WAL snapshot, so the table
+        # can be read later in a thread without seeing any later writes
+        reader = sqlite3.connect(path, check_same_thread=False)
+        reader.execute("BEGIN")
+        reader.execute("SELECT 1 FROM url_status LIMIT 1").fetchall()
+
+        def read() -> dict[str, Status]:
+            statuses = {status.value: status for status in Status}
+            try:
+                cursor = reader.execute(
+                    "SELECT url, status FROM url_status WHERE event_id = ? "
+                    "ORDER BY rowid",
+                    (str(id_),),
+                )
+                return {url: statuses[status] for url, status in cursor}
+            finally:
+                reader.close()
+
+        return read
+
+    def flush(self):
+        if self._pending:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO url_status (event_id, url, status) VALUES (?, ?, ?) "
+                    "ON CONFLICT (event_id, url) DO UPDATE SET status = excluded.status",
+                    [
+                        (str(id_), url, status.value)
+                        for (id_, url), status in self._pending.items()
+                    ],
+                )
+            self._pending.clear()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class _SeenUrls:
+    """
+    a scrape event's seen-sets: the urls with a status record, the urls
+    ignored or skipped without one and which of those were skipped, with a
+    count of each status
+    """
+
+    def __init__(self, error_rate: float, initial_capacity: int):
+        self.recorded = ScalableBloomFilter(error_rate, initial_capacity)
+        self.unrecorded = ScalableBloomFilter(error_rate, initial_capacity)
+        self.skipped = ScalableBloomFilter(error_rate, initial_capacity)
+        self.counts = {status: 0 for status in Status}
+        self.unrecorded_bytes = 0
+
+    def status(self, url: str) -> Status:
+        """the status a url without a record was given, MISSING if it's new"""
+        if url not in self.unrecorded:
+            return Status.MISSING
+        return Status.SKIPPED if url in self.skipped else Status.IGNORED
+
+    def add(self, url: str, status: Status):
+        """add a url without a record"""
+        self.unrecorded.add(url)
+        if status == Status.SKIPPED:
+            self.skipped.add(url)
+        self.count(url, status, 1)
+
+    def count(self, url: str, status: Status, change: int):
+        """add a url to, or take it off, the count of a status"""
+        self.counts[status] += change
+        size = sys.getsizeof(url) + SeenSetDb.RECORD_BYTES
+        self.unrecorded_bytes += change * size
+
+    @property
+    def filters(self) -> tuple[ScalableBloomFilter, ...]:
+        """every bloom filter of the event, for their stats"""
+        return (self.recorded, self.unrecorded, self.skipped)
+
+
+class SeenSetDb(Db):
+    """
+    Keeps status records in `db` only for urls which are queued or visited.
+    Urls which are ignored or skipped without being requested, usually most
+    of them, only go into a seen-set per scrape event, see seenset.py, and
+    are counted, so they aren't listed in the stats. They read back as their
+    status, so ignored urls found again in scope are still queued. Recorded
+    urls go into a seen-set as well, so new urls are told apart without a
+    lookup in `db`. A new url is taken for an ignored one, and checked again,
+    about `error_rate` of the time, and only lost if also taken for a skipped one
+    """
+
+    UNRECORDED = (Status.IGNORED, Status.SKIPPED)
+    RECORD_BYTES = 40  # about what a status record costs on top of its url
+
+    def __init__(self, db: Db, error_rate: float, initial_capacity: int):
+        self._db = db
+        self._error_rate = error_rate
+        self._initial_capacity = initial_capacity
+        self._events: dict[UUID, _SeenUrls] = {}
+
+    def _seen_urls(self, id_: UUID) -> _SeenUrls:
+        if (event := self._events.get(id_)) is None:
+            self._db.get_scrape_event_settings(id_)  # key error if it doesn't exist
+            event = _SeenUrls(self._error_rate, self._initial_capacity)
+            self._events[id_] = event
+        return event
+
+    def add_scrape_event(
+        self, id_: UUID, base_url: str, max_depth: int
+    ) -> ScrapeEventSettings:
+        settings = self._db.add_scrape_event(id_, base_url, max_depth)
+        self._seen_urls(id_)
+        return settings
+
+    def get_scrape_event_settings(self, id_: UUID):
+        return self._db.get_scrape_event_settings(id_)
+
+    def remove_scrape_event(self, id_: UUID):
+        self._events.pop(id_, None)
+        self._db.remove_scrape_event(id_)
+
+    def set_url_status(self, id_: UUID, url: str, status: Status):
+        event = self._seen_urls(id_)
+        recorded = self._recorded_status(id_, event, url)
+        previous = event.status(url) if recorded == Status.MISSING else recorded
+        if previous == status:
+            return
+        if previous == Status.MISSING and status in self.UNRECORDED:
+            event.add(url, status)
+            return
+        # seen-sets can't forget a url, so any later status of one is recorded
+        event.recorded.add(url)
+        self._db.set_url_status(id_, url, status)
+        if recorded == Status.MISSING and previous in self.UNRECORDED:
+            # urls with a record are counted by `db`, only the others by the event
+            event.count(url, previous, -1)
+
+    def _recorded_status(self, id_: UUID, event: _SeenUrls, url: str) -> Status:
+        if url in event.recorded:
+            return self._db.get_url_status(id_, url)
+        return Status.MISSING
+
+    def _status(self, id_: UUID, event: _SeenUrls, url: str) -> Status:
+        status = self._recorded_status(id_, event, url)
+        return event.status(url) if status == Status.MISSING else status
+
+    def get_url_status(self, id_: UUID, url: str):
+        return self._status(id_, self._seen_urls(id_), url)
+
+    def get_url_statuses(self, id_: UUID, urls: Iterable[str]):
+        event = self._seen_urls(id_)
+        urls = list(urls)
+        statuses = self._db.get_url_statuses(
+            id_, [url for url in urls if url in event.recorded]
+        )
+        for url in urls:
+            if url not in statuses and (status := event.status(url)) != Status.MISSING:
+                statuses[url] = status
+        return statuses
+
+    def _with_unrecorded(self, id_: UUID, outcome: dict) -> dict:
+        unrecorded = self._seen_urls(id_).counts
+        outcome["counts"] = {
+            status: count + unrecorded[status]
+            for status, count in outcome["counts"].items()
+        }
+        outcome["total_count"] += sum(unrecorded.values())
+        return outcome
+
+    def get_scrape_counts(self, id_: UUID):
+        return self._with_unrecorded(id_, self._db.get_scrape_counts(id_))
+
+    def iter_scrape_stats(self, id_: UUID):
+        return self._db.iter_scrape_stats(id_)
+
+    def snapshot_url_statuses(self, id_: UUID):
+        return self._db.snapshot_url_statuses(id_)
+
+    def get_scrape_stats(self, id_: UUID):
+        return self._with_unrecorded(id_, self._db.get_scrape_stats(id_))
+
+    def get_seen_set_stats(self, id_: UUID) -> dict:
+        """
+        the seen-sets' sizes and the rate of new urls taken for known ones,
+        with the urls left unrecorded and an estimate of the memory that saved
+        """
+        event = self._seen_urls(id_)
+        nbytes = sum(f.nbytes for f in event.filters)
+        return {
+            "urls": sum(len(f) for f in event.filters),
+            "filters": sum(f.stats()["filters"] for f in event.filters),
+            "bytes": nbytes,
+            "error_rate": self._error_rate,
+            "estimated_error_rate": event.unrecorded.error_rate(),
+            "unrecorded_urls": sum(event.counts.values()),
+            "bytes_saved": max(0, event.unrecorded_bytes - nbytes),
+        }
+
+    def flush(self):
+        self._db.flush()
+
+    def close(self):
+        self._db.close()
+
+
 @lru_cache
-def get_db():
-    """get in memory db,cached and global"""
-    return Db()
+def get_db() -> Db:
+    """get the configured db,cached and global"""
+    settings = get_core_settings()
+    db: Db = MemoryDb()
+    if settings.db_backend == DbBackend.SQLITE:
+        db = SqliteDb(
+            settings.sqlite_path,
+            settings.sqlite_batch_size,
+            settings.sqlite_flush_interval,
+        )
+    if settings.seen_set:
+        db = SeenSetDb(
+            db, settings.seen_set_error_rate, settings.seen_set_initial_capacity
+        )
+    return db
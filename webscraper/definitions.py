@@ -19,18 +19,57 @@ class Status(StrEnum):
     SUCCESS = "success"
     MISSING = "missing"
     IGNORED = "ignored"
+    DUPLICATE = "duplicate"  # same content as a page already scraped
+    SKIPPED = "skipped"  # not html, too large or a binary file, never downloaded
 
 
 class ScrapeEventSettings(BaseModel):
-    """Scrape event settings"""
+    """Scrape event settings, urls are normalized keys from urls.py"""
 
     id_: UUID
     max_depth: int
-    base_url: HttpUrl
+    base_url: str
+    host: str
 
 
 class ScrapeEvent(BaseModel):
     """Scrape Event definition"""
 
     settings: ScrapeEventSettings
-    status: dict[HttpUrl, Status] = Field(default_factory=dict)
+    status: dict[str, Status] = Field(default_factory=dict)
+    # kept up to date on every status transition so live stats are O(1)
+    counts: dict[Status, int] = Field(
+        default_factory=lambda: {status: 0 for status in Status}
+    )
+
+
+class Checkpoint(BaseModel):
+    """
+    Snapshot of a scrape event that can be resumed from.
+    urls are grouped by status so each status is only stored once
+    """
+
+    version: int = 1
+    settings: ScrapeEventSettings
+    frontier: list[tuple[str, int]] = Field(default_factory=list)
+    in_progress: list[tuple[str, int]] = Field(default_factory=list)
+    status: dict[Status, list[str]] = Field(default_factory=dict)
+
+
+class JobState(StrEnum):
+    """
+    State of a scrape job run by the service
+    """
+
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobRequest(BaseModel):
+    """Scrape job submitted to the service"""
+
+    url: HttpUrl
+    max_depth: int = Field(default=10, ge=0)
+    workers: int | None = Field(default=None, gt=0)  # capped by the service
@@ -0,0 +1,125 @@
+"""
+Content fingerprints, so pages which are the same or nearly the same as one
+already seen in a scrape event don't have their links extracted again
+"""
+
+from collections import Counter, defaultdict
+from functools import lru_cache
+import hashlib
+import re
+from uuid import UUID
+
+from .settings import get_core_settings
+
+_TOKEN = re.compile(rb"[A-Za-z0-9]+")
+_BANDS = 4  # 16 bit bands, any two hashes within 3 bits share at least one
+
+
+class DuplicateContent(Exception):
+    """raised when a page's content has already been seen in the scrape event"""
+
+    def __init__(self, original: str):
+        super().__init__(original)
+        self.original = original
+
+
+class PageFingerprint:
+    """
+    Exact hash plus a 64 bit simhash over three word shingles of a page,
+    built up chunk by chunk so the body never has to be held in memory
+    """
+
+    max_features = 50000  # plenty to tell pages apart, bounds memory on huge pages
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._features: Counter[tuple[bytes, ...]] = Counter()
+        self._context: list[bytes] = []  # the last words of the previous chunk
+        self._tail = b""
+
+    def update(self, chunk: bytes):
+        """add the next chunk of the body"""
+        self._hash.update(chunk)
+        data = self._tail + chunk
+        words = self._context + _TOKEN.findall(data)
+        # hold back a word that may carry on into the next chunk
+        if len(words) > len(self._context) and data[-1:].isalnum():
+            self._tail = words.pop()
+        else:
+            self._tail = b""
+        if len(self._features) < self.max_features:
+            self._features.update(zip(words, words[1:], words[2:]))
+        self._context = words[-2:]
+
+    def digest(self) -> tuple[bytes, int]:
+        """the exact hash and simhash of everything seen so far"""
+        features = self._features.copy()
+        if self._tail:
+            features[tuple((self._context + [self._tail])[-3:])] += 1
+        elif not features and self._context:
+            features[tuple(self._context)] += 1  # pages of less than three words
+        hashes = b"".join(
+            hashlib.blake2b(b" ".join(shingle), digest_size=8).digest() * weight
+            for shingle, weight in features.items()
+        )
+        # count the values of each byte of the hashes in C rather than
+        # adding up all 64 bits of every hash one by one
+        bit_counts = [0] * 64
+        for i in range(8):
+            for byte, count in Counter(hashes[i::8]).items():
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        bit_counts[i * 8 + bit] += count
+        half = len(hashes) / 16
+        simhash = 0
+        for bit, count in enumerate(bit_counts):
+            if count > half:
+                simhash |= 1 << bit
+        return self._hash.digest(), simhash
+
+
+class ContentIndex:
+    """
+    Fingerprints seen per scrape event. Near duplicates are found through
+    16 bit bands of the simhash, so lookups don't scan every page seen
+    """
+
+    def __init__(self, max_distance: int = 3):
+        self._max_distance = max_distance
+        self._exact: dict[UUID, dict[bytes, str]] = defaultdict(dict)
+        self._bands: dict[UUID, dict[tuple[int, int], list[tuple[int, str]]]] = (
+            defaultdict(lambda: defaultdict(list))
+        )
+
+    def duplicate_of(
+        self, id_: UUID, url: str, fingerprint: PageFingerprint
+    ) -> str | None:
+        """
+        the url of a page with the same or nearly the same content,
+        otherwise None and the page is added to the index
+        """
+        exact, simhash = fingerprint.digest()
+        if (original := self._exact[id_].get(exact)) is not None:
+            return original
+        bands = self._bands[id_]
+        keys = [(band, (simhash >> (band * 16)) & 0xFFFF) for band in range(_BANDS)]
+        for key in keys:
+            for other, other_url in bands.get(key, ()):
+                if (simhash ^ other).bit_count() <= self._max_distance:
+                    return other_url
+
+        self._exact[id_][exact] = url
+        for key in keys:
+            bands[key].append((simhash, url))
+        return None
+
+    def forget(self, id_: UUID):
+        """drop the fingerprints of a finished scrape event"""
+        self._exact.pop(id_, None)
+        self._bands.pop(id_, None)
+
+
+@lru_cache
+def get_content_index():
+    """cached app global content index"""
+    return ContentIndex(get_core_settings().near_duplicate_distance)
@@ -0,0 +1,213 @@
+"""
+Bounded memory crawl frontier
+"""
+
+import asyncio
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+import os
+import shutil
+import tempfile
+
+from .settings import get_core_settings
+
+Item = tuple[str, int]  # (normalized url, depth)
+
+
+class Frontier:
+    """
+    FIFO queue of urls to scrape, with the same get / put_nowait / task_done /
+    join semantics as an asyncio.Queue. At most `max_in_memory` items are held
+    in memory, the overflow is written to append only segment files of
+    `segment_size` items which are read back in order once memory drains
+    """
+
+    def __init__(
+        self,
+        max_in_memory: int = 100000,
+        segment_size: int = 10000,
+        spill_dir: str | None = None,
+    ):
+        self._max_in_memory = max_in_memory
+        self._segment_size = segment_size
+        self._spill_root = spill_dir  # the system temp dir if None
+        self._spill_dir: str | None = None
+        self._head: deque[Item] = deque()  # served first
+        self._segments: deque[str] = deque()  # spilled, oldest first
+        self._tail: list[Item] = []  # queued after spilling started, not yet written
+        self._size = 0
+        self._next_segment = 0
+        self._getters: deque[asyncio.Future] = deque()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self) -> int:
+        """number of items queued"""
+        return self._size
+
+    def empty(self) -> bool:
+        """whether nothing is queued"""
+        return not self._size
+
+    @property
+    def spilled(self) -> int:
+        """number of segment files on disk"""
+        return len(self._segments)
+
+    def put_nowait(self, item: Item):
+        """queue an item, spilling to disk once memory is full"""
+        self.put_many((item,))
+
+    def put_many(self, items: Iterable[Item]):
+        """queue items in order, waking a waiting getter for each"""
+        count = 0
+        for item in items:
+            if (
+                not self._segments
+                and not self._tail
+                and len(self._head) < self._max_in_memory
+            ):
+                self._head.append(item)
+            else:
+                # keep FIFO order, anything queued after the first spill goes behind it
+                self._tail.append(item)
+                if len(self._tail) >= self._segment_size:
+                    self._spill()
+            count += 1
+        if not count:
+            return
+        self._size += count
+        self._unfinished += count
+        self._finished.clear()
+        for _ in range(min(count, len(self._getters))):
+            self._wake_getter()
+
+    def _wake_getter(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def _spill(self):
+        """write the tail out as a new segment"""
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="frontier-", dir=self._spill_root)
+        path = os.path.join(self._spill_dir, f"{self._next_segment:08d}.seg")
+        self._next_segment += 1
+        with open(path, "w", encoding="utf-8") as f:
+            # normalized urls are percent encoded, so never hold a tab or newline
+            f.writelines(f"{depth}\t{url}\n" for url, depth in self._tail)
+        self._segments.append(path)
+        self._tail = []
+
+    @staticmethod
+    def _read_segment(path: str) -> Iterator[Item]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                depth, url = line.rstrip("\n").split("\t", 1)
+                yield url, int(depth)
+
+    def _refill(self):
+        """page the oldest segment, or the unwritten tail, back into memory"""
+        if self._segments:
+            path = self._segments.popleft()
+            self._head.extend(self._read_segment(path))
+            os.remove(path)
+        else:
+            self._head.extend(self._tail)
+            self._tail = []
+
+    def get_nowait(self) -> Item:
+        """get the next item, raising asyncio.QueueEmpty if there isn't one"""
+        if not self._size:
+            raise asyncio.QueueEmpty
+        if not self._head:
+            self._refill()
+        self._size -= 1
+        return self._head.popleft()
+
+    async def get(self) -> Item:
+        """wait for the next item"""
+        while not self._size:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                if getter in self._getters:
+                    self._getters.remove(getter)
+                elif self._size:
+                    self._wake_getter()  # woken then cancelled, pass the wake up on
+                raise
+        return self.get_nowait()
+
+    def task_done(self):
+        """mark an item returned by get as worked on"""
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._finished.set()
+
+    async def join(self):
+        """wait until every queued item has been worked on"""
+        await self._finished.wait()
+
+    def items(self) -> Iterator[Item]:
+        """every queued item in order, including spilled ones"""
+        yield from self._head
+        for path in self._segments:
+            yield from self._read_segment(path)
+        yield from self._tail
+
+    def snapshot(self) -> Callable[[], list[Item]]:
+        """
+        Snapshot every queued item in order, e.g. for checkpoints. Only the
+        in memory items are copied now, spilled segments are hard linked so
+        refilling can't remove them and are read by the returned function,
+        which can run in a thread
+        """
+        head, tail = list(self._head), list(self._tail)
+        frozen: list[str] = []
+        link_dir = None
+        if self._segments:
+            link_dir = tempfile.mkdtemp(prefix="snapshot-", dir=self._spill_root)
+            for path in self._segments:
+                frozen.append(os.path.join(link_dir, os.path.basename(path)))
+                try:
+                    os.link(path, frozen[-1])
+                except OSError:  # e.g. a filesystem without hard links
+                    shutil.copyfile(path, frozen[-1])
+
+        def read() -> list[Item]:
+            try:
+                items = head
+                for path in frozen:
+                    items.extend(self._read_segment(path))
+                items.extend(tail)
+                return items
+            finally:
+                if link_dir is not None:
+                    shutil.rmtree(link_dir, ignore_errors=True)
+
+        return read
+
+    def close(self):
+        """remove any spilled segments"""
+        self._segments.clear()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
+def get_frontier() -> Frontier:
+    """new frontier with the configured limits, one per crawl"""
+    settings = get_core_settings()
+    return Frontier(
+        settings.frontier_max_in_memory,
+        settings.frontier_segment_size,
+        settings.frontier_spill_dir,
+    )
@@ -0,0 +1,154 @@
+"""
+On disk cache of response validators and outbound links, so recrawls can
+send conditional requests and reuse the links of unchanged pages on a 304
+"""
+
+from collections import defaultdict
+from functools import lru_cache
+import sqlite3
+import time
+from typing import NamedTuple
+from uuid import UUID
+
+import httpx
+
+from .settings import get_http_client_settings
+
+
+class CacheEntry(NamedTuple):
+    """validators and links of a previously fetched page"""
+
+    etag: str | None
+    last_modified: str | None
+    links: list[str]
+
+    def headers(self) -> dict[str, str]:
+        """conditional request headers for this entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Sqlite backed cache keyed by normalized url, evicting the least recently
+    used entries once the stored links go over `max_bytes`.
+    Writes are buffered and flushed in batches, like the sqlite db
+    """
+
+    _schema = """
+    CREATE TABLE IF NOT EXISTS responses (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        links TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS responses_by_last_used ON responses (last_used);
+    """
+
+    def __init__(self, path: str, max_bytes: int, batch_size: int = 500):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self._schema)
+        self._max_bytes = max_bytes
+        self._batch_size = batch_size
+        # only ever over estimated between flushes, so eviction is checked cheaply
+        self._size = self._stored_size()
+        self._pending: dict[str, tuple] = {}
+        self._touched: dict[str, float] = {}
+        self._stats: dict[UUID, dict[str, int]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "not_modified": 0}
+        )
+
+    def _stored_size(self) -> int:
+        return self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def lookup(self, id_: UUID, url: str) -> CacheEntry | None:
+        """get the cached entry for a url, counting a hit or miss for the scrape event"""
+        if (row := self._pending.get(url)) is None:
+            row = self._conn.execute(
+                "SELECT url, etag, last_modified, links FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            self._stats[id_]["misses"] += 1
+            return None
+        self._stats[id_]["hits"] += 1
+        self._touched[url] = time.time()
+        _, etag, last_modified, links = row[:4]
+        return CacheEntry(etag, last_modified, links.split("\n") if links else [])
+
+    def not_modified(self, id_: UUID):
+        """count a 304, the cached links were reused"""
+        self._stats[id_]["not_modified"] += 1
+
+    def store(self, url: str, headers: httpx.Headers, links: list[str]):
+        """cache the links of a page, if the response has any validators"""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        joined = "\n".join(links)  # normalized urls never contain a raw newline
+        size = len(joined) + len(url)
+        self._pending[url] = (url, etag, last_modified, joined, size, time.time())
+        self._touched.pop(url, None)
+        self._size += size
+        if len(self._pending) + len(self._touched) >= self._batch_size:
+            self.flush()
+
+    def get_stats(self, id_: UUID) -> dict[str, int]:
+        """hit, miss and 304 counts of a scrape event"""
+        return dict(self._stats[id_])
+
+    def forget(self, id_: UUID):
+        """drop the stats of a finished scrape event"""
+        self._stats.pop(id_, None)
+
+    def flush(self):
+        """write buffered entries and evict if over the size limit"""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending.values(),
+            )
+            self._conn.executemany(
+                "UPDATE responses SET last_used = ? WHERE url = ?",
+                [(used, url) for url, used in self._touched.items()],
+            )
+        self._pending.clear()
+        self._touched.clear()
+        if self._size > self._max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """drop the least recently used entries until under 90% of the limit"""
+        self._size = self._stored_size()
+        while self._size > self._max_bytes * 0.9:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE url IN "
+                    "(SELECT url FROM responses ORDER BY last_used LIMIT "
+                    "(SELECT MAX(COUNT(*) / 10, 1) FROM responses))"
+                )
+            self._size = self._stored_size()
+
+    def close(self):
+        """flush and close the cache"""
+        self.flush()
+        self._conn.close()
+
+
+@lru_cache
+def get_response_cache() -> ResponseCache | None:
+    """cached app global response cache, None if caching is turned off"""
+    settings = get_http_client_settings()
+    if not settings.cache_path:
+        return None
+    return ResponseCache(settings.cache_path, settings.cache_max_bytes)
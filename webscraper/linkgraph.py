@@ -0,0 +1,209 @@
+"""
+Link graph of a crawl.
+Every url gets an integer id the first time it is seen, and the links of each
+page are appended to a typed array of target ids, so a link costs 4 bytes
+however long its url is. Once the crawl ends the graph is compacted into CSR
+form (row offsets per page and the concatenated targets) with numpy, which
+is what the exported file holds and what in-degree, orphan pages and
+PageRank are computed on. numpy is only needed with `link_graph_path` set,
+install it with `uv sync --extra graph` or `pip install numpy`
+"""
+
+from array import array
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # optional, only needed to record link graphs
+    np = None  # type: ignore[assignment]
+
+_MAGIC = b"WSLINKG1"
+_HEADER = struct.Struct("<8sQQ")  # magic, nodes, edges
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError(
+            "the link graph needs numpy, install it with `pip install numpy`"
+        )
+
+
+class LinkGraph:
+    """
+    Append only recorder of the links between pages, `root` gets id 0.
+    A page's links are only recorded the first time it is added
+    """
+
+    def __init__(self, root: str):
+        _require_numpy()
+        self._ids: dict[str, int] = {}
+        self.urls: list[str] = []
+        self._crawled = bytearray()  # 1 for pages added, by id
+        self._targets = array("I")  # every page's links, one after the other
+        self._pages = array("I")  # id of each page added, in order
+        self._ends = array("Q")  # offset of the end of each page's links
+        self.id_of(root)
+
+    @property
+    def nodes(self) -> int:
+        """number of urls seen"""
+        return len(self.urls)
+
+    @property
+    def edges(self) -> int:
+        """number of links recorded"""
+        return len(self._targets)
+
+    def id_of(self, url: str) -> int:
+        """id of a url, assigned the first time it is seen"""
+        if (id_ := self._ids.get(url)) is None:
+            id_ = self._ids[url] = len(self.urls)
+            self.urls.append(url)
+            self._crawled.append(0)
+        return id_
+
+    def add_page(self, url: str, links: list[str]):
+        """record a crawled page and its links, each distinct link once"""
+        source = self.id_of(url)
+        if self._crawled[source]:
+            return
+        self._crawled[source] = 1
+        self._targets.extend(self.id_of(link) for link in dict.fromkeys(links))
+        self._pages.append(source)
+        self._ends.append(len(self._targets))
+
+    def compact(self) -> "CsrGraph":
+        """the graph in CSR form, with the links of each page ordered by its id"""
+        nodes = self.nodes
+        pages = np.frombuffer(self._pages, dtype=np.uint32)
+        ends = np.frombuffer(self._ends, dtype=np.uint64).astype(np.int64)
+        starts = np.zeros_like(ends)
+        starts[1:] = ends[:-1]
+        counts = np.zeros(nodes, dtype=np.int64)
+        counts[pages] = ends - starts
+        indptr = np.zeros(nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        targets = np.frombuffer(self._targets, dtype=np.uint32)
+        # rows in id order: sort the pages rather than the links, then gather
+        # each row from where its page's links were appended
+        order = np.argsort(pages, kind="stable")
+        lengths = (ends - starts)[order]
+        shift = np.repeat(starts[order] - indptr[pages[order]], lengths)
+        indices = targets[np.arange(len(targets), dtype=np.int64) + shift]
+        crawled = np.frombuffer(bytes(self._crawled), dtype=np.bool_)
+        return CsrGraph(indptr, indices, list(self.urls), crawled)
+
+
+class CsrGraph:
+    """
+    Compacted link graph: the links of page `i` are
+    `indices[indptr[i]:indptr[i + 1]]`, and `crawled[i]` is whether page `i`
+    was crawled, rather than only linked to
+    """
+
+    def __init__(self, indptr, indices, urls: list[str], crawled):
+        self.indptr = indptr
+        self.indices = indices
+        self.urls = urls
+        self.crawled = crawled
+
+    @property
+    def nodes(self) -> int:
+        """number of urls"""
+        return len(self.urls)
+
+    @property
+    def edges(self) -> int:
+        """number of links"""
+        return len(self.indices)
+
+    def _sources(self):
+        """source id of every link"""
+        return np.repeat(np.arange(self.nodes, dtype=np.uint32), np.diff(self.indptr))
+
+    def out_degree(self):
+        """number of links on each page"""
+        return np.diff(self.indptr)
+
+    def in_degree(self, self_links: bool = True):
+        """number of pages linking to each page"""
+        indices = self.indices
+        if not self_links:
+            indices = indices[indices != self._sources()]
+        return np.bincount(indices, minlength=self.nodes)
+
+    def orphans(self) -> list[str]:
+        """crawled pages no other page links to, e.g. only in a sitemap, the root aside"""
+        orphaned = self.crawled & (self.in_degree(self_links=False) == 0)
+        orphaned[0] = False
+        return [self.urls[id_] for id_ in np.flatnonzero(orphaned)]
+
+    def pagerank(
+        self, damping: float = 0.85, tolerance: float = 1e-6, max_iterations: int = 100
+    ):
+        """
+        PageRank of every url by power iteration, summing to 1.
+        The rank of pages without links, including ones never crawled,
+        is spread evenly over every page
+        """
+        nodes = self.nodes
+        out_degree = self.out_degree()
+        dangling = out_degree == 0
+        share = np.zeros(nodes)
+        sources = self._sources()
+        rank = np.full(nodes, 1 / nodes)
+        for _ in range(max_iterations):
+            np.divide(rank, out_degree, out=share, where=~dangling)
+            incoming = np.bincount(
+                self.indices, weights=share[sources], minlength=nodes
+            )
+            updated = damping * (incoming + rank[dangling].sum() / nodes)
+            updated += (1 - damping) / nodes
+            converged = np.abs(updated - rank).sum() < tolerance
+            rank = updated
+            if converged:
+                break
+        return rank
+
+    def summary(self, top: int = 20) -> dict:
+        """sizes, orphan pages, and the crawled pages most linked to and by rank"""
+        in_degree = self.in_degree(self_links=False)
+        rank = self.pagerank()
+        crawled = np.flatnonzero(self.crawled)
+        by_links = crawled[np.argsort(-in_degree[crawled], kind="stable")[:top]]
+        by_rank = crawled[np.argsort(-rank[crawled], kind="stable")[:top]]
+        return {
+            "nodes": self.nodes,
+            "edges": self.edges,
+            "crawled": len(crawled),
+            "orphans": self.orphans(),
+            "most_linked": [[self.urls[i], int(in_degree[i])] for i in by_links],
+            "pagerank": [[self.urls[i], float(rank[i])] for i in by_rank],
+        }
+
+    def save(self, path: str):
+        """
+        Write the graph to a binary file: a header, the row offsets as int64,
+        the link targets as uint32, the crawled flags as bytes and then
+        the urls, one per line
+        """
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, self.nodes, self.edges))
+            np.asarray(self.indptr, dtype="<i8").tofile(f)
+            np.asarray(self.indices, dtype="<u4").tofile(f)
+            np.asarray(self.crawled, dtype=np.uint8).tofile(f)
+            f.write("\n".join(self.urls).encode())
+
+    @classmethod
+    def load(cls, path: str) -> "CsrGraph":
+        """read a graph written by `save`"""
+        _require_numpy()
+        with open(path, "rb") as f:
+            magic, nodes, edges = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"{path} isn't a link graph")
+            indptr = np.fromfile(f, dtype="<i8", count=nodes + 1)
+            indices = np.fromfile(f, dtype="<u4", count=edges)
+            crawled = np.fromfile(f, dtype=np.uint8, count=nodes).astype(np.bool_)
+            urls = f.read().decode().split("\n") if nodes else []
+        return cls(indptr, indices, urls, crawled)
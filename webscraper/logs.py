@@ -0,0 +1,173 @@
+"""
+Background, structured logging.
+Records are put on a queue by the logging call and formatted and written by
+a listener thread, so the event loop never waits on encoding, stdout or disk.
+Handlers write in batches, flushing every `log_batch_size` records,
+`log_flush_interval` seconds or on a warning. The log file gets a json object
+per line holding the record's `extra` fields, stdout stays human readable.
+Records up to INFO are capped at `log_max_per_second`, any dropped are
+counted on the next record let through
+"""
+
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import time
+
+# attributes every record has, anything else came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    A json object per record, with the time, level, process, function,
+    message and `extra` fields of the record
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "process": record.processName,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `max_per_second` records up to INFO each second,
+    warnings and errors always pass. The number of records dropped since the
+    last one let through is set on it as `dropped`
+    """
+
+    def __init__(self, max_per_second: float):
+        super().__init__()
+        self._max_per_second = max_per_second
+        self._window = 0
+        self._passed = 0
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self._max_per_second and record.levelno <= logging.INFO:
+            window = int(record.created)
+            if window != self._window:
+                self._window, self._passed = window, 0
+            if self._passed >= self._max_per_second:
+                self.dropped += 1
+                return False
+            self._passed += 1
+        if self.dropped:
+            record.dropped = self.dropped
+            self.dropped = 0
+        return True
+
+
+class BatchedStreamHandler(logging.StreamHandler):
+    """
+    Stream handler buffering formatted records and writing them in one go
+    once `batch_size` are waiting, `flush_interval` seconds have passed since
+    the last write, or a warning comes in
+    """
+
+    def __init__(self, stream=None, batch_size: int = 256, flush_interval: float = 1):
+        # for a BatchedFileHandler `stream` is the filename, passed on to FileHandler
+        super().__init__(stream)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._lines: list[str] = []
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._lines.append(self.format(record) + self.terminator)
+        except RecursionError:  # as logging.StreamHandler.emit does
+            raise
+        # formatting runs arbitrary __str__ methods of the arguments, anything they
+        # raise is reported through handleError rather than crashing the caller
+        except Exception:  # noqa: BLE001  # pylint: disable=broad-exception-caught
+            self.handleError(record)
+            return
+        if (
+            len(self._lines) >= self._batch_size
+            or record.levelno >= logging.WARNING
+            or time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """write the buffered records"""
+        with self.lock:  # type: ignore[union-attr]
+            if self._lines and self.stream is not None:
+                lines, self._lines = self._lines, []
+                self.stream.write("".join(lines))
+            super().flush()
+        self._last_flush = time.monotonic()
+
+
+class BatchedFileHandler(BatchedStreamHandler, logging.FileHandler):
+    """batched handler appending to a file"""
+
+    def __init__(self, filename: str, batch_size: int = 256, flush_interval: float = 1):
+        super().__init__(filename, batch_size, flush_interval)
+
+
+class _FlushingListener(QueueListener):
+    """queue listener flushing its handlers whenever the queue goes quiet"""
+
+    def __init__(self, queue_: queue.SimpleQueue, *handlers, flush_interval: float):
+        super().__init__(queue_, *handlers, respect_handler_level=True)
+        self._records = queue_
+        self._flush_interval = flush_interval
+
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self._records.get(timeout=self._flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    def flush(self):
+        """flush every handler"""
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Hands records to `handlers` running on a listener thread of its own,
+    which is stopped once every record queued has been written when closed
+    """
+
+    def __init__(self, *handlers: logging.Handler, flush_interval: float = 1):
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        super().__init__(records)
+        self.listener = _FlushingListener(
+            records, *handlers, flush_interval=flush_interval
+        )
+        self.listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the listener is a thread, so the record doesn't need pickling,
+        # but its arguments could change before it is formatted
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super().close()
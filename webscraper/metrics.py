@@ -0,0 +1,261 @@
+"""
+Hot path instrumentation.
+Latency histograms per crawl stage and counters, labelled by host and scrape
+event, exposed in Prometheus text format from an optional local endpoint and
+logged as a periodic summary line. Recording is a dict lookup, a bisect and
+a couple of adds, so it is always on
+"""
+
+import asyncio
+from bisect import bisect_left
+from enum import StrEnum
+from functools import lru_cache
+import logging
+import time
+from uuid import UUID
+
+# upper bounds in seconds, Prometheus style
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+class Stage(StrEnum):
+    """
+    Timed stages of the crawl
+    """
+
+    QUEUE_WAIT = "queue_wait"  # a worker waiting for a url
+    FETCH = "fetch"  # request sent until response headers, retries included
+    BACKOFF = "backoff"  # sleeping before retrying a 429
+    PARSE = "parse"  # pulling links out of a page and resolving them
+    VALIDATE = "validate"  # validating and recording a page's links
+    PAGE = "page"  # a page from start to finish
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their sum
+    """
+
+    __slots__ = ("count", "counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """record an observation"""
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        """add another histogram's observations to this one"""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket holding the q-th quantile"""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+# (stage, host, event id)
+HistogramKey = tuple[Stage, str, UUID | None]
+# (name, host, event id, status)
+CounterKey = tuple[str, str, UUID | None, str]
+
+
+def _labels(host: str, event: UUID | None, **extra: str) -> str:
+    labels = {"host": host, "event": str(event or ""), **extra}
+    return ",".join(f'{name}="{value}"' for name, value in labels.items() if value)
+
+
+class Metrics:
+    """
+    Registry of every histogram and counter of the process
+    """
+
+    def __init__(self):
+        self._histograms: dict[HistogramKey, Histogram] = {}
+        self._counters: dict[CounterKey, float] = {}
+        self._last_summary = (time.monotonic(), 0.0)
+
+    def observe(self, stage: Stage, host: str, event: UUID | None, seconds: float):
+        """record how long a stage took"""
+        key = (stage, host, event)
+        if (histogram := self._histograms.get(key)) is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def increment(
+        self,
+        name: str,
+        host: str,
+        event: UUID | None,
+        value: float = 1,
+        status: str = "",
+    ):
+        """add to a counter"""
+        key = (name, host, event, status)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram(self, stage: Stage, host: str, event: UUID | None) -> Histogram:
+        """the live histogram of a stage for a host and event"""
+        key = (stage, host, event)
+        if (histogram := self._histograms.get(key)) is None:
+            histogram = self._histograms[key] = Histogram()
+        return histogram
+
+    def stage(self, stage: Stage) -> Histogram:
+        """a stage's observations across every host and event"""
+        total = Histogram()
+        for (name, _, _), histogram in self._histograms.items():
+            if name == stage:
+                total.merge(histogram)
+        return total
+
+    def counter(self, name: str) -> float:
+        """a counter's total across every label"""
+        return sum(value for key, value in self._counters.items() if key[0] == name)
+
+    def forget(self, event: UUID):
+        """
+        drop the histograms and counters of a finished scrape event,
+        so a long running service doesn't keep every event's label sets
+        """
+        pages = self.counter("pages")
+        self._histograms = {
+            key: histogram
+            for key, histogram in self._histograms.items()
+            if key[2] != event
+        }
+        self._counters = {
+            key: value for key, value in self._counters.items() if key[2] != event
+        }
+        # the forgotten pages don't count against the next summary's rate
+        last, last_pages = self._last_summary
+        self._last_summary = (last, last_pages - (pages - self.counter("pages")))
+
+    def render(self) -> str:
+        """every metric in Prometheus text exposition format"""
+        lines = [
+            "# HELP webscraper_stage_seconds time spent in each crawl stage",
+            "# TYPE webscraper_stage_seconds histogram",
+        ]
+        for (stage, host, event), histogram in sorted(
+            self._histograms.items(), key=lambda item: str(item[0])
+        ):
+            labels = _labels(host, event, stage=stage)
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'webscraper_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"webscraper_stage_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(
+                f"webscraper_stage_seconds_count{{{labels}}} {histogram.count}"
+            )
+        names = sorted({key[0] for key in self._counters})
+        for name in names:
+            lines.append(f"# TYPE webscraper_{name}_total counter")
+            for (counter, host, event, status), value in self._counters.items():
+                if counter == name:
+                    labels = _labels(host, event, status=status)
+                    lines.append(f"webscraper_{name}_total{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """one line of throughput since the last summary, and stage latencies"""
+        now, pages = time.monotonic(), self.counter("pages")
+        last, last_pages = self._last_summary
+        self._last_summary = (now, pages)
+        parts = [
+            f"pages={pages:.0f} ({(pages - last_pages) / max(now - last, 1e-9):.1f}/s)"
+        ]
+        for stage in Stage:
+            histogram = self.stage(stage)
+            if histogram.count:
+                parts.append(
+                    f"{stage} p50<={histogram.quantile(0.5) * 1000:g}ms "
+                    f"p99<={histogram.quantile(0.99) * 1000:g}ms "
+                    f"total={histogram.sum:.1f}s"
+                )
+        parts.append(f"retries={self.counter('retries'):.0f}")
+        return " | ".join(parts)
+
+
+async def _handle_scrape(metrics: Metrics, reader, writer):
+    """answer a single http request, /metrics or a 404"""
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass  # headers
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(metrics: Metrics, host: str, port: int) -> asyncio.Server:
+    """serve the metrics at http://host:port/metrics until the server is closed"""
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_scrape(metrics, reader, writer), host, port
+    )
+    logging.info(
+        "serving metrics on http://%s:%s/metrics",
+        host,
+        server.sockets[0].getsockname()[1],
+    )
+    return server
+
+
+async def log_metrics_periodically(metrics: Metrics, interval: float):
+    """log a summary line every `interval` seconds until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("metrics: %s", metrics.summary())
+
+
+@lru_cache
+def get_metrics():
+    """cached app global metrics registry"""
+    return Metrics()
@@ -0,0 +1,211 @@
+"""
+Html parsing, either streamed over the raw response bytes
+or run off the event loop so fetching is never blocked
+"""
+
+import asyncio
+import codecs
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import html
+import logging
+import multiprocessing
+import re
+
+from bs4 import BeautifulSoup
+
+from .settings import ParseMode, get_core_settings
+
+
+def extract_hrefs(content: bytes | str) -> tuple[list[str], str | None]:
+    """
+    Extract the raw href of every anchor on a page, and the `<base href>`.
+    Module level so it can be pickled and sent to a process pool
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    base = soup.find("base", href=True)
+    return (
+        [tag["href"] for tag in soup.find_all("a", href=True)],  # type:ignore
+        base["href"] if base else None,  # type:ignore
+    )
+
+
+_TAG = re.compile(rb"""<([a-zA-Z][^\t\n\f\r />]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+# end tags, doctypes and processing instructions
+_OTHER_TAG = re.compile(rb"<[/!?][^>]*>")
+_ATTR = re.compile(rb"""([^\s/>"'=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?""")
+_COMMENT_END = re.compile(rb"-->")
+_RAWTEXT_END = {
+    name: re.compile(rb"</" + name, re.IGNORECASE) for name in (b"script", b"style")
+}
+_LINK_TAGS = (b"a", b"base")
+
+
+def _codec_name(encoding: str | None) -> str:
+    """the codec of a page's declared charset, utf-8 if it is missing or unknown"""
+    try:
+        return codecs.lookup(encoding or "utf-8").name
+    except LookupError:
+        logging.debug("unknown charset %s, decoding as utf-8", encoding)
+        return "utf-8"
+
+
+class StreamingLinkExtractor:
+    """
+    Incremental tokenizer that pulls hrefs out of `<a>` and `<base>` tags.
+    Bytes are fed in as they arrive and only the unfinished tail of the last
+    tag is kept between chunks, so memory stays flat regardless of page size.
+    Matches the html.parser behaviour of ignoring tags inside comments,
+    scripts and styles, and of the last duplicate attribute winning
+    """
+
+    max_tag_bytes = 65536  # give up on a tag that never closes
+
+    def __init__(self, encoding: str | None = None):
+        self.encoding = _codec_name(encoding)
+        self.base_href: str | None = None
+        self._buffer = b""
+        self._until: re.Pattern | None = None  # skipping a comment or raw text
+
+    def _decode(self, value: bytes) -> str:
+        return html.unescape(value.decode(self.encoding, errors="replace"))
+
+    def _href(self, attrs: bytes) -> str | None:
+        href = None
+        for name, double, single, bare in _ATTR.findall(attrs):
+            if name.lower() == b"href":
+                href = self._decode(double or single or bare)
+        return href
+
+    def feed(self, chunk: bytes) -> list[str]:
+        """feed the next chunk of the body, returning the hrefs it completed"""
+        buffer = self._buffer + chunk if self._buffer else chunk
+        hrefs: list[str] = []
+        pos = 0
+        while True:
+            if self._until is not None:
+                end = self._until.search(buffer, pos)
+                if end is None:
+                    # only keep enough to match a terminator split across chunks
+                    pos = max(pos, len(buffer) - 8)
+                    break
+                pos = end.start() if self._until is not _COMMENT_END else end.end()
+                self._until = None
+                continue
+
+            start = buffer.find(b"<", pos)
+            if start == -1:
+                pos = len(buffer)
+                break
+            if buffer.startswith(b"<!--", start):
+                self._until = _COMMENT_END
+                pos = start + 4
+                continue
+
+            match = _TAG.match(buffer, start) or _OTHER_TAG.match(buffer, start)
+            if match is None:
+                following = buffer[start + 1 : start + 2]  # empty at end of buffer
+                opens_tag = following in b"/!?" or following.isalpha()
+                if opens_tag and len(buffer) - start < self.max_tag_bytes:
+                    pos = start  # tag is split across chunks, wait for more
+                    break
+                pos = start + 1  # just a "<" in the text
+                continue
+
+            pos = match.end()
+            if match.re is _OTHER_TAG:
+                continue
+            name = match.group(1).lower()
+            if name in _RAWTEXT_END:
+                self._until = _RAWTEXT_END[name]
+            elif (
+                name in _LINK_TAGS and (href := self._href(match.group(2))) is not None
+            ):
+                if name == b"a":
+                    hrefs.append(href)
+                elif self.base_href is None:  # only the first base counts
+                    self.base_href = href
+
+        self._buffer = buffer[pos:]
+        return hrefs
+
+
+def stream_hrefs(content: bytes | str) -> tuple[list[str], str | None]:
+    """
+    Run the streaming extractor over a whole page,
+    returning the hrefs and the `<base href>` if there was one
+    """
+    extractor = StreamingLinkExtractor()
+    if isinstance(content, str):
+        content = content.encode(extractor.encoding)
+    return extractor.feed(content), extractor.base_href
+
+
+class LinkParser:
+    """
+    Runs `extract_hrefs` inline, in a thread pool or in a process pool.
+    Pages smaller than `offload_min_bytes` are always parsed inline,
+    as shipping them to a pool costs more than parsing them
+    """
+
+    def __init__(
+        self,
+        mode: ParseMode = ParseMode.PROCESS,
+        max_workers: int | None = None,
+        offload_min_bytes: int = 0,
+    ):
+        self.mode = mode
+        self._max_workers = max_workers
+        self._offload_min_bytes = offload_min_bytes
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor | None:
+        """lazily start the pool, falling back to threads if processes are unavailable"""
+        if self._executor is not None or self.mode == ParseMode.INLINE:
+            return self._executor
+        if self.mode == ParseMode.PROCESS:
+            try:
+                self._executor = ProcessPoolExecutor(
+                    self._max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                return self._executor
+            except (OSError, NotImplementedError):
+                logging.warning("process pool unavailable, parsing in threads instead")
+                self.mode = ParseMode.THREAD
+        self._executor = ThreadPoolExecutor(
+            self._max_workers, thread_name_prefix="parser"
+        )
+        return self._executor
+
+    async def extract_hrefs(self, content: bytes | str) -> tuple[list[str], str | None]:
+        """extract hrefs from a page without blocking the event loop"""
+        if len(content) < self._offload_min_bytes:
+            return extract_hrefs(content)
+        executor = self._get_executor()
+        if executor is None:
+            return extract_hrefs(content)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, extract_hrefs, content
+            )
+        except BrokenProcessPool:
+            logging.exception("parser process pool died, parsing inline from now on")
+            self.close()
+            self.mode = ParseMode.INLINE
+            return extract_hrefs(content)
+
+    def close(self):
+        """shutdown the pool if one was started"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+@lru_cache
+def get_link_parser():
+    """cached app global link parser, so the pool is shared between scrape events"""
+    settings = get_core_settings()
+    return LinkParser(
+        settings.parse_mode, settings.parse_workers, settings.parse_offload_min_bytes
+    )
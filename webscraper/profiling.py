@@ -0,0 +1,186 @@
+"""
+Profiling of a crawl: a sampling cpu profiler writing collapsed stacks,
+tracemalloc allocation sites grouped by module, and event loop lag.
+The sampler is a thread reading the event loop thread's stack every few
+milliseconds, so the crawl itself runs unchanged
+"""
+
+import asyncio
+from collections import Counter
+from collections.abc import Coroutine
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from types import FrameType
+from typing import Any
+
+
+def _frame_name(frame: FrameType) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+class StackSampler:
+    """
+    Samples a thread's stack every `interval` seconds from a background thread,
+    counting each distinct stack
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: int | None = None):
+        self._interval = interval
+        self._thread_id = thread_id or threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            # the only way to read another thread's stack
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            frame = frames.get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        """start sampling"""
+        self._thread = threading.Thread(
+            target=self._sample, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """stop sampling"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_collapsed(self, path: str):
+        """write `root;caller;callee count` lines, as read by flamegraph.pl or speedscope"""
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(
+                f"{';'.join(stack)} {count}\n"
+                for stack, count in self.stacks.most_common()
+            )
+
+    def top_functions(self, limit: int = 20) -> list[tuple[str, int]]:
+        """functions on top of the stack most often, i.e. by self time"""
+        functions: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            functions[stack[-1]] += count
+        return functions.most_common(limit)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes a sleeping task, which is how long
+    something blocked the loop
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self._interval = interval
+        self.samples: list[float] = []
+
+    async def run(self):
+        """measure until cancelled"""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self._interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self._interval))
+
+    def percentiles(self) -> dict[str, float]:
+        """p50, p90, p99 and max lag in seconds"""
+        if len(self.samples) < 2:
+            return {}
+        quantiles = statistics.quantiles(self.samples, n=100, method="inclusive")
+        return {
+            "p50": quantiles[49],
+            "p90": quantiles[89],
+            "p99": quantiles[98],
+            "max": max(self.samples),
+        }
+
+
+def _module_names() -> dict[str, str]:
+    """source file to module name of every imported module"""
+    return {
+        os.path.abspath(path): name
+        for name, module in list(sys.modules.items())
+        if (path := getattr(module, "__file__", None))
+    }
+
+
+def allocations_by_module(
+    snapshot: tracemalloc.Snapshot, limit: int = 20
+) -> list[tuple[str, int, int]]:
+    """(module, bytes, blocks) of the memory still allocated, largest first"""
+    modules = _module_names()
+    sizes: Counter[str] = Counter()
+    blocks: Counter[str] = Counter()
+    for stat in snapshot.statistics("filename"):
+        filename = stat.traceback[0].filename
+        module = modules.get(os.path.abspath(filename), filename)
+        sizes[module] += stat.size
+        blocks[module] += stat.count
+    return [(module, size, blocks[module]) for module, size in sizes.most_common(limit)]
+
+
+def write_report(
+    path: str,
+    sampler: StackSampler,
+    snapshot: tracemalloc.Snapshot,
+    peak: int,
+    lag: LoopLagMonitor,
+    limit: int = 20,
+):
+    """human readable report of the cpu, memory and loop lag profiles"""
+    total = sum(sampler.stacks.values()) or 1
+    lines = ["cpu, by self samples"]
+    for name, count in sampler.top_functions(limit):
+        lines.append(f"  {count / total:6.1%} {count:8d}  {name}")
+    lines += ["", f"memory allocated at the end by module, peak {peak / 2**20:.1f} MiB"]
+    for module, size, count in allocations_by_module(snapshot, limit):
+        lines.append(f"  {size / 2**20:9.2f} MiB {count:9d} blocks  {module}")
+    lines += ["", "memory allocated at the end by line"]
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"  {stat.size / 2**20:9.2f} MiB {stat.count:9d} blocks  "
+            f"{frame.filename}:{frame.lineno}"
+        )
+    lines += ["", f"event loop lag over {len(lag.samples)} samples"]
+    for name, value in lag.percentiles().items():
+        lines.append(f"  {name:>4} {value * 1000:8.2f} ms")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+async def profiled[T](coro: Coroutine[Any, Any, T], directory: str) -> T:
+    """
+    Run a coroutine under the profilers, writing `cpu.collapsed` and
+    `report.txt` to `directory` once it finishes, even if it fails
+    """
+    os.makedirs(directory, exist_ok=True)
+    sampler, lag = StackSampler(), LoopLagMonitor()
+    tracemalloc.start()
+    sampler.start()
+    monitor = asyncio.create_task(lag.run())
+    try:
+        return await coro
+    finally:
+        monitor.cancel()
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sampler.write_collapsed(os.path.join(directory, "cpu.collapsed"))
+        write_report(
+            os.path.join(directory, "report.txt"), sampler, snapshot, peak, lag
+        )
+        logging.info("profiles written to %s", directory)
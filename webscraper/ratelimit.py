@@ -0,0 +1,204 @@
+"""
+Adaptive per host rate limiting.
+Each host gets a token bucket (requests per second) and an AIMD
+concurrency window, both shrink on 429's / Retry-After and grow back
+while responses are healthy
+"""
+
+import asyncio
+from collections import deque
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import logging
+import math
+import time
+
+import httpx
+
+from .settings import HttpClientSettings, get_http_client_settings
+
+
+def parse_retry_after(value: str | None, max_delay: float) -> float | None:
+    """
+    Parse a Retry-After header, either delay seconds or a http date,
+    capped at `max_delay` so one response can't stall a host for good
+    """
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=UTC)
+        delay = (retry_at - datetime.now(UTC)).total_seconds()
+    if not math.isfinite(delay):  # e.g. "inf" or "nan"
+        return None
+    return min(max(0.0, delay), max_delay)
+
+
+class HostLimiter:
+    """
+    Token bucket plus AIMD concurrency window for a single host
+    """
+
+    def __init__(self, host: str, settings: HttpClientSettings):
+        self.host = host
+        self._settings = settings
+        self.window = float(settings.host_initial_window)
+        self.rate = float(settings.host_initial_rate)
+        self.in_flight = 0
+        self.throttled = 0
+        self._sent = 0  # requests let through so far, numbering each one
+        self._cut_after = 0  # the last request sent before the window was last cut
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    def _refill(self, now: float):
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def _wait_for_slot(self):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def _wake(self):
+        """wake as many waiters as there are free slots in the window"""
+        free = int(self.window) - self.in_flight
+        while free > 0 and self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                free -= 1
+
+    async def acquire(self) -> int:
+        """
+        Wait until the host is not blocked, there is room in the window
+        and a token in the bucket, returning the request's number for `release`
+        """
+        while True:
+            now = time.monotonic()
+            if self._blocked_until > now:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            if self.in_flight >= int(self.window):
+                await self._wait_for_slot()
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            self._tokens -= 1
+            self.in_flight += 1
+            self._sent += 1
+            return self._sent
+
+    def release(self, response: httpx.Response | None, sent: int):
+        """
+        Free the slot of request number `sent` and adjust the window and rate
+        from the response. `None` means the request failed before a response
+        came back
+        """
+        self.in_flight -= 1
+        if response is not None and response.status_code == 429:
+            retry_after = parse_retry_after(
+                response.headers.get("Retry-After"), self._settings.retry_after_max
+            )
+            self._decrease(retry_after, sent)
+        elif response is not None:
+            self._increase()
+        self._wake()
+
+    def _increase(self):
+        """additive increase, spread over a full window of responses"""
+        settings = self._settings
+        self.window = min(
+            float(settings.host_max_window),
+            self.window + settings.host_window_increase / max(self.window, 1),
+        )
+        self.rate = min(
+            settings.host_max_rate,
+            self.rate + settings.host_rate_increase / max(self.window, 1),
+        )
+
+    def _decrease(self, retry_after: float | None, sent: int):
+        """
+        multiplicative decrease, and stop all requests until Retry-After.
+        Like TCP, the window is cut at most once per window of requests: only
+        requests sent after the last cut can cut it again, not the rest of a
+        burst of 429's which were already in flight
+        """
+        settings = self._settings
+        self.throttled += 1
+        if retry_after:
+            self._blocked_until = max(
+                self._blocked_until, time.monotonic() + retry_after
+            )
+        if sent <= self._cut_after:
+            return
+        self._cut_after = self._sent
+        self.window = max(
+            float(settings.host_min_window), self.window * settings.host_decrease_factor
+        )
+        self.rate = max(
+            settings.host_min_rate, self.rate * settings.host_decrease_factor
+        )
+        self._tokens = min(self._tokens, 0.0)
+        logging.info(
+            "host %s throttled, window %.1f, rate %.1f/s, retry after %s",
+            self.host,
+            self.window,
+            self.rate,
+            retry_after,
+        )
+
+    def snapshot(self) -> dict:
+        """current state of the limiter"""
+        return {
+            "window": round(self.window, 2),
+            "rate": round(self.rate, 2),
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+        }
+
+
+class RateController:
+    """
+    Shares a limiter per host between every worker using the client
+    """
+
+    def __init__(self, settings: HttpClientSettings):
+        self._settings = settings
+        self._hosts: dict[str, HostLimiter] = {}
+
+    def for_host(self, host: str) -> HostLimiter:
+        """get or create the limiter for a host"""
+        if host not in self._hosts:
+            self._hosts[host] = HostLimiter(host, self._settings)
+        return self._hosts[host]
+
+    def snapshot(self, host: str | None = None) -> dict[str, dict]:
+        """window and rate per host, optionally for a single host"""
+        return {
+            name: limiter.snapshot()
+            for name, limiter in self._hosts.items()
+            if host is None or name == host
+        }
+
+
+@lru_cache
+def get_rate_controller():
+    """cached app global rate controller"""
+    return RateController(get_http_client_settings())
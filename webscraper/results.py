@@ -0,0 +1,152 @@
+"""
+Streamed NDJSON results.
+A header record for the scrape event, one record per visited page as the
+workers finish them, records of statuses set outside of a page, e.g. while
+seeding from sitemaps, and a summary trailer once the crawl is done.
+The usual json results can be rebuilt from the stream with `read_ndjson_results`
+"""
+
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+from typing import TextIO
+
+from .definitions import ScrapeEventSettings, Status
+
+
+class NdjsonWriter:
+    """
+    Appends records to a file from a background thread.
+    Records are buffered and handed over in batches, once `batch_size` are
+    waiting or `flush_interval` seconds have passed, so the event loop never
+    waits on encoding or disk
+    """
+
+    def __init__(self, path: str, batch_size: int = 256, flush_interval: float = 1):
+        # appending, so a resumed crawl carries on in the same file, which is
+        # held open by the writer for every batch until `close`
+        self._file = open(  # noqa: SIM115  # pylint: disable=consider-using-with
+            path, "a", encoding="utf-8"
+        )
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="ndjson")
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._buffer: list[dict] = []
+
+    def write(self, record: dict):
+        """queue a record, the dict must not be changed afterwards"""
+        self._buffer.append(record)
+        if (
+            len(self._buffer) >= self._batch_size
+            or time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            self.flush()
+
+    def write_event(self, settings: ScrapeEventSettings):
+        """header record, written whenever a crawl of the event starts"""
+        self.write(
+            {
+                "type": "event",
+                "id": str(settings.id_),
+                "base_url": settings.base_url,
+                "max_depth": settings.max_depth,
+            }
+        )
+
+    def write_page(
+        self,
+        url: str,
+        status: Status,
+        depth: int,
+        links: list[str],
+        discovered: dict[str, Status],
+        started: float,
+        elapsed: float,
+    ):
+        """
+        record of a visited page. `discovered` holds the links whose status
+        the page set, so statuses of urls that are never visited can be rebuilt
+        """
+        self.write(
+            {
+                "type": "page",
+                "url": url,
+                "status": status,
+                "depth": depth,
+                "links": links,
+                "discovered": discovered,
+                "timings": {"started": started, "elapsed": elapsed},
+            }
+        )
+
+    def write_statuses(self, statuses: dict[str, Status]):
+        """record of statuses set outside of a visited page, e.g. while seeding"""
+        if statuses:
+            self.write({"type": "statuses", "statuses": statuses})
+
+    def write_summary(self, counts: dict, extras: dict):
+        """trailer record with the final counts and extra stats"""
+        self.write({"type": "summary", **counts, **extras})
+
+    def _write_lines(self, records: list[dict]):
+        self._file.write("".join(f"{json.dumps(record)}\n" for record in records))
+        self._file.flush()
+
+    def flush(self):
+        """hand the buffered records to the writer thread"""
+        if self._buffer:
+            records, self._buffer = self._buffer, []
+            self._executor.submit(self._write_lines, records)
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """write everything still buffered and close the file"""
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._file.close()
+
+
+def read_ndjson_results(lines: Iterable[str]) -> dict:
+    """
+    Rebuild the json results from a results stream, in the same shape as
+    `scraper.get_results`. Works on streams without a summary too,
+    e.g. from a crawl that was killed, pages in flight are then left pending
+    """
+    statuses: dict[str, Status] = {}
+    extras: dict = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record["type"] == "event":
+            statuses.setdefault(record["base_url"], Status.PENDING)
+        elif record["type"] == "page":
+            for url, status in record["discovered"].items():
+                statuses[url] = Status(status)
+            statuses[record["url"]] = Status(record["status"])
+        elif record["type"] == "statuses":
+            for url, status in record["statuses"].items():
+                statuses[url] = Status(status)
+        elif record["type"] == "summary":
+            extras = {
+                key: value
+                for key, value in record.items()
+                if key not in ("type", "counts", "total_count")
+            }
+
+    by_status: dict[Status, list[str]] = {status: [] for status in Status}
+    for url, status in statuses.items():
+        by_status[status].append(url)
+    return {
+        "counts": {status: len(urls) for status, urls in by_status.items()},
+        "total_count": len(statuses),
+        "status": by_status,
+        **extras,
+    }
+
+
+def convert_ndjson_results(source: TextIO, destination: TextIO):
+    """write the json results rebuilt from a results stream"""
+    json.dump(read_ndjson_results(source), destination)
@@ -0,0 +1,304 @@
+"""
+robots.txt rules and sitemap seeding.
+robots.txt is fetched once per origin before its first page is requested,
+its rules are applied when validating links and again before fetching them,
+for links found before their origin's robots.txt was, and its Crawl-delay
+when scheduling requests.
+Sitemaps, including sitemap indexes and gzipped sitemaps, are stream parsed
+so the frontier can be seeded with every listed page up front
+"""
+
+import asyncio
+from collections import deque
+from collections.abc import AsyncGenerator
+from contextlib import aclosing
+from functools import lru_cache
+import logging
+import re
+import time
+from urllib.parse import quote, urlsplit
+from uuid import UUID
+import xml.etree.ElementTree as ET
+import zlib
+
+import httpx
+
+from .settings import get_http_client_settings
+from .urls import QUERY_SAFE
+
+MAX_ROBOTS_BYTES = 512 * 1024  # RFC 9309 asks for at least 500 KiB to be parsed
+MAX_SITEMAP_BYTES = 64 * 1024 * 1024  # after decompression, sitemaps are at most 50 MB
+MAX_SITEMAPS = 1000  # sitemap files read per crawl, through sitemap indexes
+
+
+@lru_cache(maxsize=65536)
+def origin_of(url: str) -> str:
+    """scheme and host of a normalized url, robots.txt applies per origin"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _path_of(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def _pattern_regex(pattern: str) -> re.Pattern:
+    """`*` matches anything and a trailing `$` anchors the end"""
+    anchored = pattern.endswith("$")
+    pattern = quote(pattern[:-1] if anchored else pattern, safe=QUERY_SAFE)
+    regex = re.escape(pattern).replace(r"\*", ".*")
+    return re.compile(regex + ("$" if anchored else ""))
+
+
+class RobotsRules:
+    """
+    The rules of a robots.txt group. The longest matching rule wins,
+    and allow wins a tie (RFC 9309)
+    """
+
+    def __init__(
+        self,
+        rules: list[tuple[str, bool]] | None = None,
+        crawl_delay: float | None = None,
+        sitemaps: list[str] | None = None,
+    ):
+        ordered = sorted(rules or (), key=lambda rule: (len(rule[0]), rule[1]))
+        self._rules = [
+            (_pattern_regex(path), allow) for path, allow in reversed(ordered)
+        ]
+        self.crawl_delay = crawl_delay
+        self.sitemaps = sitemaps or []
+        self.allowed = lru_cache(maxsize=65536)(self._allowed)
+
+    def _allowed(self, url: str) -> bool:
+        """whether a normalized url may be fetched"""
+        path = _path_of(url)
+        for regex, allow in self._rules:
+            if regex.match(path):
+                return allow
+        return True
+
+
+class _Group:
+    def __init__(self):
+        self.agents: list[str] = []
+        self.rules: list[tuple[str, bool]] = []
+        self.crawl_delay: float | None = None
+
+
+def parse_robots(text: str, user_agent: str) -> RobotsRules:
+    """
+    Parse a robots.txt, keeping the groups for `user_agent`'s product token
+    or the `*` groups if there are none
+    """
+    groups: list[_Group] = []
+    sitemaps: list[str] = []
+    group: _Group | None = None
+    in_agents = False
+    for line in text.splitlines():
+        field, _, value = line.split("#", 1)[0].partition(":")
+        field, value = field.strip().lower(), value.strip()
+        if field == "user-agent":
+            if group is None or not in_agents:
+                group = _Group()
+                groups.append(group)
+            group.agents.append(value.lower())
+            in_agents = True
+            continue
+        in_agents = False
+        if field == "sitemap" and value:
+            sitemaps.append(value)
+        elif group is None:
+            continue
+        elif field in ("allow", "disallow") and value:  # an empty disallow allows all
+            group.rules.append((value, field == "allow"))
+        elif field == "crawl-delay":
+            try:
+                group.crawl_delay = max(0.0, float(value))
+            except ValueError:
+                pass
+
+    token = user_agent.split("/", 1)[0].lower()
+    matched = [group for group in groups if token in group.agents] or [
+        group for group in groups if "*" in group.agents
+    ]
+    delays = [group.crawl_delay for group in matched if group.crawl_delay is not None]
+    return RobotsRules(
+        [rule for group in matched for rule in group.rules],
+        max(delays) if delays else None,
+        sitemaps,
+    )
+
+
+class RobotsCache:
+    """
+    robots.txt rules per origin, fetched once, and the Crawl-delay
+    schedule of each origin. `delay_scale` stretches Crawl-delay for when
+    several processes crawl the same origin independently.
+    The scrape events using each origin are kept so it can be forgotten
+    once none of them are left
+    """
+
+    def __init__(self, user_agent: str, delay_scale: float = 1):
+        self._user_agent = user_agent
+        self.delay_scale = delay_scale
+        self._rules: dict[str, RobotsRules] = {}
+        self._loading: dict[str, asyncio.Task] = {}
+        self._next_request: dict[str, float] = {}
+        self._events: dict[str, set[UUID]] = {}
+
+    async def load(
+        self, client: httpx.AsyncClient, origin: str, event: UUID | None = None
+    ) -> RobotsRules:
+        """
+        fetch and parse an origin's robots.txt, unless it already has been,
+        once however many workers ask for it at the same time
+        """
+        if event is not None:
+            self._events.setdefault(origin, set()).add(event)
+        if (rules := self._rules.get(origin)) is not None:
+            return rules
+        if (loading := self._loading.get(origin)) is None:
+            loading = asyncio.create_task(self._fetch(client, origin))
+            self._loading[origin] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(origin, None))
+        # a worker cancelled while waiting leaves the fetch to the others
+        return await asyncio.shield(loading)
+
+    async def _fetch(self, client: httpx.AsyncClient, origin: str) -> RobotsRules:
+        try:
+            async with client.stream("GET", f"{origin}/robots.txt") as response:
+                if response.status_code >= 500:
+                    # unreachable, so assume everything is disallowed (RFC 9309)
+                    rules = RobotsRules([("/", False)])
+                elif response.status_code >= 400:
+                    rules = RobotsRules()
+                else:
+                    body = b""
+                    async for chunk in response.aiter_bytes():
+                        body += chunk
+                        if len(body) >= MAX_ROBOTS_BYTES:
+                            break
+                    text = body[:MAX_ROBOTS_BYTES].decode("utf-8", "replace")
+                    rules = parse_robots(text, self._user_agent)
+        except httpx.HTTPError:
+            logging.warning("failed to fetch robots.txt for %s, allowing all", origin)
+            rules = RobotsRules()
+        self._rules[origin] = rules
+        return rules
+
+    def forget(self, event: UUID):
+        """
+        drop the rules of the origins a finished scrape event was the last to
+        use. A Crawl-delay turn still to come is kept, so forgetting an origin
+        never lets a request through early
+        """
+        now = time.monotonic()
+        for origin, events in list(self._events.items()):
+            events.discard(event)
+            if events:
+                continue
+            del self._events[origin]
+            self._rules.pop(origin, None)
+            if self._next_request.get(origin, now) <= now:
+                self._next_request.pop(origin, None)
+
+    def allowed(self, url: str) -> bool:
+        """
+        whether a normalized url may be fetched. Urls of origins not loaded
+        yet are, `load` them before fetching
+        """
+        rules = self._rules.get(origin_of(url))
+        return rules is None or rules.allowed(url)
+
+    async def wait_turn(self, url: str):
+        """wait out the origin's Crawl-delay, spacing requests from every worker"""
+        origin = origin_of(url)
+        rules = self._rules.get(origin)
+        if rules is None or not rules.crawl_delay:
+            return
+        now = time.monotonic()
+        turn = max(now, self._next_request.get(origin, now))
+        self._next_request[origin] = turn + rules.crawl_delay * self.delay_scale
+        if turn > now:
+            await asyncio.sleep(turn - now)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+async def _read_sitemap(
+    client: httpx.AsyncClient, url: str
+) -> AsyncGenerator[tuple[str, str], None]:
+    """
+    Yield ("url", loc) for pages and ("sitemap", loc) for the sitemaps of an
+    index, parsing the sitemap as it downloads and dropping each entry once read
+    """
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        parser: ET.XMLPullParser = ET.XMLPullParser(events=("start", "end"))
+        decompressor = None
+        root: ET.Element | None = None
+        size = 0
+        async for chunk in response.aiter_bytes():
+            if root is None and decompressor is None and chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(wbits=31)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            size += len(chunk)
+            parser.feed(chunk)
+            entries = []
+            for item in parser.read_events():
+                event, element = item[0], item[-1]
+                if not isinstance(element, ET.Element):
+                    continue
+                if event == "start":
+                    root = element if root is None else root
+                    continue
+                if (kind := _local_name(element.tag)) in ("url", "sitemap"):
+                    if loc := (element.findtext("{*}loc") or "").strip():
+                        entries.append((kind, loc))
+                    if root is not None and element in root:
+                        root.remove(element)  # keep memory flat on huge sitemaps
+            for entry in entries:
+                yield entry
+            if size >= MAX_SITEMAP_BYTES:
+                logging.warning("sitemap %s is too large, stopped reading it", url)
+                return
+
+
+async def iter_sitemap_urls(
+    client: httpx.AsyncClient, sitemaps: list[str], max_urls: int
+) -> AsyncGenerator[str, None]:
+    """
+    Yield up to `max_urls` page urls from sitemaps, following sitemap indexes
+    """
+    pending = deque(sitemaps)
+    seen = set(sitemaps)
+    found = 0
+    for _ in range(MAX_SITEMAPS):
+        if not pending:
+            return
+        sitemap = pending.popleft()
+        try:
+            async with aclosing(_read_sitemap(client, sitemap)) as entries:
+                async for kind, loc in entries:
+                    if kind == "sitemap":
+                        if loc not in seen:
+                            seen.add(loc)
+                            pending.append(loc)
+                        continue
+                    yield loc
+                    found += 1
+                    if found >= max_urls:
+                        return
+        except (httpx.HTTPError, ET.ParseError, zlib.error) as e:
+            logging.warning("failed to read sitemap %s: %s", sitemap, e)
+
+
+@lru_cache
+def get_robots_cache():
+    """cached app global robots.txt cache"""
+    return RobotsCache(get_http_client_settings().user_agent)
@@ -0,0 +1,99 @@
+"""
+Crawl scope.
+The allow / deny rules of a scrape event are compiled once into a single
+matcher, so checking a link is a host lookup, a `str.startswith` over every
+path prefix and one regex search over every pattern. Query params which don't
+change the page are stripped earlier, by the url normalizer in urls.py
+"""
+
+from collections.abc import Iterable
+from functools import lru_cache
+import re
+
+from .definitions import Status
+from .settings import get_core_settings
+from .urls import url_extension, url_host
+
+
+def _any_of(patterns: Iterable[str]) -> re.Pattern | None:
+    """one regex matching wherever any of the patterns would, None if there are none"""
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+
+
+def _path(key: str) -> str:
+    """path and query of a normalized url, which always has a path"""
+    return key[key.index("/", key.index("//") + 2) :]
+
+
+class Scope:
+    """
+    Which normalized urls a scrape event crawls:
+    - on `host`, one of `allow_hosts`, or a subdomain of `host` with `subdomains`
+    - with a path starting with one of `allow_paths`, if there are any,
+      and none of `deny_paths`
+    - matching one of `allow_patterns` anywhere, if there are any,
+      and none of `deny_patterns`
+    - without one of `skip_extensions`, which are SKIPPED rather than IGNORED
+    """
+
+    def __init__(
+        self,
+        host: str,
+        subdomains: bool = False,
+        allow_hosts: Iterable[str] = (),
+        allow_paths: Iterable[str] = (),
+        deny_paths: Iterable[str] = (),
+        allow_patterns: Iterable[str] = (),
+        deny_patterns: Iterable[str] = (),
+        skip_extensions: Iterable[str] = (),
+    ):
+        self._hosts = frozenset({host.lower(), *(h.lower() for h in allow_hosts)})
+        self._subdomain_suffix = f".{host.lower()}" if subdomains else None
+        self._allow_paths = tuple(allow_paths)
+        self._deny_paths = tuple(deny_paths)
+        self._allow = _any_of(allow_patterns)
+        self._deny = _any_of(deny_patterns)
+        self._skip_extensions = frozenset(skip_extensions)
+
+    def host_allowed(self, host: str) -> bool:
+        """whether urls on a host are crawled"""
+        return host in self._hosts or (
+            self._subdomain_suffix is not None and host.endswith(self._subdomain_suffix)
+        )
+
+    def check(self, key: str) -> Status | None:
+        """the status of a normalized url which shouldn't be scraped, else None"""
+        if not self.host_allowed(url_host(key)):
+            return Status.IGNORED
+        if self._allow_paths or self._deny_paths:
+            path = _path(key)
+            if self._allow_paths and not path.startswith(self._allow_paths):
+                return Status.IGNORED
+            if self._deny_paths and path.startswith(self._deny_paths):
+                return Status.IGNORED
+        if self._allow is not None and self._allow.search(key) is None:
+            return Status.IGNORED
+        if self._deny is not None and self._deny.search(key) is not None:
+            return Status.IGNORED
+        if url_extension(key) in self._skip_extensions:
+            return Status.SKIPPED
+        return None
+
+
+@lru_cache
+def get_scope(host: str) -> Scope:
+    """scope of the scrape events of a host, compiled once from the core settings"""
+    settings = get_core_settings()
+    return Scope(
+        host,
+        settings.scope_subdomains,
+        settings.scope_allow_hosts,
+        settings.scope_allow_paths,
+        settings.scope_deny_paths,
+        settings.scope_allow_patterns,
+        settings.scope_deny_patterns,
+        settings.skip_extensions,
+    )
@@ -3,151 +3,836 @@ Logic for scraping endpoints given a starting point
 """
 
 import asyncio
+from collections.abc import Callable, Iterable
+from contextlib import nullcontext
+import json
 import logging
+import random
 import signal
+import time
+from typing import TextIO
 from urllib.parse import urljoin
 from uuid import UUID, uuid4
-from bs4 import BeautifulSoup
-from pydantic import HttpUrl, ValidationError
 import httpx
 
-from webscraper.settings import get_core_settings
+from webscraper.settings import LinkExtractor, get_core_settings
+from .parsing import LinkParser, StreamingLinkExtractor, get_link_parser, stream_hrefs
+from .ratelimit import get_rate_controller
 from .utils import get_httpx_client
-from .definitions import Status, ScrapeEventSettings
-from .datastore import Db, get_db
+from .definitions import Checkpoint, Status, ScrapeEventSettings
+from .autoscale import WorkerPool
+from .checkpoint import (
+    checkpoint_periodically,
+    read_checkpoint,
+    restore_checkpoint,
+    save_checkpoint,
+    take_checkpoint,
+)
+from .datastore import Db, SeenSetDb, get_db
+from .frontier import Frontier, get_frontier
+from .fingerprint import DuplicateContent, PageFingerprint, get_content_index
+from .httpcache import get_response_cache
+from .linkgraph import LinkGraph
+from .metrics import Stage, get_metrics, log_metrics_periodically, serve_metrics
+from .results import NdjsonWriter
+from .robots import RobotsRules, get_robots_cache, iter_sitemap_urls, origin_of
+from .scope import get_scope
+from .urls import get_url_normalizer, normalize_url, url_host
 
+SITEMAP_BATCH_SIZE = 1000  # sitemap urls validated at once
 
-async def _fetch_page(
-    url: HttpUrl, client: httpx.AsyncClient, settings: ScrapeEventSettings, db: Db
-) -> str:
+
+def _skip_reason(response: httpx.Response) -> str | None:
     """
-    fetch page content
+    Why a response can't be worth reading, from its headers alone.
+    Responses without a Content-Type are given the benefit of the doubt
     """
-    try:
-        response = await client.get(url.encoded_string())
-        response.raise_for_status()
-        db.set_url_status(settings.id_, url, Status.SUCCESS)
-        return response.text
-    except httpx.HTTPError:
-        logging.exception("Failed to fetch %s", url)
-        db.set_url_status(settings.id_, url, Status.FAILED)
-        return ""
+    settings = get_core_settings()
+    content_type = response.headers.get("Content-Type")
+    if content_type is not None:
+        mime_type = content_type.partition(";")[0].strip().lower()
+        if mime_type not in settings.html_content_types:
+            return f"content type {mime_type}"
+    content_length = response.headers.get("Content-Length", "")
+    if content_length.isdigit() and int(content_length) > settings.max_page_bytes:
+        return f"{content_length} bytes"
+    return None
 
 
-def _extract_links(html: str, current_url: HttpUrl):
+async def _capped_body(response: httpx.Response):
+    """
+    The body's chunks up to `max_page_bytes`, the rest is never downloaded.
+    For bodies without a Content-Length, links past the cap are lost
+    """
+    remaining = get_core_settings().max_page_bytes
+    async for chunk in response.aiter_bytes():
+        if len(chunk) >= remaining:
+            if chunk := chunk[:remaining]:
+                yield chunk
+            logging.info("%s is too large, only read the first part", response.url)
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _resolve_links(hrefs: list[str], current_url: str, base_href: str | None = None):
+    """
+    Resolve hrefs against the page they were found on, or its `<base href>`,
+    into normalized url keys
+    """
+    base = urljoin(current_url, base_href) if base_href else current_url
+    normalizer = get_url_normalizer()
+    for href in hrefs:
+        if (url := normalizer.resolve(href, base)) is None:
+            logging.debug("invalid href %s, continuing...", href)
+            continue
+        yield url
+
+
+def _extract_links(html: bytes | str, current_url: str):
     """
     Extract links from page
     """
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup.find_all("a", href=True):
-        url: str = urljoin(current_url.encoded_string(), tag["href"])  # type:ignore
-        try:
-            yield HttpUrl(url)
-        except ValidationError:
-            logging.debug("invalid href %s, continuing...", url)
+    hrefs, base_href = stream_hrefs(html)
+    yield from _resolve_links(hrefs, current_url, base_href)
 
 
-def validate_next_steps(settings: ScrapeEventSettings, url: str, depth: int):
+async def _response_links(
+    response: httpx.Response,
+    url: str,
+    settings: ScrapeEventSettings,
+    parser: LinkParser,
+):
+    """
+    Yield the links of a response with the configured extractor, either
+    streamed out of the body as it arrives or parsed from the whole page.
+    With content dedup on, the page is fingerprinted first and links are only
+    resolved once it is known not to be a duplicate, else DuplicateContent is raised.
+    Only time spent extracting links counts towards the parse stage,
+    not downloading or the caller's handling of each link
     """
-    Get the next status for an event
+    streaming = get_core_settings().link_extractor == LinkExtractor.STREAM
+    parse_time = 0.0
+    try:
+        if not get_core_settings().dedup_content:
+            if streaming:
+                extractor = StreamingLinkExtractor(response.charset_encoding)
+                async for chunk in _capped_body(response):
+                    tick = time.perf_counter()
+                    links = list(
+                        _resolve_links(extractor.feed(chunk), url, extractor.base_href)
+                    )
+                    parse_time += time.perf_counter() - tick
+                    for link in links:
+                        yield link
+                return
+            content = b"".join([chunk async for chunk in _capped_body(response)])
+            tick = time.perf_counter()
+            hrefs, base_href = await parser.extract_hrefs(content)
+            links = list(_resolve_links(hrefs, url, base_href))
+            parse_time += time.perf_counter() - tick
+            for link in links:
+                yield link
+            return
+
+        fingerprint = PageFingerprint()
+        if streaming:
+            # raw hrefs are cheap to hold on to, resolving them is the costly part
+            extractor = StreamingLinkExtractor(response.charset_encoding)
+            raw_hrefs: list[str] = []
+            async for chunk in _capped_body(response):
+                tick = time.perf_counter()
+                fingerprint.update(chunk)
+                raw_hrefs.extend(extractor.feed(chunk))
+                parse_time += time.perf_counter() - tick
+            tick = time.perf_counter()
+            original = get_content_index().duplicate_of(settings.id_, url, fingerprint)
+            parse_time += time.perf_counter() - tick
+            if original:
+                raise DuplicateContent(original)
+            hrefs, base_href = raw_hrefs, extractor.base_href
+        else:
+            content = b"".join([chunk async for chunk in _capped_body(response)])
+            tick = time.perf_counter()
+            fingerprint.update(content)
+            original = get_content_index().duplicate_of(settings.id_, url, fingerprint)
+            parse_time += time.perf_counter() - tick
+            if original:
+                raise DuplicateContent(original)  # without ever parsing the page
+            tick = time.perf_counter()
+            hrefs, base_href = await parser.extract_hrefs(content)
+            parse_time += time.perf_counter() - tick
+        tick = time.perf_counter()
+        links = list(_resolve_links(hrefs, url, base_href))
+        parse_time += time.perf_counter() - tick
+        for link in links:
+            yield link
+    finally:
+        get_metrics().observe(Stage.PARSE, url_host(url), settings.id_, parse_time)
+
+
+async def _page_links(
+    url: str,
+    client: httpx.AsyncClient,
+    settings: ScrapeEventSettings,
+    db: Db,
+    parser: LinkParser,
+):
+    """
+    Fetch a page and yield its links. Pages in the response cache are
+    requested conditionally, and their cached links reused on a 304.
+    The robots.txt of the page's origin is loaded first, if it hasn't been,
+    so pages on other hosts in scope keep to their own rules too
     """
+    if get_core_settings().respect_robots:
+        robots = get_robots_cache()
+        rules = await robots.load(client, origin_of(url), settings.id_)
+        if not rules.allowed(url):
+            logging.info("%s is disallowed by robots.txt, skipping it", url)
+            db.set_url_status(settings.id_, url, Status.IGNORED)
+            return
+        await robots.wait_turn(url)  # Crawl-delay
+    cache = get_response_cache()
+    cached = cache.lookup(settings.id_, url) if cache else None
+    links: list[str] = []
+    start = time.perf_counter()
     try:
-        parsed_url = HttpUrl(url)
-    except ValidationError:
+        async with client.stream(
+            "GET",
+            url,
+            headers=cached.headers() if cached else None,
+            # lets the transport label retries with the scrape event
+            extensions={"scrape_event": settings.id_},
+        ) as response:
+            get_metrics().observe(
+                Stage.FETCH, url_host(url), settings.id_, time.perf_counter() - start
+            )
+            if cache and cached and response.status_code == 304:
+                cache.not_modified(settings.id_)
+                db.set_url_status(settings.id_, url, Status.SUCCESS)
+                for link in cached.links:
+                    yield link
+                return
+
+            response.raise_for_status()
+            if (reason := _skip_reason(response)) is not None:
+                # leaving without reading the body aborts the download
+                logging.info("skipping %s, %s", url, reason)
+                db.set_url_status(settings.id_, url, Status.SKIPPED)
+                return
+            db.set_url_status(settings.id_, url, Status.SUCCESS)
+            async for link in _response_links(response, url, settings, parser):
+                links.append(link)
+                yield link
+    except httpx.HTTPError:
+        logging.exception("Failed to fetch %s", url)
+        db.set_url_status(settings.id_, url, Status.FAILED)
+        return
+    except DuplicateContent as duplicate:
+        logging.info(
+            "%s is a duplicate of %s, skipping its links", url, duplicate.original
+        )
+        db.set_url_status(settings.id_, url, Status.DUPLICATE)
+        return
+
+    if cache:
+        cache.store(url, response.headers, links)
+
+
+def _check_link(settings: ScrapeEventSettings, url: str, depth: int) -> Status | None:
+    """the status of a link which shouldn't be scraped, else None"""
+    if (key := normalize_url(url)) is None:
         logging.debug("invalid url, settings ignored.")
         return Status.IGNORED
 
-    db = get_db()
     if depth > settings.max_depth:
         logging.debug("max depth reached, settings ignored.")
         return Status.IGNORED
 
-    if parsed_url.host != settings.base_url.host:
-        logging.debug(
-            "url %s on a different domain to base url %s, setting ignored.",
-            parsed_url.host,
-            settings.base_url.host,
-        )
+    if (status := get_scope(settings.host).check(key)) is not None:
+        logging.debug("url %s out of scope, setting %s.", key, status)
+        return status
+
+    if get_core_settings().respect_robots and not get_robots_cache().allowed(key):
+        logging.debug("url %s disallowed by robots.txt, setting ignored.", key)
         return Status.IGNORED
+    return None
+
+
+def validate_next_steps(settings: ScrapeEventSettings, url: str, depth: int):
+    """
+    Get the next status for an event.
+    Links from the scraper are already normalized so this is a cache hit
+    """
+    if (status := _check_link(settings, url, depth)) is not None:
+        return status
 
-    if (status := db.get_url_status(settings.id_, url)) != Status.MISSING:
+    if (status := get_db().get_url_status(settings.id_, url)) != Status.MISSING:
         logging.debug("url %s is already worked on, keeping status the same...", url)
-        ## inefficient resetting of this key - extra unneccesary transaction but makes code cleaner
         return status
 
     return Status.PENDING
 
 
+def record_links(
+    settings: ScrapeEventSettings, urls: Iterable[str], depth: int
+) -> dict[str, Status]:
+    """
+    Validate the normalized links found on a page at `depth` in one go, with a
+    single status lookup and write, and record the status of the new ones.
+    Known links keep their status, unless ignored before and in scope now,
+    e.g. found again closer to the base url. Returns the statuses recorded,
+    so only the PENDING ones need queueing
+    """
+    db = get_db()
+    unique = dict.fromkeys(urls)  # dedup within the page, keeping order
+    known = db.get_url_statuses(settings.id_, unique)
+    scope = get_scope(settings.host)
+    robots = get_robots_cache() if get_core_settings().respect_robots else None
+    too_deep = depth > settings.max_depth
+    recorded: dict[str, Status] = {}
+    for url in unique:
+        previous = known.get(url, Status.MISSING)
+        if previous not in (Status.MISSING, Status.IGNORED):
+            continue  # queued or worked on already
+        status: Status | None = Status.IGNORED if too_deep else scope.check(url)
+        if status is None:
+            allowed = robots is None or robots.allowed(url)
+            status = Status.PENDING if allowed else Status.IGNORED
+        if status != previous:
+            recorded[url] = status
+    db.set_url_statuses(settings.id_, recorded)
+    return recorded
+
+
+def queue_links(
+    settings: ScrapeEventSettings, queue: Frontier, urls: Iterable[str], depth: int
+) -> dict[str, Status]:
+    """record the links found on a page at `depth`, queueing the new ones"""
+    recorded = record_links(settings, urls, depth)
+    queue.put_many(
+        (url, depth + 1) for url, status in recorded.items() if status == Status.PENDING
+    )
+    return recorded
+
+
+def log_visited(url: str, status: Status, depth: int, links: list[str], elapsed: float):
+    """
+    One structured record per page, holding the number of links found,
+    and the links themselves for a `log_links_sample_rate` share of pages
+    """
+    fields: dict = {"url": url, "status": status, "depth": depth}
+    fields |= {"links": len(links), "elapsed": elapsed}
+    if random.random() < get_core_settings().log_links_sample_rate:
+        fields["found_links"] = links
+    logging.info("visited %s, %s links", url, len(links), extra=fields)
+
+
+class CrawlContext:
+    """
+    State of a crawl, shared by its workers.
+    `in_flight` tracks the depth of pages being worked on for checkpoints,
+    pages are only worked on while holding one of the `slots`,
+    and each finished page is recorded to `results` if streaming results,
+    and to `graph` if recording the link graph.
+    A standalone crawl owns the process, see `_crawl`
+    """
+
+    def __init__(
+        self,
+        settings: ScrapeEventSettings,
+        client: httpx.AsyncClient,
+        slots: asyncio.Semaphore,
+        results_path: str | None = None,
+        standalone: bool = True,
+    ):
+        self.settings = settings
+        self.client = client
+        self.slots = slots
+        self.standalone = standalone
+        self.queue = get_frontier()
+        self.in_flight: dict[str, int] = {}
+        self.results = NdjsonWriter(results_path) if results_path else None
+        # only standalone, else crawls sharing a process would share the file
+        record_graph = standalone and get_core_settings().link_graph_path
+        self.graph = LinkGraph(settings.base_url) if record_graph else None
+
+    def snapshot(self) -> Callable[[], Checkpoint]:
+        """copy the crawl's state for a checkpoint, see `take_checkpoint`"""
+        return take_checkpoint(self.settings, self.queue, self.in_flight)
+
+    def queue_seeds(self, seeds: list[tuple[str, int]], robots: RobotsRules | None):
+        """queue the urls to start from, bar those disallowed by robots.txt"""
+        ignored: dict[str, Status] = {}
+        for url, depth in seeds:
+            if robots is not None and not robots.allowed(url):
+                logging.info("%s is disallowed by robots.txt, skipping it", url)
+                ignored[url] = Status.IGNORED
+                continue
+            self.queue.put_nowait((url, depth))
+        get_db().set_url_statuses(self.settings.id_, ignored)
+        self.record_statuses(ignored)
+
+    def record_statuses(self, statuses: dict[str, Status]):
+        """stream statuses set outside of a visited page, if streaming results"""
+        if self.results is not None:
+            self.results.write_statuses(statuses)
+
+
+def _crawl_slots(num_workers: int, standalone: bool) -> asyncio.Semaphore:
+    """slots for a crawl not sharing any, one per worker it can have"""
+    core_settings = get_core_settings()
+    autoscale = standalone and core_settings.autoscale_workers
+    return asyncio.Semaphore(core_settings.max_workers if autoscale else num_workers)
+
+
+async def _scrape_page(crawl: CrawlContext, url: str, depth: int):
+    """
+    Scrape a page and queue its new links, then record it in the metrics,
+    the streamed results and the link graph
+    """
+    db, metrics, settings = get_db(), get_metrics(), crawl.settings
+    started, start = time.time(), time.perf_counter()
+    db.set_url_status(settings.id_, url, Status.IN_PROGRESS)
+    links = [
+        link
+        async for link in _page_links(
+            url, crawl.client, settings, db, get_link_parser()
+        )
+    ]
+    tick = time.perf_counter()
+    discovered = queue_links(settings, crawl.queue, links, depth)
+    validate_time = time.perf_counter() - tick
+
+    del crawl.in_flight[url]  # left in place if cancelled, so it is requeued on resume
+    elapsed = time.perf_counter() - start
+    host, page_status = url_host(url), db.get_url_status(settings.id_, url)
+    metrics.observe(Stage.VALIDATE, host, settings.id_, validate_time)
+    metrics.observe(Stage.PAGE, host, settings.id_, elapsed)
+    metrics.increment("pages", host, settings.id_, status=page_status)
+    metrics.increment("links", host, settings.id_, len(links))
+    if crawl.results is not None:
+        crawl.results.write_page(
+            url, page_status, depth, links, discovered, started, elapsed
+        )
+    if crawl.graph is not None:
+        crawl.graph.add_page(url, links)
+    log_visited(url, page_status, depth, links, elapsed)
+
+
 async def worker(
-    queue: asyncio.Queue,
-    client: httpx.AsyncClient,
-    settings: ScrapeEventSettings,
-    shutdown_event: asyncio.Event,
+    crawl: CrawlContext, stop: asyncio.Event, idle: asyncio.Event | None = None
 ):
     """
-    Run workers to scrape links
+    Run workers to scrape links.
+    Workers block on the queue so they wake as soon as work arrives,
+    and are cancelled by `_crawl` once the crawl is done or shutting down.
+    A page failing unexpectedly is logged and marked FAILED, the worker
+    carries on with the next one.
+    `idle` is set while the worker waits for a url, if given
     """
-    db = get_db()
-    while not shutdown_event.is_set():
+    settings, queue = crawl.settings, crawl.queue
+    while not stop.is_set():
+        waited = time.perf_counter()
+        if idle is not None:
+            idle.set()
+        url, depth = await queue.get()
+        if idle is not None:
+            idle.clear()
+        crawl.in_flight[url] = depth
+        await crawl.slots.acquire()
         try:
-            url, depth = queue.get_nowait()  # syncronous operation
-        except (
-            asyncio.QueueEmpty
-        ):  # allows sigterm and siging to shutdown worker when no messages are on queue
-            await asyncio.sleep(1)  # prevents cpu hogging
-            continue
-        db.set_url_status(settings.id_, url, Status.IN_PROGRESS)
-        html = await _fetch_page(url, client, settings, db)
-        links = []
-        for extracted_url in _extract_links(html, url):
-            links.append(extracted_url.encoded_string())
-            status = validate_next_steps(settings, extracted_url, depth)
-            db.set_url_status(settings.id_, extracted_url, status)
-            if status != Status.PENDING:
-                continue  # don't add to queue if already worked on or ignored
+            get_metrics().observe(
+                Stage.QUEUE_WAIT,
+                settings.host,
+                settings.id_,
+                time.perf_counter() - waited,
+            )
+            await _scrape_page(crawl, url, depth)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # one bad page mustn't stop the worker, or the crawl never drains
+            logging.exception("Failed to scrape %s", url)
+            get_db().set_url_status(settings.id_, url, Status.FAILED)
+            crawl.record_statuses({url: Status.FAILED})
+            crawl.in_flight.pop(url, None)
+        finally:
+            crawl.slots.release()
+            queue.task_done()  # never leave join() hanging if a page blows up
 
-            queue.put_nowait((extracted_url, depth + 1))
 
-        logging.info("\033[1;32mvisited %s\033[0m", url.encoded_string())
-        logging.info("\033[1;33mLinks found: %s\033[0m", links)
-        queue.task_done()
+async def _drained(queue: Frontier, seeding: asyncio.Task | None):
+    if seeding is not None:
+        await asyncio.wait((seeding,))  # errors are logged by the seeding itself
+    await queue.join()
 
 
-async def begin(
-    base_url: HttpUrl, max_depth: int, httpx_client: httpx.AsyncClient | None = None
+async def _wait_for_completion(
+    queue: Frontier,
+    shutdown_event: asyncio.Event,
+    seeding: asyncio.Task | None = None,
 ):
     """
-    Begin function to create and pass in the httpx client
+    Wait until either every queued url has been processed, after any seeding
+    has finished, or a shutdown has been requested, whichever happens first
+    """
+    joined = asyncio.create_task(_drained(queue, seeding))
+    stopped = asyncio.create_task(shutdown_event.wait())
+    try:
+        await asyncio.wait((joined, stopped), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        joined.cancel()
+        stopped.cancel()
+    if shutdown_event.is_set():
+        logging.warning("shutdown requested, %s urls left on the queue", queue.qsize())
+
+
+def _seed(crawl: CrawlContext, urls: list[str]) -> int:
+    """queue sitemap urls as if linked from the base url, returning how many were new"""
+    recorded = queue_links(crawl.settings, crawl.queue, urls, 0)
+    crawl.record_statuses(recorded)
+    return sum(status == Status.PENDING for status in recorded.values())
+
+
+async def _seed_from_sitemaps(crawl: CrawlContext, sitemaps: list[str]):
+    """
+    Queue every page listed in the host's sitemaps, as if linked from the base url.
+    Falls back to /sitemap.xml if robots.txt doesn't list any sitemaps
+    """
+    seeded, batch = 0, []
+    async for loc in iter_sitemap_urls(
+        crawl.client,
+        sitemaps or [f"{origin_of(crawl.settings.base_url)}/sitemap.xml"],
+        get_core_settings().sitemap_max_urls,
+    ):
+        if (url := normalize_url(loc)) is not None:
+            batch.append(url)
+        if len(batch) >= SITEMAP_BATCH_SIZE:
+            seeded += _seed(crawl, batch)
+            batch = []
+    seeded += _seed(crawl, batch)
+    logging.info("seeded %s urls from sitemaps", seeded)
+
+
+def _start_workers(
+    crawl: CrawlContext, shutdown_event: asyncio.Event, num_workers: int
+) -> list[asyncio.Task]:
+    """
+    the crawl's workers, resized from `num_workers` by a pool with
+    `autoscale_workers`, see autoscale.py
+    """
+    core_settings = get_core_settings()
+    if not (crawl.standalone and core_settings.autoscale_workers):
+        return [
+            asyncio.create_task(worker(crawl, shutdown_event))
+            for _ in range(num_workers)
+        ]
+    settings = crawl.settings
+    pool = WorkerPool(
+        lambda stop, idle: worker(crawl, stop, idle),
+        crawl.queue,
+        get_metrics().histogram(Stage.FETCH, settings.host, settings.id_),
+        get_metrics().histogram(Stage.PAGE, settings.host, settings.id_),
+        core_settings.min_workers,
+        core_settings.max_workers,
+        core_settings.autoscale_interval,
+        core_settings.autoscale_max_loop_lag,
+    )
+    return [asyncio.create_task(pool.run(num_workers))]
+
+
+async def _start_monitoring(
+    crawl: CrawlContext, checkpoint_path: str | None, tasks: list[asyncio.Task]
+) -> asyncio.Server | None:
+    """
+    add the periodic checkpoint and, if standalone, metrics logging to the
+    crawl's tasks, returning the metrics server if one is served
     """
-    event_settings = get_db().add_scrape_event(uuid4(), base_url, max_depth)
     core_settings = get_core_settings()
+    if checkpoint_path:
+        tasks.append(
+            asyncio.create_task(
+                checkpoint_periodically(
+                    checkpoint_path, core_settings.checkpoint_interval, crawl.snapshot
+                )
+            )
+        )
+    if not crawl.standalone:
+        return None
+    if core_settings.metrics_log_interval:
+        tasks.append(
+            asyncio.create_task(
+                log_metrics_periodically(
+                    get_metrics(), core_settings.metrics_log_interval
+                )
+            )
+        )
+    if core_settings.metrics_port is None:
+        return None
+    return await serve_metrics(
+        get_metrics(), core_settings.metrics_host, core_settings.metrics_port
+    )
+
 
-    queue: asyncio.Queue = asyncio.Queue()
+async def _finish_crawl(
+    crawl: CrawlContext,
+    tasks: list[asyncio.Task],
+    checkpoint_path: str | None,
+    metrics_server: asyncio.Server | None,
+):
+    """
+    stop the crawl's tasks, then write the last checkpoint, the link graph
+    and the results summary, and release what the crawl held
+    """
+    # idle workers are blocked on queue.get() so cancelling is immediate.
+    # pages still in flight on shutdown are left IN_PROGRESS.
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    id_ = crawl.settings.id_
+    if crawl.standalone:
+        logging.info("metrics: %s", get_metrics().summary())
+    if metrics_server is not None:
+        metrics_server.close()
+    if checkpoint_path:
+        await save_checkpoint(checkpoint_path, crawl.snapshot)
+    if crawl.graph is not None and (graph_path := get_core_settings().link_graph_path):
+        await asyncio.to_thread(save_link_graph, id_, crawl.graph, graph_path)
+    get_db().flush()
+    get_content_index().forget(id_)
+    crawl.queue.close()
+    if cache := get_response_cache():
+        cache.flush()
+    if crawl.results:
+        crawl.results.write_summary(
+            get_db().get_scrape_counts(id_), _result_extras(id_)
+        )
+        await asyncio.to_thread(crawl.results.close)
+
+
+async def _crawl(
+    crawl: CrawlContext,
+    seeds: list[tuple[str, int]],
+    checkpoint_path: str | None,
+    sitemaps: bool = False,
+    num_workers: int | None = None,
+):
+    """
+    Run the workers over the scrape event until the queue is drained or
+    a shutdown is requested, checkpointing periodically and on the way out.
+    robots.txt of the host is loaded before anything is queued, other
+    origins' before their first page is fetched, and the frontier is seeded
+    from its sitemaps alongside the workers if `sitemaps`.
+    Results are streamed as NDJSON if the crawl has a results file, and the
+    link graph is recorded to `link_graph_path` if set, see linkgraph.py.
+    A standalone crawl owns the process: it handles signals, closes the client
+    once done and serves and logs metrics, otherwise the caller does
+    """
+    core_settings = get_core_settings()
+    settings = crawl.settings
+    if crawl.standalone:
+        checkpoint_path = checkpoint_path or core_settings.checkpoint_path
     loop = asyncio.get_running_loop()
     shutdown_event = asyncio.Event()
-    loop.add_signal_handler(signal.SIGTERM, shutdown_event.set)
-    loop.add_signal_handler(signal.SIGINT, shutdown_event.set)
+    if crawl.standalone:
+        loop.add_signal_handler(signal.SIGTERM, shutdown_event.set)
+        loop.add_signal_handler(signal.SIGINT, shutdown_event.set)
+    if crawl.results:
+        crawl.results.write_event(settings)
+    client = crawl.client
+    async with client if crawl.standalone else nullcontext(client):
+        robots = None
+        if core_settings.respect_robots:
+            robots = await get_robots_cache().load(
+                client, origin_of(settings.base_url), settings.id_
+            )
+        crawl.queue_seeds(seeds, robots)
+        tasks = _start_workers(
+            crawl, shutdown_event, num_workers or core_settings.num_workers
+        )
+        metrics_server = await _start_monitoring(crawl, checkpoint_path, tasks)
+        seeding = None
+        if sitemaps:
+            seeding = asyncio.create_task(
+                _seed_from_sitemaps(crawl, robots.sitemaps if robots else [])
+            )
+            tasks.append(seeding)
+        try:
+            await _wait_for_completion(crawl.queue, shutdown_event, seeding)
+        finally:
+            shutdown_event.set()
+            await _finish_crawl(crawl, tasks, checkpoint_path, metrics_server)
+            if crawl.standalone:
+                loop.remove_signal_handler(signal.SIGTERM)
+                loop.remove_signal_handler(signal.SIGINT)
+
+
+async def begin(
+    base_url: str,
+    max_depth: int,
+    httpx_client: httpx.AsyncClient | None = None,
+    checkpoint_path: str | None = None,
+    results_path: str | None = None,
+):
+    """
+    Begin function to create and pass in the httpx client.
+    `base_url` is expected to be validated already, e.g. by the cli
+    """
+    event_settings = new_scrape_event(base_url, max_depth)
+    await crawl_scrape_event(
+        event_settings, httpx_client, checkpoint_path, results_path
+    )
+    return event_settings.id_
+
+
+def new_scrape_event(base_url: str, max_depth: int) -> ScrapeEventSettings:
+    """add a scrape event, with its base url validated and recorded"""
+    event_settings = get_db().add_scrape_event(uuid4(), base_url, max_depth)
     ## Do initial validation - have to duplicate this logic twice, but improves efficiency
     status = validate_next_steps(event_settings, event_settings.base_url, 0)
     get_db().set_url_status(event_settings.id_, event_settings.base_url, status)
     ##
-    queue.put_nowait((event_settings.base_url, 0))
+    return event_settings
 
-    httpx_client = httpx_client or get_httpx_client()
-    async with httpx_client as client:
-        workers = [
-            asyncio.create_task(worker(queue, client, event_settings, shutdown_event))
-            for _ in range(core_settings.num_workers)
-        ]
-        await queue.join()
 
-    shutdown_event.set()
+async def crawl_scrape_event(
+    event_settings: ScrapeEventSettings,
+    httpx_client: httpx.AsyncClient | None = None,
+    checkpoint_path: str | None = None,
+    results_path: str | None = None,
+    num_workers: int | None = None,
+    slots: asyncio.Semaphore | None = None,
+    standalone: bool = True,
+):
+    """crawl a new scrape event from its base url, see `_crawl` for the options"""
+    num_workers = num_workers or get_core_settings().num_workers
+    crawl = CrawlContext(
+        event_settings,
+        httpx_client or get_httpx_client(),
+        slots or _crawl_slots(num_workers, standalone),
+        results_path,
+        standalone,
+    )
+    await _crawl(
+        crawl,
+        [(event_settings.base_url, 0)],
+        checkpoint_path,
+        sitemaps=get_core_settings().seed_from_sitemaps,
+        num_workers=num_workers,
+    )
 
-    await asyncio.gather(*workers)
 
-    return event_settings.id_
+async def resume(
+    checkpoint: str,
+    httpx_client: httpx.AsyncClient | None = None,
+    checkpoint_path: str | None = None,
+    results_path: str | None = None,
+):
+    """
+    Resume a scrape event from a checkpoint, under the same scrape event id.
+    Checkpoints keep being written to the same file unless told otherwise,
+    and streamed results are appended to `results_path`
+    """
+    saved = read_checkpoint(checkpoint)
+    seeds = restore_checkpoint(saved)
+    crawl = CrawlContext(
+        saved.settings,
+        httpx_client or get_httpx_client(),
+        _crawl_slots(get_core_settings().num_workers, standalone=True),
+        results_path,
+    )
+    await _crawl(crawl, seeds, checkpoint_path or checkpoint)
+    return saved.settings.id_
+
+
+# extras gathered in other processes, e.g. summed over the shards of a sharded crawl
+_merged_extras: dict[UUID, dict] = {}
+
+
+# summaries of the link graphs recorded, see `save_link_graph`
+_link_graphs: dict[UUID, dict] = {}
+
+
+def save_link_graph(id_: UUID, graph: LinkGraph, path: str):
+    """compact and write a scrape event's link graph, keeping its summary for the results"""
+    start = time.perf_counter()
+    csr = graph.compact()
+    csr.save(path)
+    summary = csr.summary(get_core_settings().link_graph_report_size)
+    _link_graphs[id_] = {"path": path, **summary}
+    logging.info(
+        "link graph of %s urls and %s links written to %s in %.2fs",
+        csr.nodes,
+        csr.edges,
+        path,
+        time.perf_counter() - start,
+    )
+
+
+def merge_result_extras(id_: UUID, extras: dict):
+    """use extras gathered elsewhere for a scrape event's results"""
+    _merged_extras[id_] = extras
+
+
+def _result_extras(id_: UUID) -> dict:
+    """
+    results alongside the url statuses, the rate limits of the scraped host,
+    the response cache stats if caching is on, the link graph's summary
+    if it was recorded and the seen-set's stats if there is one
+    """
+    if (merged := _merged_extras.get(id_)) is not None:
+        return merged
+    host = get_db().get_scrape_event_settings(id_).host
+    extras: dict = {"rate_limits": get_rate_controller().snapshot(host)}
+    if cache := get_response_cache():
+        extras["http_cache"] = cache.get_stats(id_)
+    if (graph := _link_graphs.get(id_)) is not None:
+        extras["link_graph"] = graph
+    if isinstance(db := get_db(), SeenSetDb):
+        extras["seen_set"] = db.get_seen_set_stats(id_)
+    return extras
 
 
 def get_results(id_: UUID):
-    """get scrape event status"""
-    return get_db().get_scrape_stats(id_)
+    """get scrape event status, along with any extra stats"""
+    results = get_db().get_scrape_stats(id_)
+    results.update(_result_extras(id_))
+    return results
+
+
+def forget_scrape_event(id_: UUID):
+    """
+    drop everything kept about a finished scrape event: its url statuses,
+    metrics, response cache stats, link graph summary, merged extras and the
+    robots.txt rules of origins no other scrape event uses
+    """
+    get_robots_cache().forget(id_)
+    if cache := get_response_cache():
+        cache.forget(id_)
+    get_metrics().forget(id_)
+    get_content_index().forget(id_)
+    _link_graphs.pop(id_, None)
+    _merged_extras.pop(id_, None)
+    get_db().remove_scrape_event(id_)
+
+
+def write_results(id_: UUID, f: TextIO):
+    """
+    write the same json as `get_results`, streaming each status' urls
+    to the file instead of building every list in memory first
+    """
+    db = get_db()
+    counts = db.get_scrape_counts(id_)
+    f.write(f'{{"counts": {json.dumps(counts["counts"])}, ')
+    f.write(f'"total_count": {counts["total_count"]}, "status": {{')
+    for i, (status, urls) in enumerate(db.iter_scrape_stats(id_)):
+        f.write(f"{', ' if i else ''}{json.dumps(status)}: [")
+        f.writelines(
+            f"{', ' if j else ''}{json.dumps(url)}" for j, url in enumerate(urls)
+        )
+        f.write("]")
+    f.write("}")
+    f.writelines(
+        f", {json.dumps(key)}: {json.dumps(value)}"
+        for key, value in _result_extras(id_).items()
+    )
+    f.write("}")
@@ -0,0 +1,135 @@
+"""
+Probabilistic seen-set.
+A scalable Bloom filter answers "has this url been seen" in a few bits per
+url, instead of a status record per url. Filters are added as the set grows,
+each twice as large and with half the false positive rate of the one before,
+so the rate over all of them stays under the one asked for however many urls
+are added. Urls are never reported unseen once added, but a new url is
+reported seen with about that probability. A hit is only a hint, the
+SeenSetDb checks urls found in its recorded filter against the db, and a new
+url taken for an ignored one is checked again like one
+"""
+
+from functools import lru_cache
+from hashlib import blake2b
+import math
+
+GROWTH = 2  # capacity of each filter over the previous one's
+TIGHTENING = 0.5  # false positive rate of each filter over the previous one's
+_MASK = 2**64 - 1
+
+
+class BloomFilter:
+    """
+    Bloom filter of `capacity` items at a false positive rate of `error_rate`,
+    probed with the double hashing of two 64 bit hashes
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @property
+    def nbytes(self) -> int:
+        """memory held by the bits"""
+        return len(self._bits)
+
+    def contains(self, first: int, second: int) -> bool:
+        """whether the item with these hashes was probably added"""
+        bits, size = self._bits, self.size
+        # stepping by the second hash mod the size keeps every int small
+        position, step = first % size, second % size or 1
+        for _ in range(self.hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False  # most new urls stop at the first probe or two
+            position += step
+            if position >= size:
+                position -= size
+        return True
+
+    def add(self, first: int, second: int):
+        """add the item with these hashes"""
+        bits, size = self._bits, self.size
+        position, step = first % size, second % size or 1
+        for _ in range(self.hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+            position += step
+            if position >= size:
+                position -= size
+        self.count += 1
+
+    def error_rate(self) -> float:
+        """false positive rate expected at the current count"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+@lru_cache(maxsize=4096)
+def _hashes(url: str) -> tuple[int, int]:
+    """
+    two 64 bit hashes of a url, the halves of a blake2b digest so that
+    the same urls set the same bits in every process. Cached, as a url is
+    usually looked up just before it is added
+    """
+    digest = int.from_bytes(blake2b(url.encode(), digest_size=16).digest())
+    # never 0, which would probe the same bit every time
+    return digest >> 64, (digest & _MASK) | 1
+
+
+class ScalableBloomFilter:
+    """
+    Seen-set of urls at a false positive rate of at most `error_rate`,
+    starting with a filter of `initial_capacity` urls
+    """
+
+    def __init__(self, error_rate: float = 0.001, initial_capacity: int = 1000000):
+        self.target_error_rate = error_rate
+        self._filters = [BloomFilter(initial_capacity, error_rate * (1 - TIGHTENING))]
+
+    def __contains__(self, url: str) -> bool:
+        first, second = _hashes(url)
+        for f in self._filters:
+            if f.contains(first, second):
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return sum(f.count for f in self._filters)
+
+    def add(self, url: str) -> bool:
+        """add a url, returning whether it was probably seen already"""
+        first, second = _hashes(url)
+        for f in self._filters:
+            if f.contains(first, second):
+                return True
+        last = f
+        if last.count >= last.capacity:
+            error_rate = self.target_error_rate * (1 - TIGHTENING)
+            error_rate *= TIGHTENING ** len(self._filters)
+            last = BloomFilter(last.capacity * GROWTH, error_rate)
+            self._filters.append(last)
+        last.add(first, second)
+        return False
+
+    @property
+    def nbytes(self) -> int:
+        """memory held by every filter's bits"""
+        return sum(f.nbytes for f in self._filters)
+
+    def error_rate(self) -> float:
+        """chance a new url is reported seen, at the current counts"""
+        return 1 - math.prod(1 - f.error_rate() for f in self._filters)
+
+    def stats(self) -> dict:
+        """urls added, filters, bytes and the false positive rate expected now"""
+        return {
+            "urls": len(self),
+            "filters": len(self._filters),
+            "bytes": self.nbytes,
+            "error_rate": self.target_error_rate,
+            "estimated_error_rate": self.error_rate(),
+        }
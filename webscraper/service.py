@@ -0,0 +1,323 @@
+"""
+Long running crawl service.
+A small http api taking scrape jobs and crawling them concurrently on one
+event loop, sharing one http client and its connection pool. Each job runs
+its own workers, at most `service_max_job_workers`, and a page is only worked
+on while holding one of `service_max_workers` slots shared by every job, so
+one huge site can't starve the others
+
+    POST   /jobs                {"url": ..., "max_depth": ..., "workers": ...}
+    GET    /jobs                every job and its counts
+    GET    /jobs/{id}           a job and its counts
+    GET    /jobs/{id}/progress  ndjson lines of the job and its counts until it ends
+    GET    /jobs/{id}/results   the job's results, as written by `scrape`
+    DELETE /jobs/{id}           cancel a running job, forget a finished one
+    GET    /metrics             metrics in Prometheus text format
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import time
+from uuid import UUID
+
+import httpx
+from pydantic import ValidationError
+
+from .datastore import get_db
+from .definitions import JobRequest, JobState, ScrapeEventSettings
+from .metrics import get_metrics, log_metrics_periodically
+from .scraper import (
+    crawl_scrape_event,
+    forget_scrape_event,
+    get_results,
+    new_scrape_event,
+)
+from .settings import get_core_settings
+from .utils import get_httpx_client
+
+MAX_BODY_BYTES = 65536
+
+
+class Job:
+    """
+    A scrape event crawled by the service, its state follows the crawl's task
+    """
+
+    def __init__(self, settings: ScrapeEventSettings, workers: int, task: asyncio.Task):
+        self.settings = settings
+        self.workers = workers
+        self.task = task
+        self.started = time.time()
+        self.finished: float | None = None
+        self._counts: dict | None = None
+        task.add_done_callback(self._finish)
+
+    def _finish(self, task: asyncio.Task):
+        self.finished = time.time()
+        # kept so the job can still be described once it has been forgotten
+        self._counts = get_db().get_scrape_counts(self.settings.id_)
+        if not task.cancelled() and (error := task.exception()) is not None:
+            logging.error("job %s failed", self.settings.id_, exc_info=error)
+
+    @property
+    def state(self) -> JobState:
+        """running until the crawl ends, then how it ended"""
+        if not self.task.done():
+            return JobState.RUNNING
+        if self.task.cancelled():
+            return JobState.CANCELLED
+        return JobState.FAILED if self.task.exception() else JobState.DONE
+
+    def describe(self) -> dict:
+        """the job and its counts per status, live until it ends"""
+        state = self.state
+        return {
+            "id": str(self.settings.id_),
+            "url": self.settings.base_url,
+            "max_depth": self.settings.max_depth,
+            "workers": self.workers,
+            "state": state,
+            "error": str(self.task.exception()) if state == JobState.FAILED else None,
+            "started": self.started,
+            "finished": self.finished,
+            **(self._counts or get_db().get_scrape_counts(self.settings.id_)),
+        }
+
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+    """method, path and body of a request"""
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) < 2:
+        raise ValueError("malformed request line")
+    method, path = request_line[:2]
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f"body of {length} bytes is too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?")[0], body
+
+
+def _respond(
+    writer: asyncio.StreamWriter,
+    status: str,
+    body: bytes,
+    content_type: str = "application/json",
+):
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode()
+        + body
+    )
+
+
+def _respond_json(writer: asyncio.StreamWriter, status: str, value):
+    _respond(writer, status, json.dumps(value).encode())
+
+
+class CrawlService:
+    """
+    Runs scrape jobs concurrently with a shared client, and answers the
+    http api. At most `max_workers` pages are worked on at once across every
+    job, and each job runs at most `max_job_workers` workers.
+    Only the latest `max_finished_jobs` finished jobs are kept, everything
+    about older ones is forgotten so a long running service doesn't grow
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        max_workers: int,
+        max_job_workers: int,
+        max_finished_jobs: int = 100,
+    ):
+        self._client = client
+        self._slots = asyncio.Semaphore(max_workers)
+        self._max_job_workers = max_job_workers
+        self._max_finished_jobs = max_finished_jobs
+        self.jobs: dict[UUID, Job] = {}
+
+    def submit(self, request: JobRequest) -> Job:
+        """start crawling a job"""
+        settings = new_scrape_event(request.url.encoded_string(), request.max_depth)
+        workers = min(
+            request.workers or get_core_settings().num_workers, self._max_job_workers
+        )
+        task = asyncio.create_task(
+            crawl_scrape_event(
+                settings,
+                self._client,
+                num_workers=workers,
+                slots=self._slots,
+                standalone=False,
+            )
+        )
+        job = self.jobs[settings.id_] = Job(settings, workers, task)
+        task.add_done_callback(lambda _: self._evict())
+        logging.info("job %s started for %s", settings.id_, settings.base_url)
+        return job
+
+    def forget(self, job: Job):
+        """drop a finished job and everything kept about its scrape event"""
+        del self.jobs[job.settings.id_]
+        forget_scrape_event(job.settings.id_)
+        logging.info("job %s forgotten", job.settings.id_)
+
+    def _evict(self):
+        """forget the jobs which finished first, past `max_finished_jobs`"""
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished is not None),
+            key=lambda job: job.finished or 0,
+        )
+        for job in finished[: max(len(finished) - self._max_finished_jobs, 0)]:
+            self.forget(job)
+
+    def get(self, id_: str) -> Job | None:
+        """a job by its id, None if there is no such job"""
+        try:
+            return self.jobs.get(UUID(id_))
+        except ValueError:
+            return None
+
+    async def close(self):
+        """cancel every running job and wait for them to wind down"""
+        tasks = [job.task for job in self.jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _stream_progress(self, job: Job, writer: asyncio.StreamWriter):
+        """a chunk with the job and its counts every interval, until it ends"""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        interval = get_core_settings().service_progress_interval
+        while True:
+            ended = job.task.done()
+            line = (json.dumps(job.describe()) + "\n").encode()
+            writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            await writer.drain()
+            if ended:
+                break
+            await asyncio.wait((job.task,), timeout=interval)
+        writer.write(b"0\r\n\r\n")
+
+    async def _delete(self, job: Job) -> dict:
+        """cancel a running job, or forget a finished one, and describe it"""
+        if not job.task.done():
+            job.task.cancel()
+            await asyncio.wait((job.task,))
+            return job.describe()
+        description = job.describe()
+        self.forget(job)
+        return description
+
+    def _post_job(self, body: bytes, writer: asyncio.StreamWriter):
+        """submit a job, answering 400 if the request or its url is invalid"""
+        try:
+            request = JobRequest.model_validate_json(body)
+        except ValidationError as e:
+            _respond(writer, "400 Bad Request", e.json().encode())
+            return
+        try:
+            job = self.submit(request)
+        except ValueError as e:  # e.g. a url the normalizer rejects
+            _respond_json(writer, "400 Bad Request", {"detail": str(e)})
+            return
+        _respond_json(writer, "201 Created", job.describe())
+
+    async def _route(
+        self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter
+    ):
+        parts = path.strip("/").split("/")
+        if parts == ["metrics"] and method == "GET":
+            _respond(
+                writer,
+                "200 OK",
+                get_metrics().render().encode(),
+                "text/plain; version=0.0.4; charset=utf-8",
+            )
+        elif parts == ["jobs"] and method == "POST":
+            self._post_job(body, writer)
+        elif parts == ["jobs"] and method == "GET":
+            _respond_json(
+                writer, "200 OK", [job.describe() for job in self.jobs.values()]
+            )
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            if (job := self.get(parts[1])) is None:
+                _respond_json(writer, "404 Not Found", {"detail": "no such job"})
+            elif len(parts) == 2 and method == "GET":
+                _respond_json(writer, "200 OK", job.describe())
+            elif len(parts) == 2 and method == "DELETE":
+                _respond_json(writer, "200 OK", await self._delete(job))
+            elif parts[2:] == ["progress"] and method == "GET":
+                await self._stream_progress(job, writer)
+            elif parts[2:] == ["results"] and method == "GET":
+                _respond_json(writer, "200 OK", get_results(job.settings.id_))
+            else:
+                _respond_json(writer, "404 Not Found", {"detail": "not found"})
+        else:
+            _respond_json(writer, "404 Not Found", {"detail": "not found"})
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """answer a single http request"""
+        try:
+            try:
+                method, path, body = await _read_request(reader)
+            except ValueError as e:
+                _respond_json(writer, "400 Bad Request", {"detail": str(e)})
+            else:
+                await self._route(method, path, body, writer)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int):
+    """
+    Run the service with the shared client until SIGTERM / SIGINT,
+    cancelling any running jobs on the way out
+    """
+    settings = get_core_settings()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    async with get_httpx_client() as client:
+        service = CrawlService(
+            client,
+            settings.service_max_workers,
+            settings.service_max_job_workers,
+            settings.service_max_finished_jobs,
+        )
+        server = await asyncio.start_server(service.handle, host, port)
+        logging.info("crawl service listening on http://%s:%s", host, port)
+        logger = None
+        if settings.metrics_log_interval:
+            logger = asyncio.create_task(
+                log_metrics_periodically(get_metrics(), settings.metrics_log_interval)
+            )
+        try:
+            await stop.wait()
+        finally:
+            running = [job for job in service.jobs.values() if not job.task.done()]
+            logging.info("stopping, cancelling %s running jobs", len(running))
+            server.close()
+            if logger is not None:
+                logger.cancel()
+            await service.close()
+            get_db().flush()
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGINT)
@@ -2,10 +2,48 @@
 Settings and setup
 """
 
+from enum import StrEnum
 from functools import lru_cache
 from pydantic_settings import BaseSettings
 
 
+class ParseMode(StrEnum):
+    """
+    Where html parsing runs
+    """
+
+    PROCESS = "process"
+    THREAD = "thread"
+    INLINE = "inline"
+
+
+class LinkExtractor(StrEnum):
+    """
+    How links are pulled out of pages
+    """
+
+    STREAM = "stream"  # tokenize the response bytes as they arrive
+    SOUP = "soup"  # download the whole page and parse it with BeautifulSoup
+
+
+class DbBackend(StrEnum):
+    """
+    Where scrape events are stored
+    """
+
+    MEMORY = "memory"
+    SQLITE = "sqlite"
+
+
+class ResultsFormat(StrEnum):
+    """
+    How results are written
+    """
+
+    JSON = "json"  # a single json document once the crawl is done
+    NDJSON = "ndjson"  # a record per page as the crawl goes, see results.py
+
+
 class HttpClientSettings(BaseSettings):
     """
     Http Client Settings
@@ -15,17 +53,155 @@ class HttpClientSettings(BaseSettings):
     status_retries: int = 3
     jitter_range: float = 1
     backoff_factor: float = 0.5
+    retry_after_max: float = 300  # longer Retry-After delays are cut to this
     pool_timeout: int = 60
     timeout: int = 15
     max_connections: int = 100
     max_keepalive_connections: int = 50
+    user_agent: str = "webscraper"  # also the token robots.txt rules are matched on
+    # multiplex requests over a few connections per host, needs `httpx[http2]`
+    http2: bool = False
+    # adaptive per host rate limiting, see ratelimit.py
+    adaptive_rate_limit: bool = True
+    host_initial_window: int = 10
+    host_min_window: int = 1
+    host_max_window: int = 100
+    host_window_increase: float = 1
+    host_initial_rate: float = 10
+    host_min_rate: float = 0.5
+    host_max_rate: float = 200
+    host_rate_increase: float = 1
+    host_decrease_factor: float = 0.5
+    # conditional request cache for recrawls, see httpcache.py. off when unset
+    cache_path: str | None = None
+    cache_max_bytes: int = 256 * 1024 * 1024
 
 
 class CoreSettings(BaseSettings):
     """App settings"""
 
     log_level: str = "INFO"
+    # background logging, see logs.py
+    log_max_per_second: float = (
+        100  # records up to INFO past this are dropped, 0 for no cap
+    )
+    log_batch_size: int = 256  # write once this many records are waiting
+    log_flush_interval: float = 1  # or once this many seconds have passed
+    log_links_sample_rate: float = 0.01  # share of pages logged with all their links
     num_workers: int = 10
+    # resize the workers between min and max while crawling, see autoscale.py
+    autoscale_workers: bool = True
+    min_workers: int = 2
+    max_workers: int = 200
+    autoscale_interval: float = 0.5  # seconds between resizes
+    autoscale_max_loop_lag: float = 0.1  # p90 past this shrinks the pool
+    link_extractor: LinkExtractor = LinkExtractor.STREAM
+    # only used by the soup extractor
+    parse_mode: ParseMode = ParseMode.PROCESS
+    parse_workers: int | None = None  # defaults to the number of cores
+    parse_offload_min_bytes: int = 32768  # smaller pages are parsed inline
+    # pages which can't hold links are skipped without downloading them
+    html_content_types: set[str] = {"text/html", "application/xhtml+xml"}
+    max_page_bytes: int = 5 * 1024 * 1024  # html past this isn't read
+    skip_extensions: set[str] = {
+        "7z",
+        "apk",
+        "avi",
+        "bin",
+        "bmp",
+        "css",
+        "deb",
+        "dmg",
+        "doc",
+        "docx",
+        "eot",
+        "exe",
+        "flac",
+        "gif",
+        "gz",
+        "ico",
+        "iso",
+        "jar",
+        "jpeg",
+        "jpg",
+        "js",
+        "m4a",
+        "mkv",
+        "mov",
+        "mp3",
+        "mp4",
+        "msi",
+        "ogg",
+        "otf",
+        "pdf",
+        "png",
+        "ppt",
+        "pptx",
+        "rar",
+        "rpm",
+        "svg",
+        "tar",
+        "tgz",
+        "tif",
+        "tiff",
+        "ttf",
+        "wav",
+        "webm",
+        "webp",
+        "woff",
+        "woff2",
+        "xls",
+        "xlsx",
+        "zip",
+    }
+    # datastore, see datastore.py
+    db_backend: DbBackend = DbBackend.MEMORY
+    sqlite_path: str = "webscraper.db"
+    sqlite_batch_size: int = 1000  # flush the write buffer once it holds this many
+    sqlite_flush_interval: float = 1  # or once this many seconds have passed
+    # keep status records for visited pages only, other urls go in a seen-set,
+    # see seenset.py
+    seen_set: bool = False
+    seen_set_error_rate: float = 0.001  # share of new urls wrongly taken as seen
+    seen_set_initial_capacity: int = 1000000  # urls before the seen-set grows
+    # robots.txt and sitemaps, see robots.py
+    respect_robots: bool = True
+    seed_from_sitemaps: bool = True
+    sitemap_max_urls: int = 100000
+    # crawl frontier, see frontier.py
+    frontier_max_in_memory: int = 100000  # urls queued past this spill to disk
+    frontier_segment_size: int = 10000  # urls per spilled segment file
+    frontier_spill_dir: str | None = None  # defaults to the system temp dir
+    # instrumentation, see metrics.py
+    metrics_port: int | None = None  # serve /metrics in Prometheus format if set
+    metrics_host: str = "127.0.0.1"
+    metrics_log_interval: float = 60  # seconds between summary lines, 0 for none
+    # crawl service, see service.py
+    service_host: str = "127.0.0.1"
+    service_port: int = 8080
+    service_max_workers: int = 100  # pages worked on at once across every job
+    service_max_job_workers: int = 20  # workers a single job can ask for
+    service_progress_interval: float = 1  # seconds between progress lines
+    service_max_finished_jobs: int = 100  # kept for their results, oldest forgotten
+    # checkpoints of the frontier and url statuses, see checkpoint.py
+    checkpoint_path: str | None = None
+    checkpoint_interval: float = 60
+    # crawl scope, see scope.py
+    scope_subdomains: bool = False  # also crawl subdomains of the base url's host
+    scope_allow_hosts: set[str] = set()  # other hosts crawled too
+    scope_allow_paths: list[str] = []  # only paths starting with one of these if set
+    scope_deny_paths: list[str] = []
+    scope_allow_patterns: list[str] = []  # only urls matching one of these if set
+    scope_deny_patterns: list[str] = []  # regexes searched for anywhere in the url
+    # url canonicalization, see urls.py
+    sort_query_params: bool = False
+    strip_query_params: set[str] = set()
+    # record the links between pages to this file if set, needs numpy, see linkgraph.py
+    link_graph_path: str | None = None
+    link_graph_report_size: int = 20  # pages listed per ranking in the results
+    # skip the links of pages whose content was already seen, see fingerprint.py
+    dedup_content: bool = False
+    near_duplicate_distance: int = 3  # max differing simhash bits, at most 3
 
 
 @lru_cache
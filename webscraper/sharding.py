@@ -0,0 +1,351 @@
+"""
+Sharded crawls across processes.
+Every url belongs to one shard, picked by a hash of its normalized key.
+Each shard runs its own event loop, workers and db in a separate process,
+links owned by another shard are forwarded to it in batches over its inbox,
+and the results of every shard are merged back into this process' db
+"""
+
+import asyncio
+from collections import defaultdict
+from collections.abc import Callable
+import logging
+import multiprocessing
+import queue as queue_
+import signal
+import time
+from uuid import UUID, uuid4
+import zlib
+
+import httpx
+
+from .datastore import get_db
+from .definitions import ScrapeEventSettings, Status
+from .frontier import get_frontier
+from .httpcache import get_response_cache
+from .parsing import LinkParser, get_link_parser
+from .ratelimit import get_rate_controller
+from .robots import get_robots_cache, origin_of
+from .scraper import _page_links, log_visited, merge_result_extras, record_links
+from .settings import (
+    CoreSettings,
+    HttpClientSettings,
+    get_core_settings,
+    get_http_client_settings,
+)
+from .utils import get_httpx_client, setup_logging
+
+# (url, depth to validate it at, depth to queue it at)
+Link = tuple[str, int, int]
+
+
+def shard_of(url: str, shards: int) -> int:
+    """the shard owning a normalized url, the same in every process"""
+    return zlib.crc32(url.encode()) % shards
+
+
+class WorkTracker:
+    """
+    Counts busy shards plus batches of links on their way to a shard.
+    It only drops to zero once every shard is idle with nothing left in
+    transit, at which point `done` is set and the crawl is over
+    """
+
+    def __init__(self, context):
+        self._count = context.Value("q", 0)
+        self.done = context.Event()
+
+    def add(self, delta: int):
+        """adjust the count, setting `done` if it reaches zero"""
+        with self._count.get_lock():
+            self._count.value += delta
+            if self._count.value == 0:
+                self.done.set()
+
+
+class _Shard:
+    """
+    State of a shard, run inside its own process
+    """
+
+    def __init__(
+        self,
+        index: int,
+        settings: ScrapeEventSettings,
+        inboxes: list,
+        tracker: WorkTracker,
+    ):
+        self.index = index
+        self.settings = settings
+        self.shards = len(inboxes)
+        self.queue = get_frontier()
+        self._inboxes = inboxes
+        self._tracker = tracker
+        self._outstanding = 0  # queued or in flight pages
+        self._busy = False
+
+    def admit(self, urls: list[str], check_depth: int, queue_depth: int):
+        """validate links this shard owns in one go, queueing the new ones"""
+        recorded = record_links(self.settings, urls, check_depth)
+        new = [url for url, status in recorded.items() if status == Status.PENDING]
+        self._outstanding += len(new)
+        self.queue.put_many((url, queue_depth) for url in new)
+
+    def receive(self, batch: list[Link]):
+        """admit a batch forwarded by another shard"""
+        # the batch stops being in transit, and the shard becomes busy if it
+        # wasn't, which cancels out
+        if self._busy:
+            self._tracker.add(-1)
+        self._busy = True
+        by_depth: dict[tuple[int, int], list[str]] = defaultdict(list)
+        for url, check_depth, queue_depth in batch:
+            by_depth[(check_depth, queue_depth)].append(url)
+        for (check_depth, queue_depth), urls in by_depth.items():
+            self.admit(urls, check_depth, queue_depth)
+        self.settle()
+
+    def forward(self, batches: dict[int, list[Link]]):
+        """send links to the shards that own them"""
+        # counted before sending, so the count can't drop to zero while in transit
+        self._tracker.add(len(batches))
+        for owner, batch in batches.items():
+            self._inboxes[owner].put(batch)
+
+    def page_done(self):
+        """a queued page has been worked on"""
+        self._outstanding -= 1
+        self.settle()
+
+    def settle(self):
+        """mark the shard idle once it has nothing left to do"""
+        if self._busy and self._outstanding == 0:
+            self._busy = False
+            self._tracker.add(-1)
+
+
+async def _shard_worker(shard: _Shard, client: httpx.AsyncClient, parser: LinkParser):
+    """
+    Like `scraper.worker`, but links owned by other shards are forwarded
+    to them rather than validated here
+    """
+    db = get_db()
+    settings = shard.settings
+    while True:
+        url, depth = await shard.queue.get()
+        outgoing: dict[int, list[Link]] = defaultdict(list)
+        try:
+            start = time.perf_counter()
+            db.set_url_status(settings.id_, url, Status.IN_PROGRESS)
+            links, owned = [], []
+            async for link in _page_links(url, client, settings, db, parser):
+                links.append(link)
+                if (owner := shard_of(link, shard.shards)) == shard.index:
+                    owned.append(link)
+                else:
+                    outgoing[owner].append((link, depth, depth + 1))
+            shard.admit(owned, depth, depth + 1)
+            status = db.get_url_status(settings.id_, url)
+            log_visited(url, status, depth, links, time.perf_counter() - start)
+        finally:
+            if outgoing:
+                shard.forward(outgoing)
+            shard.queue.task_done()
+            shard.page_done()
+
+
+async def _receive(shard: _Shard, inbox):
+    """admit batches from the inbox until the crawl is over"""
+    while (batch := await asyncio.to_thread(inbox.get)) is not None:
+        shard.receive(batch)
+
+
+async def _run_shard(
+    shard: _Shard,
+    inbox,
+    tracker: WorkTracker,
+    client_factory: Callable[[], httpx.AsyncClient] | None,
+):
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, tracker.done.set)
+    loop.add_signal_handler(signal.SIGINT, tracker.done.set)
+    parser = get_link_parser()
+    client = client_factory() if client_factory else get_httpx_client()
+    async with client:
+        if get_core_settings().respect_robots:
+            # every shard paces itself, so together they keep to the Crawl-delay
+            robots = get_robots_cache()
+            robots.delay_scale = shard.shards
+            await robots.load(
+                client, origin_of(shard.settings.base_url), shard.settings.id_
+            )
+        tasks = [
+            asyncio.create_task(_shard_worker(shard, client, parser))
+            for _ in range(get_core_settings().num_workers)
+        ]
+        receiver = asyncio.create_task(_receive(shard, inbox))
+        try:
+            await asyncio.to_thread(tracker.done.wait)
+        finally:
+            # pages still in flight on shutdown are left IN_PROGRESS
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    # the receiver stops once the parent sends None
+    await receiver
+    shard.queue.close()
+    parser.close()
+
+
+def _configure_shard(
+    index: int, shards: int, core: CoreSettings, http: HttpClientSettings
+):
+    """
+    Copy the parent's settings, as spawned processes start from the environment.
+    Per host limits and connections are split between the shards so the
+    host sees the same load as from a single process
+    """
+    core_settings, http_settings = get_core_settings(), get_http_client_settings()
+    for name, value in core:
+        setattr(core_settings, name, value)
+    for name, value in http:
+        setattr(http_settings, name, value)
+    core_settings.sqlite_path = f"{core.sqlite_path}.shard{index}"
+    core_settings.checkpoint_path = None
+    for name in (
+        "host_initial_window",
+        "host_max_window",
+        "max_connections",
+        "max_keepalive_connections",
+    ):
+        setattr(http_settings, name, max(1, getattr(http, name) // shards))
+    for name in ("host_initial_rate", "host_max_rate"):
+        setattr(
+            http_settings, name, max(http.host_min_rate, getattr(http, name) / shards)
+        )
+
+
+def _shard_main(
+    index: int,
+    settings: ScrapeEventSettings,
+    core: CoreSettings,
+    http: HttpClientSettings,
+    inboxes: list,
+    tracker: WorkTracker,
+    results,
+    client_factory: Callable[[], httpx.AsyncClient] | None,
+    log: bool,
+):
+    """process entrypoint of a shard"""
+    _configure_shard(index, len(inboxes), core, http)
+    if log:
+        setup_logging()
+    db = get_db()
+    db.add_scrape_event(settings.id_, settings.base_url, settings.max_depth)
+    shard = _Shard(index, db.get_scrape_event_settings(settings.id_), inboxes, tracker)
+    asyncio.run(_run_shard(shard, inboxes[index], tracker, client_factory))
+
+    db.flush()
+    extras: dict = {"rate_limits": get_rate_controller().snapshot(settings.host)}
+    if cache := get_response_cache():
+        cache.flush()
+        extras["http_cache"] = cache.get_stats(settings.id_)
+    results.put((index, db.get_scrape_stats(settings.id_), extras))
+    db.close()
+
+
+def _sum_stats(total: dict, stats: dict) -> dict:
+    """add up nested dicts of numbers"""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            _sum_stats(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def _wait(processes: list, until: Callable[[], bool]):
+    """wait for `until`, failing if a shard dies on the way"""
+    while not until():
+        if any(process.exitcode for process in processes):
+            raise RuntimeError("a shard exited unexpectedly, stopping the crawl")
+
+
+def begin_sharded(
+    base_url: str,
+    max_depth: int,
+    processes: int,
+    client_factory: Callable[[], httpx.AsyncClient] | None = None,
+) -> UUID:
+    """
+    Crawl with `processes` shards, merging their results into the db.
+    `client_factory` must be picklable, i.e. a module level function,
+    and creates each shard's client instead of the default one
+    """
+    db = get_db()
+    settings = db.add_scrape_event(uuid4(), base_url, max_depth)
+    context = multiprocessing.get_context("spawn")
+    root = logging.getLogger()
+    inboxes = [context.Queue() for _ in range(processes)]
+    results = context.Queue()
+    tracker = WorkTracker(context)
+    tracker.add(1)  # the seed is in transit
+    inboxes[shard_of(settings.base_url, processes)].put([(settings.base_url, 0, 0)])
+
+    shards = [
+        context.Process(
+            target=_shard_main,
+            name=f"shard-{index}",
+            args=(
+                index,
+                settings,
+                get_core_settings(),
+                get_http_client_settings(),
+                inboxes,
+                tracker,
+                results,
+                client_factory,
+                # log from the shards as well if this process is logging
+                root.hasHandlers() and root.isEnabledFor(logging.CRITICAL),
+            ),
+        )
+        for index in range(processes)
+    ]
+    for shard in shards:
+        shard.start()
+
+    shard_results: list = []
+
+    def collected() -> bool:
+        try:
+            shard_results.append(results.get(timeout=0.1))
+        except queue_.Empty:
+            pass
+        return len(shard_results) == processes
+
+    try:
+        try:
+            _wait(shards, lambda: tracker.done.wait(0.1))
+        except KeyboardInterrupt:
+            tracker.done.set()  # the shards got the signal too and are stopping
+        for inbox in inboxes:
+            inbox.put(None)
+        _wait(shards, collected)
+    finally:
+        tracker.done.set()
+        for inbox in inboxes:
+            inbox.put(None)
+        for shard in shards:
+            shard.join(timeout=10)
+            if shard.is_alive():
+                shard.terminate()
+
+    extras: dict = {}
+    for _, stats, shard_extras in sorted(shard_results, key=lambda result: result[0]):
+        for status, urls in stats["status"].items():
+            for url in urls:
+                db.set_url_status(settings.id_, url, status)
+        _sum_stats(extras, shard_extras)
+    db.flush()
+    merge_result_extras(settings.id_, extras)
+    return settings.id_
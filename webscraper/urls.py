@@ -0,0 +1,116 @@
+"""
+Url canonicalization.
+Urls are validated and normalized once into strings which are used as keys
+everywhere else, instead of building pydantic HttpUrl's per link. Keys aren't
+interned, as interned strings are never freed on python 3.12, and repeated
+links already share the key cached by the normalizer
+"""
+
+from functools import lru_cache
+from urllib.parse import parse_qsl, quote, urlencode, urljoin, urlsplit, urlunsplit
+
+from .settings import get_core_settings
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+_ABSOLUTE_PREFIXES = ("http://", "https://")
+_PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+QUERY_SAFE = _PATH_SAFE + "?"
+MAX_URL_LENGTH = 2083  # same limit as pydantic's HttpUrl
+
+
+class UrlNormalizer:
+    """
+    Lowercases the scheme and host, drops default ports and fragments,
+    percent encodes the path and query, and optionally sorts query params
+    or strips the ones that don't change the page (e.g. tracking params)
+    """
+
+    def __init__(
+        self,
+        sort_query_params: bool = False,
+        strip_query_params: set[str] | None = None,
+        cache_size: int = 65536,
+    ):
+        self._sort_query_params = sort_query_params
+        self._strip_query_params = frozenset(strip_query_params or ())
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+        self.host = lru_cache(maxsize=cache_size)(self._host)
+        self.extension = lru_cache(maxsize=cache_size)(self._extension)
+
+    def _query(self, query: str) -> str:
+        if not query or not (self._sort_query_params or self._strip_query_params):
+            return quote(query, safe=QUERY_SAFE)
+        params = [
+            (key, value)
+            for key, value in parse_qsl(query, keep_blank_values=True)
+            if key not in self._strip_query_params
+        ]
+        if self._sort_query_params:
+            params.sort()
+        return urlencode(params, safe=QUERY_SAFE)
+
+    def _normalize(self, url: str) -> str | None:
+        """canonical key for a url, or None if it isn't a valid http(s) url"""
+        if len(url) > MAX_URL_LENGTH:
+            return None
+        try:
+            parts = urlsplit(url.strip())
+            host, port = parts.hostname, parts.port
+        except ValueError:
+            return None
+        scheme = parts.scheme  # already lowercased by urlsplit
+        if scheme not in _DEFAULT_PORTS or not host:
+            return None
+        if not host.isascii():
+            try:
+                host = host.encode("idna").decode("ascii")
+            except UnicodeError:
+                return None
+        netloc = f"[{host}]" if ":" in host else host
+        if port is not None and port != _DEFAULT_PORTS[scheme]:
+            netloc = f"{netloc}:{port}"
+        if parts.username is not None:
+            userinfo = parts.username
+            if parts.password is not None:
+                userinfo = f"{userinfo}:{parts.password}"
+            netloc = f"{userinfo}@{netloc}"
+        path = quote(parts.path, safe=_PATH_SAFE) or "/"
+        key = urlunsplit((scheme, netloc, path, self._query(parts.query), ""))
+        return key
+
+    def _host(self, key: str) -> str:
+        """host of an already normalized url"""
+        return urlsplit(key).hostname or ""
+
+    def _extension(self, key: str) -> str:
+        """lowercased file extension of a normalized url's path, if any"""
+        name = urlsplit(key).path.rpartition("/")[2]
+        return name.rpartition(".")[2].lower() if "." in name else ""
+
+    def resolve(self, href: str, base: str) -> str | None:
+        """normalize an href found on the page at `base`"""
+        if href.startswith(_ABSOLUTE_PREFIXES):
+            return self.normalize(href)
+        return self.normalize(urljoin(base, href))
+
+
+@lru_cache
+def get_url_normalizer():
+    """cached app global url normalizer"""
+    settings = get_core_settings()
+    return UrlNormalizer(settings.sort_query_params, settings.strip_query_params)
+
+
+def normalize_url(url: str) -> str | None:
+    """normalize a url with the app global normalizer"""
+    return get_url_normalizer().normalize(url)
+
+
+def url_host(key: str) -> str:
+    """host of a normalized url"""
+    return get_url_normalizer().host(key)
+
+
+def url_extension(key: str) -> str:
+    """file extension of a normalized url, e.g. "pdf", or "" if it has none"""
+    return get_url_normalizer().extension(key)
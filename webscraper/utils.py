@@ -10,12 +10,22 @@ import random
 import sys
 
 import httpx
+from .logs import (
+    BackgroundHandler,
+    BatchedFileHandler,
+    BatchedStreamHandler,
+    JsonFormatter,
+    RateLimitFilter,
+)
+from .metrics import Stage, get_metrics
+from .ratelimit import RateController, get_rate_controller, parse_retry_after
 from .settings import get_http_client_settings, get_core_settings
 
 
 class RetryTransport(httpx.AsyncBaseTransport):
     """
-    Retry transport that uses the async http transport under the hood
+    Retry transport that uses the async http transport under the hood.
+    If given a rate controller every attempt waits for a slot on its host
     """
 
     def __init__(
@@ -24,12 +34,28 @@ class RetryTransport(httpx.AsyncBaseTransport):
         status_retries: int = 3,
         backoff_factor: float = 0.5,
         jitter_range: float = 1,
+        rate_controller: RateController | None = None,
     ):
         self._status_retries = status_retries
         self._backoff_factor = backoff_factor
         self._retry_statuses = (429,)
         self._transport = async_transport
         self._jitter = jitter_range
+        self._rate_controller = rate_controller
+        self._retry_after_max = get_http_client_settings().retry_after_max
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        if self._rate_controller is None:
+            return await self._transport.handle_async_request(request)
+
+        limiter = self._rate_controller.for_host(request.url.host)
+        sent = await limiter.acquire()
+        response = None
+        try:
+            response = await self._transport.handle_async_request(request)
+            return response
+        finally:
+            limiter.release(response, sent)
 
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
         """
@@ -37,7 +63,7 @@ class RetryTransport(httpx.AsyncBaseTransport):
         """
         for attempt in range(self._status_retries + 1):  # retries plus first attempt
             request.headers.update({"Attempt": str(attempt)})
-            response = await self._transport.handle_async_request(request)
+            response = await self._send(request)
             if response.status_code not in self._retry_statuses:
                 return response
 
@@ -45,11 +71,49 @@ class RetryTransport(httpx.AsyncBaseTransport):
             delay = random.uniform(0, self._jitter) + self._backoff_factor * pow(
                 2, attempt
             )  # exponential backoff
-            await asyncio.sleep(delay)
+            retry_after = parse_retry_after(
+                response.headers.get("Retry-After"), self._retry_after_max
+            )
+            backoff = max(delay, retry_after or 0)
+            event = request.extensions.get("scrape_event")
+            metrics = get_metrics()
+            metrics.increment("retries", request.url.host, event)
+            metrics.observe(Stage.BACKOFF, request.url.host, event, backoff)
+            await asyncio.sleep(backoff)
 
         return response
 
 
+def get_transport(**transport_kwargs) -> RetryTransport:
+    """
+    The retrying and rate limited transport of the shared client.
+    `transport_kwargs` override the arguments of the underlying
+    httpx.AsyncHTTPTransport, e.g. `http1=False` for HTTP/2 without TLS
+    """
+    settings = get_http_client_settings()
+    kwargs = {
+        # this only retries on connection failures, not on bad status codes
+        "retries": settings.connection_retries,
+        "limits": httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+        ),
+        # HTTP/2 is negotiated with ALPN, so only used for https urls
+        "http2": settings.http2,
+    }
+    return RetryTransport(
+        async_transport=httpx.AsyncHTTPTransport(**(kwargs | transport_kwargs)),
+        # retries on bad status codes
+        status_retries=settings.status_retries,
+        backoff_factor=settings.backoff_factor,
+        jitter_range=settings.jitter_range,
+        # per host window and rate shared by every worker
+        rate_controller=(
+            get_rate_controller() if settings.adaptive_rate_limit else None
+        ),
+    )
+
+
 @lru_cache
 def get_httpx_client():
     """
@@ -59,20 +123,8 @@ def get_httpx_client():
     settings = get_http_client_settings()
     return httpx.AsyncClient(
         follow_redirects=True,
-        transport=RetryTransport(
-            async_transport=httpx.AsyncHTTPTransport(
-                # this only retries on connection failures, not on bad status codes
-                retries=settings.connection_retries,
-                limits=httpx.Limits(
-                    max_connections=settings.max_connections,
-                    max_keepalive_connections=settings.max_keepalive_connections,
-                ),
-            ),
-            # retries on bad status codes
-            status_retries=settings.status_retries,
-            backoff_factor=settings.backoff_factor,
-            jitter_range=settings.jitter_range,
-        ),
+        headers={"User-Agent": settings.user_agent},
+        transport=get_transport(),
         timeout=httpx.Timeout(
             pool=settings.pool_timeout,
             timeout=settings.timeout,
@@ -82,25 +134,37 @@ def get_httpx_client():
 
 def setup_logging():
     """
-    Setup a stream handler to stdout and a file handler
-    to write to ./logs/logfile.log from the root logger for convenience
+    Log from the root logger through a background thread to stdout and
+    json lines in ./logs/logfile.log, replacing any earlier setup, see logs.py
     """
     settings = get_core_settings()
     logger = logging.getLogger()
     logger.setLevel(settings.log_level.upper())
-    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    for handler in logger.handlers[:]:
+        if isinstance(handler, BackgroundHandler):
+            logger.removeHandler(handler)
+            handler.close()
+
+    batching = {
+        "batch_size": settings.log_batch_size,
+        "flush_interval": settings.log_flush_interval,
+    }
+    stream_handler = BatchedStreamHandler(stream=sys.stdout, **batching)
+    stream_handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s | %(processName)-10s | %(levelname)-8s | %(funcName)s | %(message)s"
+        )
+    )
 
     logfolder, logfile = os.path.join(os.getcwd(), "logs"), "logfile.log"
     if not os.path.exists(logfolder):
         os.makedirs(logfolder)
-    file_handler = logging.FileHandler(f"{logfolder}/{logfile}")
+    file_handler = BatchedFileHandler(f"{logfolder}/{logfile}", **batching)
+    file_handler.setFormatter(JsonFormatter())
 
-    formatter = logging.Formatter(
-        "%(asctime)s | %(processName)-10s | %(levelname)-8s | %(funcName)s | %(message)s"
+    handler = BackgroundHandler(
+        stream_handler, file_handler, flush_interval=settings.log_flush_interval
     )
-    stream_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    handler.addFilter(RateLimitFilter(settings.log_max_per_second))
+    logger.addHandler(handler)
     return logger